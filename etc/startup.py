@@ -49,6 +49,55 @@ hooks.config.Eups.verbose = 0
 # this will not override this on the command-line
 hooks.config.Eups.asAdmin = None
 
+# Eups.cacheFormat:  the format used for the product cache files; either 
+# "pickle" or "indexed".  An indexed cache only decodes the products that 
+# are actually used, which makes loading faster for large stacks.
+# hooks.config.Eups.cacheFormat = "indexed"
+
+# Eups.paranoidCacheCheck:  if True, validate product caches by checking the
+# modification times of all the database files (and the list of declared 
+# products) rather than trusting the database's generation number.  Use this
+# if the database may be updated by older versions of EUPS.
+# hooks.config.Eups.paranoidCacheCheck = True
+
+# Eups.lazyStackLoading:  if True, the product cache for each EUPS_PATH 
+# directory is only read when a lookup first needs it, so a setup that 
+# finds everything in the first directory doesn't read the others.
+# hooks.config.Eups.lazyStackLoading = True
+
+# Eups.cacheLoadThreads:  the number of threads used to read the product 
+# caches of several EUPS_PATH directories at once (default: 1).
+# hooks.config.Eups.cacheLoadThreads = 8
+
+# Eups.cacheTables:  if False, table files are parsed afresh every time 
+# rather than being cached alongside the product cache.
+# hooks.config.Eups.cacheTables = False
+
+# Eups.cacheJournalSize:  the size (in bytes) that the journal of updates 
+# to a product cache may grow to before the cache is rewritten; 0 means 
+# that the cache is rewritten on every update.
+# hooks.config.Eups.cacheJournalSize = 1000000
+
+# Eups.cacheSetupPlans:  if True, replay the way that the same setup was 
+# last resolved rather than resolving every setup afresh.  Only turn this on
+# if your setups don't depend on the environment beyond the products already
+# setup (conditions on environment variables in table files are detected).
+# hooks.config.Eups.cacheSetupPlans = True
+
+# Eups.recordUnsetup:  if False, unsetup finds each product in its stack and
+# reads its table file again, rather than undoing what setup recorded.
+# hooks.config.Eups.recordUnsetup = False
+
+# Eups.tablePrefetchThreads:  the number of threads used to read the table
+# files that a setup will need next; 0 turns off reading ahead.
+# hooks.config.Eups.tablePrefetchThreads = 8
+
+# Eups.cacheStartupFiles:  if True, the configuration that the startup files
+# set is reused (until one of them changes) rather than executing them for
+# every command.  Don't set this if their effect depends on anything but
+# their contents (e.g. the environment, the host, or the time).
+# hooks.config.Eups.cacheStartupFiles = True
+
 # A few other sets of configuration properties are defined that the top level:
 #
 #    Eups      -- properties that configure the main EUPS operations
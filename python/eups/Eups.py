@@ -2,7 +2,9 @@
 The Eups class 
 """
 from __future__ import absolute_import, print_function
+import bisect
 import glob
+import operator
 import re
 import os
 import shutil
@@ -13,14 +15,20 @@ import tempfile
 import zlib
 
 from . import utils
-from .stack      import ProductStack, CacheOutOfSync
+from .stack      import ProductStack, CacheOutOfSync, LazyStacks
 from .db         import Database
 from .tags       import Tags, Tag, TagNotRecognized
 from .exceptions import ProductNotFound, EupsException, TableError, TableFileNotFound
 from .table      import Table, Action
 from .Product    import Product
 from .Uses       import Uses
+from .SetupPlan  import SetupPlan, SetupPlanCache
+from .SetupState import SetupState
+from .PathVariables import OrderedPath, PathVariables
+from .UnsetupRecord import UnsetupRecord
+from .TablePrefetcher import TablePrefetcher
 from .utils      import cmp_or_key, xrange, cmp
+from .VersionCompare import VersionCompare, versionSortKey, latestVersion
 from . import hooks
 
 class Eups(object):
@@ -41,6 +49,11 @@ class Eups(object):
 
     debugFlag = False                   # set via --debug=debug
 
+    # static variable:  a WarmStacks pool of the ProductStacks already loaded by this process, set
+    #  by processes that run many commands (see eups.daemon).  If None, every instance reads the
+    #  stacks afresh.
+    warmStacks = None
+
     # static variable:  the name of the EUPS database directory inside a EUPS-
     #  managed software stack
     ups_db = "ups_db"
@@ -237,6 +250,18 @@ class Eups(object):
         # of this instance.  Used by setup().
         #
         self.alreadySetupProducts = {}
+        #
+        # the products setup in the environment; see getSetupProducts()
+        #
+        self._setupState = None
+        #
+        # the path variables changed by the current setup(), not all written to os.environ
+        #
+        self._pathVars = None
+        #
+        # the table files being read ahead of time; see prefetchTables()
+        #
+        self._tablePrefetcher = None
 
         self.noaction = noaction
         self.force = force
@@ -252,10 +277,18 @@ class Eups(object):
         self._msgs = {}                 # used to suppress messages
         self._msgs["setup"] = {}        # used to suppress messages about setups
 
+        self._versionMatchers = {}      # the _VersionMatchers for version expressions; see version_match()
+
+        self._setupPlan = None          # the SetupPlan being recorded by setup()
+        self._unversionedDbs = {}       # ups_db directories without a generation: are they in use?
+        self._setupPlans = None         # the SetupPlanCache; see _getSetupPlanCache()
+
         self._stacks = {}               # used for saving/restoring state
         self._stacks["env"] = []        # environment that we'll setup
         self._stacks["vro"] = []        # the VRO
         self._stacks["verbose"] = []    # the values of verbose/verboseUnsetup
+        self._savedEnvStates = []       # the setup states and path variables going with
+                                        # self._stacks["env"]
         #
         # The Version Resolution Order.  The entries may be a string (which should be split), or a dictionary
         # indexed by dictionary names in the EUPS_PATH (as set by -z); each value in this dictionary should
@@ -308,9 +341,11 @@ class Eups(object):
 
         #
         # Get product information:  
-        #   * read the cached version of product info
+        #   * read the cached version of product info (if configured to load
+        #     stacks lazily, this happens when a stack is first consulted;
+        #     self.versions.loaded lists the stacks read so far)
         #
-        self.versions = {}
+        self.versions = LazyStacks()
         neededFlavors = utils.Flavor().getFallbackFlavors(self.flavor, True)
         if readCache:
           for p in self.path:
@@ -323,12 +358,10 @@ class Eups(object):
             if not self.asAdmin or not utils.isDbWritable(p):
                 # use a user-writable alternate location for the cache
                 cacheDir = userCacheDir
-            self.versions[p] = ProductStack.fromCache(dbpath, neededFlavors, 
-                                                      persistDir=cacheDir, 
-                                                      userTagDir=userCacheDir,
-                                                      updateCache=True, 
-                                                      autosave=False,
-                                                      verbose=self.verbose)
+            self.versions.addLoader(p, self._stackLoader(dbpath, neededFlavors, cacheDir, userCacheDir))
+
+          if not hooks.config.Eups.lazyStackLoading:
+              self.versions.loadAll(nthread=hooks.config.Eups.cacheLoadThreads)
         #
         # 
         fallbackList = hooks.config.Eups.fallbackFlavors
@@ -456,6 +489,8 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if what == "env":
             current = os.environ.copy()
+            self._savedEnvStates.append((self._setupState and self._setupState.copy(),
+                                         self._pathVars and self._pathVars.copy()))
         elif what == "vro":
             current = self.getPreferredTags()
             if value:
@@ -482,6 +517,7 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if what == "env":
             os.environ = value
+            self._setupState, self._pathVars = self._savedEnvStates.pop()
         elif what == "vro":
             self.setPreferredTags(value)
         elif what == "verbose":
@@ -501,6 +537,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             self._stacks[what].pop()
         except IndexError:
             raise RuntimeError("Programming error: stack \"%s\" doesn't have an element to drop" % what)
+        if what == "env":
+            self._savedEnvStates.pop()
 
         self.__showStack("drop", what)
 
@@ -522,6 +560,33 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return db
 
+    def _stackLoader(self, dbpath, flavors, cacheDir, userCacheDir):
+        # return a function that loads the product stack for a database
+        def load():
+            if Eups.warmStacks is not None:
+                stack = Eups.warmStacks.get(dbpath, flavors, cacheDir, userCacheDir)
+                if stack is not None:
+                    return stack
+
+            if self.verbose > 2:
+                print("Loading product stack for %s" % dbpath, file=utils.stdinfo)
+            stack = ProductStack.fromCache(dbpath, flavors, persistDir=cacheDir, 
+                                           userTagDir=userCacheDir, updateCache=True, 
+                                           autosave=False, verbose=self.verbose)
+            if Eups.warmStacks is not None:
+                Eups.warmStacks.add(stack, dbpath, flavors, cacheDir, userCacheDir)
+            return stack
+        return load
+
+    def _isUnneededStack(self, eupsPathDir, productName):
+        # return True if the product stack for eupsPathDir hasn't been read
+        # yet and needn't be read to search for productName, as the product 
+        # isn't declared there
+        if eupsPathDir not in self.versions or self.versions.isLoaded(eupsPathDir):
+            return False
+        dbpath = self.getUpsDB(eupsPathDir)
+        return os.path.exists(dbpath) and not self._databaseFor(eupsPathDir, dbpath).isDeclared(productName)
+
     def _userStackCache(self, eupsPathDir):
         if not self.userDataDir:
             return None
@@ -652,8 +717,8 @@ The what argument tells us what sort of state is expected (allowed values are de
                             continue
 
                         try:
-                            self.versions[p].lookup[flavor][productName].tags[etag] = versionName
-                        except KeyError:
+                            self.versions[p].lookup[flavor][productName].assignTag(etag, versionName)
+                        except (KeyError, ProductNotFound):
                             continue
                 
     def setPreferredTags(self, tags):
@@ -797,6 +862,37 @@ The what argument tells us what sort of state is expected (allowed values are de
         # Return the name of the product directory's environment variable
         return utils.dirEnvNameFor(productName)
 
+    def _envarUnsetupName(self, productName):
+        # Return the name of the environment variable recording how to unsetup the product
+        return utils.unsetupEnvNameFor(productName)
+
+    def _getUnsetupRecord(self, productName):
+        # Return the UnsetupRecord written when the product was setup, or None
+        if not hooks.config.Eups.recordUnsetup:
+            return None
+
+        value = os.environ.get(self._envarUnsetupName(productName))
+        if value is None or self._envarSetupName(productName) not in os.environ:
+            return None
+
+        try:
+            return UnsetupRecord.fromString(value)
+        except ValueError as e:
+            if self.verbose > 1:
+                print("Ignoring the record of how %s was setup: %s" % (productName, e), file=utils.stdwarn)
+            return None
+
+    def _findRecordedSetupProduct(self, productName):
+        # Return the setup product described by the environment, without looking it up in its stack
+        versionName, eupsPathDir, productDir, tablefile, flavor = self.findSetupVersion(productName)
+        if versionName is None:
+            return None
+
+        db = None
+        if eupsPathDir:
+            db = self.getUpsDB(eupsPathDir)
+        return Product(productName, versionName, flavor, productDir, tablefile, db=db)
+
 
     def findProductFromVRO(self, name, version=None, versionExpr=None, eupsPathDirs=None, flavor=None,
                            noCache=False, recursionDepth=0, vro=None, optional=False):
@@ -892,6 +988,8 @@ The what argument tells us what sort of state is expected (allowed values are de
                 #
                 vroTag = "version"
                 for root in eupsPathDirs:
+                    if self._isUnneededStack(root, name):
+                        continue
                     if noCache or root not in self.versions or not self.versions[root]:
                         # go directly to the EUPS database
                         if not os.path.exists(self.getUpsDB(root)):
@@ -1083,6 +1181,8 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         # search path for an explicit version 
         for root in eupsPathDirs:
+            if self._isUnneededStack(root, name):
+                continue
             if noCache or root not in self.versions or not self.versions[root]:
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
@@ -1171,6 +1271,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             return out
 
         for root in eupsPathDirs:
+            if self._isUnneededStack(root, name):
+                continue
             if noCache or root not in self.versions or not self.versions[root]:
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
@@ -1304,6 +1406,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         out = None
 
         for root in eupsPathDirs:
+            if self._isUnneededStack(root, name):
+                continue
             if noCache or root not in self.versions or not self.versions[root]:
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
@@ -1328,19 +1432,23 @@ The what argument tells us what sort of state is expected (allowed values are de
             else:
                 # consult the cache
                 try: 
-                    vers = self.versions[root].getVersions(name, flavor)
-                    vers.sort(**cmp_or_key(self.version_cmp))
-                    if len(vers) == 0:
+                    index = self.versions[root].getVersionIndex(name, flavor, self.version_cmp)
+                    if index is not None:
+                        latestVers = index.latest()
+                    else:
+                        latestVers = latestVersion(self.version_cmp,
+                                                   self.versions[root].getVersions(name, flavor))
+                    if latestVers is None:
                         continue
 
                     # is latest version in this stack newer than minimum version?
-                    if minver and self.version_cmp(vers[-1], minver) < 0:
+                    if minver and self.version_cmp(latestVers, minver) < 0:
                         continue
 
-                    if out == None or self.version_cmp(vers[-1], 
+                    if out == None or self.version_cmp(latestVers, 
                                                         out.version) > 0:
                         # latest one in this stack is latest one seen
-                        out = self.versions[root].getProduct(name, vers[-1], flavor)
+                        out = self.versions[root].getProduct(name, latestVers, flavor)
 
                 except ProductNotFound:
                     continue
@@ -1357,6 +1465,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         out = []
         outver = []
         for root in eupsPathDirs:
+            if self._isUnneededStack(root, name):
+                continue
             if noCache or root not in self.versions or not self.versions[root]:
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
@@ -1368,7 +1478,8 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if len(products) == 0: 
                     continue
 
-                products = [z for z in products if self.version_match(z.version, expr)]
+                matched = set(self.versions_match([z.version for z in products], expr))
+                products = [z for z in products if z.version in matched]
                 for prod in products:
                     if prod.version not in outver:
                         out.append(prod)
@@ -1378,7 +1489,9 @@ The what argument tells us what sort of state is expected (allowed values are de
                 # consult the cache
                 try: 
                     vers = self.versions[root].getVersions(name, flavor)
-                    vers = [z for z in vers if self.version_match(z, expr)]
+                    vers = self.versions_match(vers, expr,
+                                               self.versions[root].getVersionIndex(name, flavor,
+                                                                                   self.version_cmp))
                     if len(vers) == 0:
                         continue
                     for ver in vers:
@@ -1405,14 +1518,13 @@ The what argument tells us what sort of state is expected (allowed values are de
         for tag in preferredTags:
             tag = self.tags.getTag(tag)  # should not fail
             if tag.name == "latest":
-                # find the latest version; first order the versions
-                vers = [p.version for p in products]
-                vers.sort(**cmp_or_key(self.version_cmp))
+                # find the latest version
+                latestVers = latestVersion(self.version_cmp, [p.version for p in products])
 
                 # select the product with the latest version
-                if len(vers) > 0:
+                if latestVers is not None:
                     for p in products:
-                        if p.version == vers[-1]:
+                        if p.version == latestVers:
                             return p
             elif tag.name == "setup":
                 for p in products:
@@ -1494,56 +1606,92 @@ The what argument tells us what sort of state is expected (allowed values are de
             if self.path.count(dataDir) == 0:
                 self.path.append(dataDir)
                 
-                self.versions[dataDir] = ProductStack.fromCache(self.getUpsDB(dataDir), [self.flavor],
-                                                                updateCache=True, autosave=False,
-                                                                verbose=self.verbose)
+                self.versions.addLoader(dataDir, self._stackLoader(self.getUpsDB(dataDir), [self.flavor],
+                                                                   None, None))
+                if not hooks.config.Eups.lazyStackLoading:
+                    self.versions.load(dataDir)
 
     def getSetupProducts(self, requestedProductName=None):
         """Return a list of all Products that are currently setup (or just the specified product)"""
 
-        re_setup = re.compile(r"^%s(\w+)$" % utils.setupEnvPrefix())
+        if self._setupState is None:
+            self._setupState = SetupState()
+        state = self._setupState
+
+        names = state.getNames(requestedProductName)
+        self._resolveSetupProducts([n for n in names if not state.isResolved(n)])
 
         productList = []
+        for productName in names:
+            product, warning = state.getResolved(productName)
+            if product:
+                productList += [product]
+            elif self.quiet <= 0:
+                print(warning, file=utils.stdwarn)
 
-        for key in [k for k in os.environ.keys() if re.search(re_setup, k)]:
-            try:
-                productInfo = os.environ[key].split()
-                productName = productInfo[0]
-            except IndexError:          # Oh dear;  "$setupEnvPrefix()_productName" must be malformed
-                continue
+        return productList
 
+    def _resolveSetupProducts(self, productNames):
+        # find the Products for setup products, recording them in self._setupState.  The
+        # products with explicit versions are looked up stack by stack, each stack being
+        # checked once for the lot.
+        state = self._setupState
+        byStack = {}
+        for productName in productNames:
             try:
-                versionName = productInfo[1]
-            except IndexError:
-                versionName = None
-
-            if requestedProductName and productName != requestedProductName:
+                versionName, eupsPathDir, productDir, tablefile, flavor = \
+                    self.findSetupVersion(productName)
+            except EupsException as e:
+                state.setResolved(productName, None, str(e))
+                continue
+            except Exception as e:
+                state.setResolved(productName, None,
+                                  "Problem with product \"%s\" found in the environment: %s" % \
+                                  (productName, e))
                 continue
 
-            try:
-                try:
-                    product = self.findSetupProduct(productName)
-                except Exception as e:
-                    if self.quiet <= 0:
-                        print("Problem with product \"%s\" found in the environment: %s" % \
-                            (productName, e), file=utils.stdwarn)
-
-                    continue
-
-                if not product:
-                    if self.quiet <= 0:
-                        print("Unable to find %s %s although it is seen in the environment" % \
-                              (productName, versionName), file=utils.stdwarn)
-                    continue
+            if versionName is None or versionName.startswith(Product.LocalVersionPrefix) or \
+                     eupsPathDir is None or self.ignore_versions or \
+                     self.isLegalRelativeVersion(versionName) or \
+                     self._isUnneededStack(eupsPathDir, productName) or \
+                     eupsPathDir not in self.versions or not self.versions[eupsPathDir]:
+                self._resolveSetupProduct(productName)
+            else:
+                byStack.setdefault(eupsPathDir, []).append((productName, versionName, flavor))
 
-            except EupsException as e:
-                if self.quiet <= 0:
-                    print(e, file=utils.stdwarn)
-                continue
+        for root in byStack:
+            stack = self.versions[root]
+            stack.ensureInSync(verbose=self.verbose)
+            for productName, versionName, flavor in byStack[root]:
+                try:
+                    product = stack.getProduct(productName, versionName, flavor or self.flavor)
+                except ProductNotFound:
+                    self._resolveSetupProduct(productName)
+                except EupsException as e:
+                    state.setResolved(productName, None, str(e))
+                else:
+                    state.setResolved(productName, product)
 
-            productList += [product]
+    def _resolveSetupProduct(self, productName):
+        # find the Product for a single setup product, recording it in self._setupState
+        try:
+            product = self.findSetupProduct(productName)
+        except EupsException as e:
+            self._setupState.setResolved(productName, None, str(e))
+            return
+        except Exception as e:
+            self._setupState.setResolved(productName, None,
+                                         "Problem with product \"%s\" found in the environment: %s" % \
+                                         (productName, e))
+            return
 
-        return productList
+        if product:
+            self._setupState.setResolved(productName, product)
+        else:
+            versionName = self.findSetupVersion(productName)[0]
+            self._setupState.setResolved(productName, None,
+                                         "Unable to find %s %s although it is seen in the environment" % \
+                                         (productName, versionName))
 
     def findSetupProduct(self, productName, environ=None):
         """
@@ -1565,18 +1713,70 @@ The what argument tells us what sort of state is expected (allowed values are de
     def setEnv(self, key, val, interpolateEnv=False):
         """Set an environmental variable"""
             
+        if self._pathVars is not None:
+            if interpolateEnv and "${" in val:
+                self.flushPathVariables()
+            self._pathVars.discard(key)
+
         if interpolateEnv:              # replace ${ENV} by its value if known
             val = re.sub(r"(\${([^}]*)})", lambda x : os.environ.get(x.group(2), x.group(1)), val)
 
         if val == None:
             val = ""
         os.environ[key] = val
+        if self._setupState is not None:
+            self._setupState.invalidate(key)
 
     def unsetEnv(self, key):
         """Unset an environmental variable"""
 
+        if self._pathVars is not None:
+            self._pathVars.discard(key)
+
         if key in os.environ:
             del os.environ[key]
+            if self._setupState is not None:
+                self._setupState.invalidate(key)
+
+    def getEnvPath(self, key, delim=":"):
+        """
+        return the value of a path-like environmental variable as an OrderedPath, which may be
+        changed and passed to setEnvPath()
+        """
+        if self._pathVars is not None:
+            path = self._pathVars.get(key)
+            if path is not None:
+                if path.delim == delim:
+                    return path
+                self.flushPathVariables()
+                self._pathVars.discard(key)
+
+        return OrderedPath(os.environ.get(key, ""), delim)
+
+    def setEnvPath(self, key, path):
+        """
+        Set a path-like environmental variable to an OrderedPath.  While setup() is running
+        the value is only written to os.environ when the setup is complete (see
+        flushPathVariables()).
+        """
+        if self._pathVars is None:
+            self.setEnv(key, str(path), interpolateEnv=True)
+        else:
+            self._pathVars.set(key, path)
+
+    def flushPathVariables(self):
+        """
+        Write any path-like environmental variables that have been set by setEnvPath() to os.environ
+        """
+        if self._pathVars is None or self._pathVars.isWritten():
+            return
+
+        paths, self._pathVars = self._pathVars, None
+        try:
+            for key, val in paths.flush():
+                self.setEnv(key, val, interpolateEnv=True)
+        finally:
+            self._pathVars = paths
 
     def setAlias(self, key, val):
         """Set an alias.  The value is in sh syntax --- we'll mangle it for csh later"""
@@ -1655,13 +1855,90 @@ The what argument tells us what sort of state is expected (allowed values are de
         if isinstance(product, Product):
             product = product.name
 
-        prod = self.findSetupProduct(product)
+        if self._getUnsetupRecord(product) is not None:
+            prod = self._findRecordedSetupProduct(product)
+        else:
+            prod = self.findSetupProduct(product)
         if prod is not None:
             try:
                 self.setup(prod.name, fwd=False, noRecursion=noRecursion)
             except EupsException as e:
                 print("Unable to unsetup %s %s: %s" % (prod.name, prod.version, e), file=utils.stderr)
 
+    def prefetchTables(self, actions):
+        """
+        start reading the table files of the products that the setupRequired actions from a
+        table file will probably setup, so that they have been read by the time that they are
+        needed (see takePrefetchedTable()).  Tables that are already in their stack's TableCache
+        aren't read.  Nothing else is changed; the products are resolved as usual when the
+        actions are executed.
+        """
+        if hooks.config.Eups.tablePrefetchThreads <= 0:
+            return
+
+        paths = []
+        for a in actions:
+            if a.cmd != Action.setupRequired:
+                continue
+
+            productName, versionName = a.getDependencySpec()
+            if productName is None:
+                continue
+
+            product = self._guessDependency(productName, versionName)
+            if product is not None and not product.isTableCached():
+                tablefile = product.tableFileName()
+                if tablefile:
+                    paths.append(tablefile)
+
+        if paths:
+            if self._tablePrefetcher is None:
+                self._tablePrefetcher = TablePrefetcher(hooks.config.Eups.tablePrefetchThreads)
+            self._tablePrefetcher.prefetch(paths)
+
+    def takePrefetchedTable(self, product):
+        """
+        return the lines of a product's table file if it has been read by prefetchTables(), or None
+        """
+        if self._tablePrefetcher is None:
+            return None
+
+        tablefile = product.tableFileName()
+        if not tablefile:
+            return None
+        return self._tablePrefetcher.take(tablefile)
+
+    def _guessDependency(self, productName, versionName):
+        # return the product that a dependency on productName versionName will probably be resolved
+        # to, or None.  Only stacks that are already loaded are searched, and nothing is changed.
+        if versionName:
+            mat = re.search(r"(?:(\S*)\s+)?\[([^\]]+)\]", versionName) # "exact [logical]"
+            if mat:
+                versionName = mat.group(1)
+        if self.ignore_versions or (versionName and self._relop_re.search(versionName)):
+            versionName = None
+
+        stacks = [self.versions[p] for p in self.path
+                  if p in self.versions and self.versions.isLoaded(p)]
+
+        if versionName:
+            for stack in stacks:
+                try:
+                    return stack.getProduct(productName, versionName, self.flavor)
+                except ProductNotFound:
+                    pass
+
+        for tagName in self.getPreferredTags():
+            if tagName in ("setup", "latest") or not self.tags.isRecognized(tagName):
+                continue
+            tag = self.tags.getTag(tagName)
+            for stack in stacks:
+                product = stack.getTaggedProduct(productName, self.flavor, tag)
+                if product:
+                    return product
+
+        return None
+
     # Permitted relational operators
     _relop_re = re.compile(r"<=?|>=?|==")
     _bad_relop_re = re.compile(r"^\s*=\s+\S+")
@@ -1679,58 +1956,23 @@ The what argument tells us what sort of state is expected (allowed values are de
     def version_match(self, vname, expr):
         """Return vname if it matches the logical expression expr"""
 
-        expr0 = expr
-        expr = [x for x in re.split(r"\s*(%s|\|\||\s)\s*" % self._relop_re.pattern, expr0) if not re.search(r"^\s*$", x)]
-
-        logop = None                    # the next logical operation to process
-        value = None                    # the value of the current term (e.g. ">= 2.0.0")
-        i = -1
-        while i < len(expr) - 1:
-            i += 1
-
-            if self._relop_re.search(expr[i]):
-                relop = expr[i]; i += 1
-                v = expr[i]
-            elif re.search(r"^[-+.:/\w]+$", expr[i]) and expr[i] not in ("and", "or"):
-                relop = "=="
-                v = expr[i]
-            elif expr[i] == "||" or expr[i] == "or":
-                logop = "or"
-                continue
-            elif expr[i] == "&&" or expr[i] == "and":
-                if not value:
-                    return False        # short circuit
-                
-                logop = "and"
-                continue
-            else:
-                print("Unexpected operator %s in \"%s\"" % (expr[i], expr0), file=utils.stdwarn)
-                break
-
-            if not logop and value is not None:
-                print("Expected logical operator || or && in \"%s\" at %s" % (expr0, v), file=utils.stdwarn)
-            else:
-                try:
-                    rhs = self.version_match_prim(relop, vname, v)
-                    if not logop:
-                        value = rhs
-                    elif logop == "and":
-                        if value and rhs:
-                            value = True
-                        else:
-                            value = False
-                    elif logop == "or":
-                        if value or rhs:
-                            return vname
+        return self._versionMatcher(expr).match(vname)
 
-                        value = False
-                except ValueError:           # no sort order is defined
-                    return None
+    def versions_match(self, vnames, expr, index=None):
+        """
+        Return the versions in the list vnames that match the logical expression expr.  If index
+        is a VersionIndex of vnames sorted by version_cmp, it's searched by bisection
+        """
+        return self._versionMatcher(expr).filter(vnames, index)
 
-        if value:
-            return vname
-        else:
-            return None
+    def _versionMatcher(self, expr):
+        # return the _VersionMatcher for expr, splitting it into terms only the first time it's seen
+        try:
+            return self._versionMatchers[expr]
+        except KeyError:
+            matcher = _VersionMatcher(self, expr)
+            self._versionMatchers[expr] = matcher
+            return matcher
 
     def version_match_prim(self, op, v1, v2):
         """
@@ -1802,7 +2044,58 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param versionExpr      An expression specifying the desired version
         @param implicitProduct  True iff product is setup due to being specified in implicitProducts
         """
+        if self._pathVars is None:
+            # keep the path variables that the setup changes in memory, writing them to
+            # os.environ when we're done
+            self._pathVars = PathVariables()
+            try:
+                return self.setup(productName, versionName, fwd, recursionDepth, setupToplevel,
+                                  noRecursion, productRoot, tablefile, versionExpr, optional,
+                                  implicitProduct)
+            finally:
+                self.flushPathVariables()
+                self._pathVars = None
+                if self._tablePrefetcher is not None:
+                    self._tablePrefetcher.close()
+                    self._tablePrefetcher = None
+
+        planKey = None
+        if fwd and recursionDepth == 0 and self._setupPlan is None:
+            planKey = self._setupPlanKey(productName, versionName, setupToplevel, noRecursion,
+                                         productRoot, tablefile, versionExpr, optional,
+                                         implicitProduct)
+        if planKey is None:
+            return self._setup(productName, versionName, fwd, recursionDepth, setupToplevel,
+                               noRecursion, productRoot, tablefile, versionExpr, optional,
+                               implicitProduct)
+        #
+        # Replay the way that this setup was resolved last time, if nothing has changed since;
+        # otherwise, resolve it and record what was done
+        #
+        plans = self._getSetupPlanCache()
+        plan = plans.get(planKey)
+        if plan is not None:
+            if self.verbose > 2:
+                print("Using the cached resolution of setup %s" % productName, file=utils.stdinfo)
+            return self._replaySetupPlan(plan, noRecursion)
 
+        self._setupPlan = SetupPlan()
+        try:
+            ret = self._setup(productName, versionName, fwd, recursionDepth, setupToplevel,
+                              noRecursion, productRoot, tablefile, versionExpr, optional,
+                              implicitProduct)
+        finally:
+            plan, self._setupPlan = self._setupPlan, None
+
+        if ret[0] and plan.cacheable:
+            plans.add(planKey, plan)
+            plans.save()
+
+        return ret
+
+    def _setup(self, productName, versionName, fwd, recursionDepth, setupToplevel, noRecursion,
+               productRoot, tablefile, versionExpr, optional, implicitProduct):
+        # the implementation of setup(), without the use of cached setup plans
         if isinstance(versionName, str) and versionName.startswith(Product.LocalVersionPrefix):
             productRoot = versionName[len(Product.LocalVersionPrefix):]
 
@@ -1814,14 +2107,21 @@ The what argument tells us what sort of state is expected (allowed values are de
         #
         setupFlavor = self.flavor         # we may end up using e.g. "generic"
         product, localProduct = None, None
+        planIndex = None                  # the product's step in self._setupPlan
+        unsetupRecord = None              # the record of how to unsetup the product
         if isinstance(productName, Product): # it's already a full Product
             raise RuntimeError("Product type passed to setup")
             # product = productName
             # productName = product.name
 
         elif not fwd:
-            # on unsetup, get the product to unsetup
-            product = self.findSetupProduct(productName)
+            # on unsetup, get the product to unsetup.  If we recorded how it was setup we
+            # needn't look for it in the stacks
+            unsetupRecord = self._getUnsetupRecord(productName)
+            if unsetupRecord is not None:
+                product = self._findRecordedSetupProduct(productName)
+            else:
+                product = self.findSetupProduct(productName)
             if not product:
                 msg = "I can't unsetup %s as it isn't setup" % productName
                 if self.verbose > 1 and self.quiet <= 0:
@@ -1944,19 +2244,25 @@ The what argument tells us what sort of state is expected (allowed values are de
 
                 self.alreadySetupProducts[product.name] = (product, vroReason)
 
-        try:
-            table = product.getTable(quiet=not fwd, verbose=self.verbose)
-        except TableFileNotFound as e:
-            if fwd:
-                raise
+        if unsetupRecord is not None:
+            table = None
+        else:
+            try:
+                table = product.getTable(quiet=not fwd, verbose=self.verbose,
+                                         contents=self.takePrefetchedTable(product))
+            except TableFileNotFound as e:
+                if fwd:
+                    raise
 
-            if not self.force:
-                raise
+                if not self.force:
+                    raise
 
-            table = None
-            print("Warning: %s" % e, file=utils.stdwarn)
+                table = None
+                print("Warning: %s" % e, file=utils.stdwarn)
         
-        if table:
+        if unsetupRecord is not None:
+            actions = unsetupRecord.getActions(product)
+        elif table:
             try:
                 verbose = self.verbose
                 if not fwd:
@@ -1965,6 +2271,12 @@ The what argument tells us what sort of state is expected (allowed values are de
             except TableError as e:
                 print("product %s %s: %s" % (product.name, product.version, e), file=utils.stdwarn)
                 return False, product.version, e
+
+            if fwd and self._setupPlan is not None and table.dependsOnEnvironment():
+                self._setupPlan.cacheable = False   # the conditions aren't part of the plan's key
+
+            if fwd and not noRecursion and recursionDepth != self.max_depth:
+                self.prefetchTables(actions)
         else:
             actions = []
 
@@ -2030,34 +2342,14 @@ The what argument tells us what sort of state is expected (allowed values are de
                             print("            %s%s" % (recursionDepth*" ", msg), file=utils.stdwarn)
                         setup_msgs[msg] = 1
 
-            q = utils.Quiet(self)
-            self.unsetupSetupProduct(product, noRecursion=noRecursion)
-            del q
+            self._setupProductEnv(product, setupFlavor, vroReason, localProduct, productRoot,
+                                  tablefile, noRecursion)
 
-            if localProduct:
-                version = localProduct.version
-            else:
-                version = product.version
-
-            setup_product_str = "%s %s -f %s -Z %s" % (
-                product.name, version, setupFlavor, utils.encodePath(product.stackRoot()))
-            if tablefile:
-                setup_product_str += " -m %s" % (tablefile)
-
-            if not productRoot:
-                productRoot = product.dir
-            self.setEnv(self._envarDirName(product.name), productRoot)
-            self.setEnv(self._envarSetupName(product.name), setup_product_str)
-
-            extraDir = os.path.join(product.stackRoot(), Eups.ups_db,
-                                    utils.extraDirPath(setupFlavor, product.name, product.version))
-                                    
-            if os.path.exists(extraDir):
-                self.setEnv(utils.dirExtraEnvNameFor(product.name), extraDir)
-            #
-            # Remember that we've set this up in case we want to keep it later
-            #
-            self.alreadySetupProducts[product.name] = (product, vroReason)
+            if self._setupPlan is not None:
+                planIndex = self._setupPlan.addProduct(product, setupFlavor, vroReason, 
+                                                       recursionDepth)
+                if localProduct:
+                    self._setupPlan.cacheable = False
         elif fwd:
             assert not setupToplevel
         else:
@@ -2067,15 +2359,22 @@ The what argument tells us what sort of state is expected (allowed values are de
             self.unsetEnv(self._envarDirName(product.name))
             self.unsetEnv(self._envarSetupName(product.name))
             self.unsetEnv(utils.dirExtraEnvNameFor(product.name))
+            self.unsetEnv(self._envarUnsetupName(product.name))
         #
-        # Process table file
+        # Process table file, recording what we do so that it can be undone
         #
+        if fwd and setupToplevel and hooks.config.Eups.recordUnsetup:
+            unsetupRecord = UnsetupRecord()
         for a in actions:
             if localProduct:    # we'll set e.g. PATH from localProduct
                 if a.cmd not in (Action.setupOptional,   Action.setupRequired,
                                  Action.unsetupOptional, Action.unsetupRequired):
                     continue
 
+            if fwd and self._setupPlan is not None:
+                self._setupPlan.addAction(planIndex, a, recursionDepth)
+            if fwd and unsetupRecord is not None:
+                unsetupRecord.addAction(a)
             a.execute(self, recursionDepth + 1, fwd, noRecursion=noRecursion, tableProduct=product,
                       implicitProduct=implicitProduct)
         #
@@ -2092,8 +2391,13 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if a.cmd in (Action.setupOptional, Action.setupRequired):
                     continue
 
+                if unsetupRecord is not None:
+                    unsetupRecord.addAction(a)
                 a.execute(self, 0, fwd=True, noRecursion=noRecursion)
 
+        if fwd and unsetupRecord is not None:
+            self.setEnv(self._envarUnsetupName(product.name), str(unsetupRecord))
+
         if recursionDepth == 0:            # we can cleanup
             if fwd:
                 del self._msgs["setup"]
@@ -2105,6 +2409,149 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return True, product.version, None
 
+    def _setupProductEnv(self, product, setupFlavor, vroReason, localProduct=None, productRoot=None,
+                         tablefile=None, noRecursion=False):
+        # set the environment variables that record that a product is setup,
+        # unsetting up any other version of it first
+        q = utils.Quiet(self)
+        self.unsetupSetupProduct(product, noRecursion=noRecursion)
+        del q
+        self.unsetEnv(self._envarUnsetupName(product.name)) # it's rewritten once the table's been processed
+
+        if localProduct:
+            version = localProduct.version
+        else:
+            version = product.version
+
+        setup_product_str = "%s %s -f %s -Z %s" % (
+            product.name, version, setupFlavor, utils.encodePath(product.stackRoot()))
+        if tablefile:
+            setup_product_str += " -m %s" % (tablefile)
+
+        if not productRoot:
+            productRoot = product.dir
+        self.setEnv(self._envarDirName(product.name), productRoot)
+        self.setEnv(self._envarSetupName(product.name), setup_product_str)
+
+        extraDir = os.path.join(product.stackRoot(), Eups.ups_db,
+                                utils.extraDirPath(setupFlavor, product.name, product.version))
+                                
+        if os.path.exists(extraDir):
+            self.setEnv(utils.dirExtraEnvNameFor(product.name), extraDir)
+        #
+        # Remember that we've set this up in case we want to keep it later
+        #
+        self.alreadySetupProducts[product.name] = (product, vroReason)
+
+    def _setupPlanKey(self, productName, versionName, setupToplevel, noRecursion, productRoot,
+                      tablefile, versionExpr, optional, implicitProduct):
+        # return the key identifying a setup in the SetupPlanCache:  everything that the way that
+        # the setup is resolved depends on.  None is returned if the setup shouldn't be cached.
+        if not hooks.config.Eups.cacheSetupPlans or hooks.config.Eups.paranoidCacheCheck or \
+               not self.userDataDir:
+            return None
+        if productRoot or tablefile or self.root or self.locallyCurrent or \
+               isinstance(productName, Product) or \
+               (isinstance(versionName, str) and versionName.startswith(Product.LocalVersionPrefix)):
+            return None
+
+        # the state of the databases; their generations change whenever a product is
+        # declared or undeclared, or a tag is assigned.  A database without a generation
+        # may only be relied upon if it is empty (like a new user data directory).
+        generations = self.getDatabaseGenerations()
+        for p, generation, userGeneration in generations:
+            if generation is None:
+                if p not in self._unversionedDbs:
+                    self._unversionedDbs[p] = bool(Database(self.getUpsDB(p)).findProductNames())
+                if self._unversionedDbs[p]:
+                    return None
+
+        # the products that are already setup
+        prefix = utils.setupEnvPrefix()
+        setup = sorted([(k, v) for k, v in os.environ.items() if k.startswith(prefix)])
+
+        return (productName, str(versionName), versionExpr, setupToplevel, noRecursion, optional,
+                implicitProduct, self.flavor, tuple(generations), tuple(setup),
+                tuple([str(t) for t in self.getPreferredTags()]), tuple(self.setupType),
+                self.keep, self.force, self.ignore_versions, self.exact_version, self.max_depth,
+                repr(sorted(hooks.config.Eups.defaultProduct.items())))
+
+    def getDatabaseGenerations(self):
+        """
+        return the generations (see Database.getGeneration()) of the databases on the path, as a
+        list of (eupsPathDir, generation, userGeneration) tuples, where userGeneration is that
+        of the user's tag area for the stack (or None if there isn't one).  The generations
+        change whenever a product is declared or undeclared, or a tag is assigned.
+        """
+        generations = []
+        for p in self.path:
+            db = Database(self.getUpsDB(p))
+            userCacheDir = self._userStackCache(p)
+            if userCacheDir:
+                generations.append((p, db.getGeneration(), db.getGeneration(userCacheDir)))
+            else:
+                generations.append((p, db.getGeneration(), None))
+
+        return generations
+
+    def _getSetupPlanCache(self):
+        # return the SetupPlanCache, kept in the user data directory
+        if self._setupPlans is None:
+            cacheDir = os.path.join(self.userDataDir, "_caches_")
+            if not os.path.isdir(cacheDir):
+                try:
+                    os.makedirs(cacheDir)
+                except OSError:
+                    pass
+            self._setupPlans = SetupPlanCache(os.path.join(cacheDir, "setupPlans.pickle"))
+        return self._setupPlans
+
+    def _replaySetupPlan(self, plan, noRecursion=False):
+        # setup the products recorded in a SetupPlan, just as setup() did when it was recorded
+        q = utils.Quiet(self)
+        self.alreadySetupProducts = {}
+        for p in self.getSetupProducts():
+            self.alreadySetupProducts[p.name] = (p, None)
+        del q
+
+        products = {}                   # the products setup, by step
+        unsetupRecords = {}             # the records of how to unsetup them, by step
+        for i, step in enumerate(plan.steps):
+            recursionDepth = step[1]
+            if step[0] == "product":
+                product = plan.getProduct(step)
+                setupFlavor, vroReason = step[8:10]
+                if self.verbose:
+                    indent = "| " * (recursionDepth//2)
+                    if recursionDepth%2 == 1:
+                        indent += "|"
+                    print("Setting up: %-30s  Flavor: %-10s Version: %s" % \
+                        (indent + product.name, setupFlavor, product.version), file=sys.stderr)
+
+                self._setupProductEnv(product, setupFlavor, vroReason, noRecursion=noRecursion)
+                products[i] = product
+                if hooks.config.Eups.recordUnsetup:
+                    unsetupRecords[i] = UnsetupRecord()
+            else:
+                product = products[step[2]]
+                action = plan.getAction(step, product)
+                if step[2] in unsetupRecords:
+                    unsetupRecords[step[2]].addAction(action)
+                if action.cmd in (Action.setupRequired, Action.setupOptional):
+                    continue            # the products that it set up are steps of their own
+
+                action.execute(self, recursionDepth + 1, True, noRecursion=noRecursion, tableProduct=product)
+
+        for i in sorted(unsetupRecords.keys()):
+            self.setEnv(self._envarUnsetupName(products[i].name), str(unsetupRecords[i]))
+        #
+        # we made a copy of os.environ so the usual magic putenv doesn't happen
+        #
+        for key, val in os.environ.items():
+            os.putenv(key, val)         
+
+        return True, plan.version, None
+
     def unsetup(self, productName, versionName=None, recursionDepth=0, noRecursion=False, optional=False):
         """Unsetup a product"""
 
@@ -2895,6 +3342,10 @@ The what argument tells us what sort of state is expected (allowed values are de
         if not isinstance(eupsPathDirs, list):
             eupsPathDirs = [eupsPathDirs]
 
+        # read any stacks we need that haven't been read yet
+        self.versions.loadAll([d for d in eupsPathDirs if d in self.versions],
+                              nthread=hooks.config.Eups.cacheLoadThreads)
+
         # start by iterating through each stack path
         for d in eupsPathDirs:
             if d not in self.versions:
@@ -2928,10 +3379,10 @@ The what argument tells us what sort of state is expected (allowed values are de
                     vers = stack.getVersions(pname, flavor)
                     if version:
                         if self.isLegalRelativeVersion(version): # version is actually an expression
-                            vers = [v for v in vers if self.version_match(v, version)]
+                            vers = self.versions_match(vers, version)
                         else:
                             vers = list(fnmatch.filter(vers, version))
-                    vers.sort(**cmp_or_key(self.version_cmp))
+                    vers.sort(key=versionSortKey(self.version_cmp, vers))
 
                     # only include latest if it passes the version constraint
                     if latest is not None and latest.version not in vers:
@@ -2981,7 +3432,8 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if version:
             if self.isLegalRelativeVersion(version): 
-                out = [p for p in out if self.version_match(p.version, version)]
+                matched = set(self.versions_match([p.version for p in out], version))
+                out = [p for p in out if p.version in matched]
             else:
                 out = [p for p in out if fnmatch.fnmatch(p.version, version)] 
 
@@ -3589,16 +4041,16 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if isinstance(vro, dict):
             if dbz in vro:
-                self._vro = vro[dbz]
+                self._vro = vro[dbz][:]
             elif "default" in vro:
-                self._vro = vro["default"]
+                self._vro = vro["default"][:]
                 if versionName:
                     self._vro[0:0] = ["commandLine"]
             else:
                 raise RuntimeError("Unable to find entry for %s in VRO dictionary for tag %s" %
                                      (dbz, vroTag))
         else:
-            self._vro = vro
+            self._vro = vro[:]
 
         if self.keep:
             self._vro[0:0] = ["keep"]
@@ -3770,6 +4222,176 @@ such sequences can be generated while rewriting the VRO"""
 
 _ClassEups = Eups                       # so we can say, "isinstance(Eups, _ClassEups)"
 
+class _VersionMatcher(object):
+    """
+    A logical expression such as ">= 12.0 && < 13", as understood by Eups.version_match(), split
+    into its terms once so that it can be matched against many versions
+    """
+
+    _relops = {"<" : operator.lt, "<=" : operator.le, "==" : operator.eq,
+               ">" : operator.gt, ">=" : operator.ge}
+
+    def __init__(self, eups, expr):
+        self.eups = eups
+        self.expr = expr
+        #
+        # The steps are ("term", relop, version), ("or",), ("and",), ("unexpected", token), or
+        # ("missing",) if the expression ends with a relop
+        #
+        self.steps = []
+
+        tokens = [x for x in re.split(r"\s*(%s|\|\||\s)\s*" % eups._relop_re.pattern, expr) if not re.search(r"^\s*$", x)]
+        i = -1
+        while i < len(tokens) - 1:
+            i += 1
+
+            if eups._relop_re.search(tokens[i]):
+                relop = tokens[i]; i += 1
+                if i == len(tokens):
+                    self.steps.append(("missing",))
+                    break
+                self.steps.append(("term", relop, tokens[i]))
+            elif re.search(r"^[-+.:/\w]+$", tokens[i]) and tokens[i] not in ("and", "or"):
+                self.steps.append(("term", "==", tokens[i]))
+            elif tokens[i] == "||" or tokens[i] == "or":
+                self.steps.append(("or",))
+            elif tokens[i] == "&&" or tokens[i] == "and":
+                self.steps.append(("and",))
+            else:
+                self.steps.append(("unexpected", tokens[i]))
+                break
+
+    def match(self, vname, test=None):
+        """
+        Return vname if it matches the expression.  Terms are evaluated by test(relop, vname, v),
+        by default Eups.version_match_prim
+        """
+        if test is None:
+            test = self.eups.version_match_prim
+
+        logop = None                    # the next logical operation to process
+        value = None                    # the value of the current term (e.g. ">= 2.0.0")
+        for step in self.steps:
+            what = step[0]
+            if what == "term":
+                relop, v = step[1], step[2]
+            elif what == "or":
+                logop = "or"
+                continue
+            elif what == "and":
+                if not value:
+                    return False        # short circuit
+                
+                logop = "and"
+                continue
+            elif what == "unexpected":
+                print("Unexpected operator %s in \"%s\"" % (step[1], self.expr), file=utils.stdwarn)
+                break
+            else:
+                raise IndexError("Expected a version after the last operator in \"%s\"" % self.expr)
+
+            if not logop and value is not None:
+                print("Expected logical operator || or && in \"%s\" at %s" % (self.expr, v), file=utils.stdwarn)
+            else:
+                try:
+                    rhs = test(relop, vname, v)
+                    if not logop:
+                        value = rhs
+                    elif logop == "and":
+                        if value and rhs:
+                            value = True
+                        else:
+                            value = False
+                    elif logop == "or":
+                        if value or rhs:
+                            return vname
+
+                        value = False
+                except ValueError:           # no sort order is defined
+                    return None
+
+        if value:
+            return vname
+        else:
+            return None
+
+    def filter(self, vnames, index=None):
+        """
+        Return the versions in the list vnames that match the expression, in the same order.  If
+        index is a VersionIndex of vnames sorted by Eups.version_cmp, it's searched by bisection
+        """
+        if not self._isRange():
+            return [v for v in vnames if self.match(v)]
+        #
+        # Find where the version in each term would go in the sorted versions by bisection.  The
+        # expression has the same value for all the versions between two such boundaries
+        #
+        bounds = None                   # the range of versions equal to each term's version
+        if index is not None:
+            versions, bounds = index.versions, {}
+            for relop, v in self._terms():
+                bounds[v] = index.bisect(self.eups.version_cmp, v)
+                if bounds[v] is None:
+                    bounds = None
+                    break
+
+        if bounds is None:
+            key = self.eups.version_cmp.rangeKey(list(vnames) + [v for relop, v in self._terms()])
+            if key is None:
+                return [v for v in vnames if self.match(v)]
+
+            versions = sorted(set(vnames), key=key)
+            keys = [key(v) for v in versions]
+            bounds = {}
+            for relop, v in self._terms():
+                bounds[v] = bisect.bisect_left(keys, key(v)), bisect.bisect_right(keys, key(v))
+
+        cuts = set([0, len(versions)])
+        for lohi in bounds.values():
+            cuts.update(lohi)
+
+        def testAt(pos):
+            # test each term for the versions at position pos of the index
+            def test(relop, vname, v):
+                lo, hi = bounds[v]
+                if pos < lo:
+                    return self._relops[relop](-1, 0)
+                elif pos < hi:
+                    return self._relops[relop](0, 0)
+                else:
+                    return self._relops[relop](1, 0)
+            return test
+
+        matched = set()
+        cuts = sorted(cuts)
+        for start, end in zip(cuts[:-1], cuts[1:]):
+            if self.match(versions[start], testAt(start)):
+                matched.update(versions[start:end])
+
+        return [v for v in vnames if v in matched]
+
+    def _terms(self):
+        # return the (relop, version) of each term
+        return [(step[1], step[2]) for step in self.steps if step[0] == "term"]
+
+    def _isRange(self):
+        """
+        Return True if the terms may be evaluated by searching sorted versions (provided that
+        they can be sorted by key;  see VersionCompare.rangeKey())
+        """
+        eups = self.eups
+        if type(eups).version_match_prim != _ClassEups.version_match_prim or \
+           not isinstance(eups.version_cmp, VersionCompare):
+            return False
+        #
+        # Only handle well-formed expressions, term [logop term]..., so as to print no warnings
+        #
+        steps = [step[0] for step in self.steps]
+        if not steps or steps[0::2] != ["term"]*len(steps[0::2]) or steps[-1] != "term" or \
+           [what for what in steps[1::2] if what not in ("or", "and")]:
+            return False
+
+        return not [relop for relop, v in self._terms() if relop not in self._relops]
 
 class _TagSet(object):
     def __init__(self, eups, tags):
@@ -0,0 +1,144 @@
+"""
+path-like environment variables (PATH, LD_LIBRARY_PATH, ...) being changed
+by a setup.
+
+The envPrepend and envAppend table actions add (or, on unsetup, remove)
+elements of a delimited path, removing duplicates.  Done on strings this is
+quadratic in the length of the path, and a deep setup does it hundreds of
+times.  An OrderedPath holds the elements of a path as an ordered set, so
+that each change is cheap;  while Eups.setup() is running the paths it
+changes are kept in a PathVariables and only written to os.environ when the
+setup is done (or when something needs to read the environment).
+"""
+from __future__ import absolute_import
+
+class OrderedPath(object):
+    """
+    the elements of a delimited path, without duplicates, in order
+    """
+
+    def __init__(self, value="", delim=":"):
+        """
+        @param value    the path, as a string.  Empty elements are dropped,
+                          as are all but the first copy of repeated elements
+        @param delim    the delimiter between elements
+        """
+        self.delim = delim
+
+        # if True, the path should start (or end) with a delimiter
+        self.leadingDelim = False
+        self.trailingDelim = False
+
+        # the elements, each with a number giving its place in the path
+        self._places = {}
+        self._first, self._last = 0, -1
+
+        for el in value.split(delim):
+            if el:
+                self.append(el)
+
+    def prepend(self, el):
+        """
+        put an element at the start of the path, moving it there if it's
+        already present
+        """
+        self._first -= 1
+        self._places[el] = self._first
+
+    def append(self, el):
+        """
+        put an element at the end of the path, unless it's already present
+        """
+        if el not in self._places:
+            self._last += 1
+            self._places[el] = self._last
+
+    def remove(self, el):
+        """
+        remove an element from the path, if present
+        """
+        self._places.pop(el, None)
+
+    def elements(self):
+        """
+        return the path's elements, in order
+        """
+        return sorted(self._places, key=self._places.get)
+
+    def __contains__(self, el):
+        return el in self._places
+
+    def __len__(self):
+        return len(self._places)
+
+    def __str__(self):
+        path = self.delim.join(self.elements())
+        if self.leadingDelim and not path.startswith(self.delim):
+            path = self.delim + path
+        if self.trailingDelim and not path.endswith(self.delim):
+            path += self.delim
+        return path
+
+    def copy(self):
+        """
+        return a copy of the path, which may be changed independently
+        """
+        path = OrderedPath("", self.delim)
+        path.leadingDelim, path.trailingDelim = self.leadingDelim, self.trailingDelim
+        path._places = self._places.copy()
+        path._first, path._last = self._first, self._last
+        return path
+
+class PathVariables(object):
+    """
+    the OrderedPaths for the environment variables changed by a setup, not
+    all of which have been written to the environment
+    """
+
+    def __init__(self):
+        self._paths = {}                # the OrderedPaths, by variable
+        self._unwritten = set()         # the variables not yet written to the environment
+
+    def get(self, key):
+        """
+        return the OrderedPath for a variable, or None if it isn't known
+        """
+        return self._paths.get(key)
+
+    def set(self, key, path):
+        """
+        set the value of a variable, to be written to the environment later
+        """
+        self._paths[key] = path
+        self._unwritten.add(key)
+
+    def discard(self, key):
+        """
+        forget about a variable (e.g. because it's been set some other way)
+        """
+        self._paths.pop(key, None)
+        self._unwritten.discard(key)
+
+    def isWritten(self):
+        """
+        return True if all the variables have been written to the environment
+        """
+        return not self._unwritten
+
+    def flush(self):
+        """
+        return a list of the (variable, value) pairs that haven't been
+        written to the environment, which the caller should now write
+        """
+        out = [(key, str(self._paths[key])) for key in sorted(self._unwritten)]
+        self._unwritten = set()
+        return out
+
+    def copy(self):
+        """
+        return a copy, which may be changed independently
+        """
+        paths = PathVariables()
+        paths._paths = dict([(key, path.copy()) for key, path in self._paths.items()])
+        paths._unwritten = set(self._unwritten)
+        return paths
@@ -56,6 +56,12 @@ class Product(object):
 
     LocalVersionPrefix = "LOCAL:"
 
+    # Products are created in large numbers (one for every version looked
+    # up in a ProductStack), so they are kept compact by doing without a 
+    # per-instance __dict__.
+    __slots__ = ("name", "version", "ups_dir", "dir", "tablefile", "_table",
+                 "tags", "db", "flavor", "_prodStack")
+
     def __init__(self, name, version, flavor=None, dir=None, table=None, 
                  tags=None, db=None, noInit=None, ups_dir=None):
         if (name and not isinstance(name, str)) or isinstance(dir,bool) or noInit is not None:
@@ -97,6 +103,23 @@ class Product(object):
         # product.  
         self._prodStack = None
 
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k)])
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (__dict__, slots) as pickled by default for a class with slots
+            dictState, slotState = state
+            state = dict(dictState or {})
+            state.update(slotState or {})
+
+        # Products pickled by older versions (e.g. as the topProduct of a
+        # cached Table) may lack some attributes
+        for k in self.__slots__:
+            setattr(self, k, state.get(k))
+        if self.tags is None:
+            self.tags = []
+
     def __hash__(self):                 # needed for set operations (such as toplogicalSort)
         return (hash(self.name) ^
                 hash(self.version) ^
@@ -373,7 +396,7 @@ class Product(object):
                 return clone.tablefile
         return self.tablefile
 
-    def getTable(self, addDefaultProduct=None, quiet=False, verbose=0):
+    def getTable(self, addDefaultProduct=None, quiet=False, verbose=0, contents=None):
         """
         return an in-memory instance of the product table.  This will be
         loaded from the path returned by tableFileName() (and cached for 
@@ -382,6 +405,8 @@ class Product(object):
         table file cannot be loaded:  if it cannot be found, a 
         TableFileNotFound is raised; if it contains unparsable errors, a 
         BadTableContent is raised.  
+        @param contents   the lines of the table file, if they have already 
+                            been read (see Eups.prefetchTables())
         """
         if quiet:
             verbose -= 2
@@ -394,9 +419,22 @@ class Product(object):
             if not os.path.exists(tablepath):
                 raise TableFileNotFound(tablepath, self.name, self.version,
                                         self.flavor)
-            self._table = mod_table.Table(tablepath, self,
-                                          addDefaultProduct=addDefaultProduct, verbose=verbose,
-                                          ).expandEupsVariables(self, quiet)
+            # use the parsed table cached alongside the product stack if the
+            # table file hasn't changed since
+            tableCache = None
+            if self._prodStack and self.flavor:
+                tableCache = self._prodStack.getTableCache()
+
+            table = None
+            if tableCache is not None:
+                table = tableCache.getTable(tablepath, self, addDefaultProduct)
+            if table is None:
+                table = mod_table.Table(tablepath, self, addDefaultProduct=addDefaultProduct,
+                                        verbose=verbose, contents=contents)
+                if tableCache is not None:
+                    tableCache.addTable(table, self, addDefaultProduct)
+
+            self._table = table.expandEupsVariables(self, quiet)
 
             if self._prodStack and self.name and self.version and self.flavor:
                 # pass the loaded table back to the cache
@@ -408,6 +446,22 @@ class Product(object):
                                         
         return self._table
 
+    def isTableCached(self, addDefaultProduct=None):
+        """
+        return True if getTable() wouldn't need to read the table file, as
+        it has already been loaded or is in the stack's cache of parsed tables
+        """
+        if self._table:
+            return True
+
+        tablepath = self.tableFileName()
+        if tablepath is None or not self._prodStack or not self.flavor:
+            return False
+
+        tableCache = self._prodStack.getTableCache()
+        return tableCache is not None and \
+               tableCache.hasTable(tablepath, self, addDefaultProduct)
+
     def getConfig(self, section="DEFAULT", option=None, getType=None):
         """Return the product's ConfigParser, which will be empty if the file doesn't exist"""
         
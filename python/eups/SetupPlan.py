@@ -0,0 +1,225 @@
+"""
+a persistent cache of resolved setups.
+
+Setting up a large product means finding every dependency on the VRO and
+reading its table file, even if nothing has changed since the same setup
+was last done.  A SetupPlan records what a setup actually did:  the products
+that were set up, in order, and the (non-recursive) table actions executed
+for each.  Eups.setup() can then replay the plan rather than resolving the
+setup again.  Plans are kept in a SetupPlanCache, keyed by everything that
+the resolution depends on (see Eups._setupPlanKey()), including the
+generations of the databases involved; a plan also records the table files
+that it was made from and is discarded if any of them has changed.
+"""
+from __future__ import absolute_import
+import os
+import sys
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from . import utils
+from .Product import Product
+from .table import Action
+
+# the version of the layout of the cache file.  Cache files with another
+# version are ignored (and eventually overwritten).  So are those written
+# by another major version of python, as python 2 would read the strings
+# of python 3 as unicode.
+formatVersion = 2
+
+class SetupPlan(object):
+    """
+    the products set up by a setup command and the table actions executed
+    for them, in the order that they were done.
+    """
+
+    def __init__(self):
+        # the steps of the setup.  Each is either
+        #   ("product", recursionDepth, name, version, flavor, dir, tablefile,
+        #    db, setupFlavor, vroReason)
+        # for a product being set up, or
+        #   ("action", recursionDepth, productIndex, tableFile, cmd, args, extra)
+        # for an action executed from the table of the product set up by
+        # the productIndex-th step.
+        self.steps = []
+
+        # the table files read, as (path, mtime, size) tuples
+        self.tables = []
+
+        # the version of the top-level product that was set up
+        self.version = None
+
+        # False if the setup did something that the plan cannot capture
+        self.cacheable = True
+
+    def addProduct(self, product, setupFlavor, vroReason, recursionDepth):
+        """
+        record that a product has been set up, returning the index of the
+        step to pass to addAction() for the product's table actions.
+        """
+        if vroReason:
+            vroReason = [str(r) for r in vroReason]
+        self.steps.append(("product", recursionDepth, product.name, product.version,
+                           product.flavor, product.dir, product.tablefile, product.db,
+                           setupFlavor, vroReason))
+        if recursionDepth == 0:
+            self.version = product.version
+
+        tablefile = product.tableFileName()
+        if tablefile and utils.isRealFilename(tablefile):
+            try:
+                st = os.stat(tablefile)
+                self.tables.append((tablefile, st.st_mtime, st.st_size))
+            except OSError:
+                self.cacheable = False
+
+        return len(self.steps) - 1
+
+    def addAction(self, productIndex, action, recursionDepth):
+        """
+        record that an action from a product's table has been executed.
+        Actions that set up other products are recorded, but not replayed,
+        as the setup of those products is recorded in its own right.
+        """
+        if action.cmd in (Action.setupRequired, Action.setupOptional):
+            if [a for a in action.args if "${" in str(a)]:
+                self.cacheable = False  # the product chosen depends on the environment
+            if productIndex is None:
+                return
+        if action.cmd in (Action.unsetupRequired, Action.unsetupOptional) or \
+           productIndex is None:
+            self.cacheable = False
+            return
+
+        self.steps.append(("action", recursionDepth, productIndex, action.tableFile,
+                           action.cmd, list(action.args), dict(action.extra)))
+
+    def isValid(self):
+        """
+        return True if none of the table files that the plan was made from
+        has changed.
+        """
+        for tablefile, mtime, size in self.tables:
+            try:
+                st = os.stat(tablefile)
+            except OSError:
+                return False
+            if st.st_mtime != mtime or st.st_size != size:
+                return False
+        return True
+
+    def getProduct(self, step):
+        """
+        return the Product set up by a "product" step
+        """
+        name, version, flavor, dir, tablefile, db = step[2:8]
+        return Product(name, version, flavor, dir, tablefile, db=db)
+
+    def getAction(self, step, topProduct=None):
+        """
+        return the Action executed by an "action" step
+        """
+        tableFile, cmd, args, extra = step[3:]
+        action = Action(tableFile, cmd, [], dict(extra), topProduct=topProduct)
+        action.args = list(args)
+        return action
+
+class SetupPlanCache(object):
+    """
+    a lookup of SetupPlans backed by a file.  The file is read when a plan
+    is first looked up, and written by save().  Only the most recently
+    added plans are kept.
+    """
+
+    def __init__(self, file, maxPlans=20):
+        """
+        @param file      the path to the cache file.  It need not exist yet.
+        @param maxPlans  the number of plans to keep
+        """
+        self.file = file
+        self.maxPlans = maxPlans
+
+        # the cached plans:  (time added, plan) tuples keyed by the setup
+        # they resolve.  None until the file is first read.
+        self._plans = None
+        self._updated = False
+
+    def _load(self):
+        if self._plans is not None:
+            return
+        self._plans = {}
+
+        try:
+            fd = open(self.file, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                data = pickle.load(fd)
+            except Exception:
+                # a corrupted or incompatible cache is simply rebuilt
+                return
+        finally:
+            fd.close()
+
+        if isinstance(data, dict) and data.get("version") == formatVersion \
+           and data.get("python") == sys.version_info[0]:
+            self._plans = data["plans"]
+
+    def get(self, key):
+        """
+        return the plan for a setup, or None if there is no valid plan
+        """
+        self._load()
+        entry = self._plans.get(key)
+        if entry is None:
+            return None
+        if not entry[1].isValid():
+            del self._plans[key]
+            self._updated = True
+            return None
+        return entry[1]
+
+    def add(self, key, plan):
+        """
+        add the plan for a setup, replacing any earlier plan for it
+        """
+        self._load()
+        self._plans[key] = (time.time(), plan)
+        if len(self._plans) > self.maxPlans:
+            oldest = sorted(self._plans.keys(), key=lambda k: self._plans[k][0])
+            for k in oldest[:len(self._plans) - self.maxPlans]:
+                del self._plans[k]
+        self._updated = True
+
+    def __len__(self):
+        self._load()
+        return len(self._plans)
+
+    def save(self):
+        """
+        write the cache to its file if it has changed.  Failure to write
+        the file is silently ignored.
+        """
+        if not self._updated:
+            return
+
+        try:
+            fd = utils.AtomicFile(self.file, "wb")
+            pickle.dump({"version": formatVersion, "python": sys.version_info[0],
+                         "plans": self._plans}, fd, protocol=2)
+            fd.close()
+        except (IOError, OSError):
+            return
+        self._updated = False
+
+    def clear(self):
+        """
+        forget all plans and remove the cache file
+        """
+        self._plans = {}
+        self._updated = False
+        if os.path.exists(self.file):
+            os.remove(self.file)
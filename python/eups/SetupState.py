@@ -0,0 +1,132 @@
+"""
+the products that the environment says are currently setup.
+
+Each setup product is recorded in a SETUP_<product> environment variable
+(see utils.setupEnvNameFor()).  Finding the Products that these describe
+means looking each of them up in its stack, which is slow when many
+products are setup, and Eups.getSetupProducts() is called several times by
+a single command.  A SetupState scans the environment once and remembers
+the Products found for its SETUP_ variables, forgetting a product only when
+one of the variables describing it is set or unset via Eups.setEnv() or
+Eups.unsetEnv().
+"""
+from __future__ import absolute_import
+import os
+from . import utils
+
+class SetupState(object):
+    """
+    the setup products found in the environment, by name, together with the
+    Products that they have been resolved to (see Eups.getSetupProducts()).
+    """
+
+    def __init__(self, environ=None):
+        """
+        @param environ   the environment to scan.  Default: os.environ
+        """
+        if environ is None:
+            environ = os.environ
+
+        # the products' names, keyed by their SETUP_ variables and kept in
+        # the order in which they were found
+        self._names = {}
+        self._order = []
+
+        # the names of the products, keyed by their _DIR variables
+        self._dirKeys = {}
+
+        # the (product, warning) pairs that the products have been resolved
+        # to, by name.  The product is None if it could not be found, in
+        # which case warning says why.
+        self._resolved = {}
+
+        prefix = utils.setupEnvPrefix()
+        for key, val in list(environ.items()):
+            if key.startswith(prefix) and key[len(prefix):]:
+                self._addKey(key, val)
+
+    def copy(self):
+        """
+        return a copy of the state, which may be changed independently
+        """
+        state = SetupState({})
+        state._names = self._names.copy()
+        state._order = self._order[:]
+        state._dirKeys = self._dirKeys.copy()
+        state._resolved = self._resolved.copy()
+        return state
+
+    def _addKey(self, key, val):
+        # record the product described by SETUP_ variable key, whose value is val
+        try:
+            name = val.split()[0]
+        except IndexError:              # Oh dear;  "$setupEnvPrefix()_productName" must be malformed
+            return
+
+        self._names[key] = name
+        self._order.append(key)
+        self._dirKeys[utils.dirEnvNameFor(name)] = name
+
+    def _forget(self, name):
+        # forget what a product was resolved to
+        self._resolved.pop(name, None)
+
+    def invalidate(self, key, environ=None):
+        """
+        note that an environment variable has just been set or unset,
+        forgetting any product that it describes.
+        @param environ   the environment that was changed.  Default: os.environ
+        """
+        if environ is None:
+            environ = os.environ
+
+        if key in self._dirKeys:
+            self._forget(self._dirKeys[key])
+
+        if not key.startswith(utils.setupEnvPrefix()):
+            return
+
+        if key in self._names:
+            name = self._names.pop(key)
+            self._order.remove(key)
+            self._forget(name)
+            if self._dirKeys.get(utils.dirEnvNameFor(name)) == name:
+                del self._dirKeys[utils.dirEnvNameFor(name)]
+
+        if key in environ:
+            self._addKey(key, environ[key])
+            if key in self._names:
+                self._forget(self._names[key])
+
+    def getNames(self, productName=None):
+        """
+        return the names of the setup products, in the order in which they
+        were found (or just productName, if it is setup)
+        """
+        names = [self._names[key] for key in self._order]
+        if productName:
+            names = [n for n in names if n == productName]
+        return names
+
+    def isResolved(self, productName):
+        """
+        return True if the product found in the environment has been resolved
+        """
+        return productName in self._resolved
+
+    def getResolved(self, productName):
+        """
+        return the (product, warning) pair that a product has been resolved
+        to (see setResolved())
+        @throws KeyError  if the product hasn't been resolved
+        """
+        return self._resolved[productName]
+
+    def setResolved(self, productName, product, warning=None):
+        """
+        record the Product that a setup product has been resolved to
+        @param product   the Product, or None if it could not be found
+        @param warning   the message to print when the product is
+                           requested, explaining why it could not be found
+        """
+        self._resolved[productName] = (product, warning)
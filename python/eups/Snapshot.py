@@ -0,0 +1,250 @@
+"""
+snapshots of the environment produced by a setup.
+
+The environment that a setup produces depends only on the products that it
+resolves to, so for a fixed release (e.g. one selected by a tag) it is the
+same every time the setup is done.  A Snapshot records the changes that a
+setup made to the environment and to the shell's aliases so that they can
+be applied again (see "eups snapshot" and "setup --from-snapshot") without
+resolving the setup or reading any table files.
+
+A snapshot records the generations of the databases on the path, the
+products that were already setup, and the table files that were read; it
+may only be applied while all of these are unchanged (see Snapshot.apply()).
+It also records how the product was asked for (its version and the tags
+used), so that the setup may be resolved in the usual way if it's stale.
+"""
+from __future__ import absolute_import
+import os
+import json
+from . import utils
+from .db import Database
+from .exceptions import EupsException, StaleSnapshot
+
+# the version of the layout of snapshot files.  Files with another version
+# are rejected.
+formatVersion = 2
+
+class Snapshot(object):
+    """
+    the changes made by a setup to the environment, and the state of the
+    databases that the setup was resolved against.
+    """
+
+    def __init__(self, productName, version, flavor, generations, setupEnv):
+        """
+        @param productName   the name of the product that was setup
+        @param version       the version of the product that was setup
+        @param flavor        the flavor that the setup was resolved for
+        @param generations   the generations of the databases on the path,
+                               as returned by Eups.getDatabaseGenerations()
+        @param setupEnv      the SETUP_* variables present before the setup,
+                               i.e. the products that were already setup
+        """
+        self.productName = productName
+        self.version = version
+        self.flavor = flavor
+        self.generations = [list(g) for g in generations]
+        self.setupEnv = dict(setupEnv)
+
+        # the environment variables changed by the setup:  (old, new) value
+        # pairs, where None means that the variable is not set
+        self.environ = {}
+
+        # the aliases set by the setup (or None for those that were unset)
+        self.aliases = {}
+
+        # the table files read, as (path, mtime, size) lists
+        self.tables = []
+
+        # the version that was asked for (None if it was chosen by the VRO),
+        # and the tags given to select the VRO (see Eups.selectVRO())
+        self.versionName = None
+        self.tags = []
+        self.postTags = []
+
+    def fromSetup(eupsenv, productName, version, environ0):
+        """
+        return a Snapshot of a setup that has just been done
+        @param eupsenv      the Eups instance that did the setup
+        @param productName  the name of the product that was setup
+        @param version      the version that was setup
+        @param environ0     a copy of os.environ as it was before the setup
+        """
+        snap = Snapshot(productName, version, eupsenv.flavor,
+                        eupsenv.getDatabaseGenerations(), _getSetupEnv(environ0))
+
+        for key, val in os.environ.items():
+            if environ0.get(key) != val:
+                snap.environ[key] = (environ0.get(key), val)
+        for key in environ0.keys():
+            if key not in os.environ:
+                snap.environ[key] = (environ0[key], None)
+
+        for key, val in eupsenv.aliases.items():
+            if eupsenv.oldAliases.get(key) != val:
+                snap.aliases[key] = val
+        for key in eupsenv.oldAliases.keys():
+            if key not in eupsenv.aliases:
+                snap.aliases[key] = None
+
+        for product, vroReason in eupsenv.alreadySetupProducts.values():
+            tablefile = product.tableFileName()
+            if tablefile and utils.isRealFilename(tablefile) and os.path.exists(tablefile):
+                st = os.stat(tablefile)
+                snap.tables.append([tablefile, st.st_mtime, st.st_size])
+
+        return snap
+
+    fromSetup = staticmethod(fromSetup)
+
+    def apply(self, eupsenv):
+        """
+        make the changes recorded in the snapshot to the environment (and to
+        eupsenv's aliases).  Variables that were changed by the setup but
+        have since been changed by something else are spliced if the setup
+        only added to them (as is the case for e.g. PATH).
+        @param eupsenv    the Eups instance to apply the snapshot for
+        @throws StaleSnapshot  if the snapshot may no longer be applied; the
+                                 environment is unchanged in this case
+        """
+        if self.flavor != eupsenv.flavor:
+            raise StaleSnapshot("it was made for flavor %s, not %s" % (self.flavor, eupsenv.flavor))
+
+        self.check()
+
+        if self.generations != [list(g) for g in eupsenv.getDatabaseGenerations()]:
+            raise StaleSnapshot("the products declared in %s have changed" %
+                                ":".join(eupsenv.path))
+
+        environ = {}
+        for key, (old, new) in self.environ.items():
+            current = os.environ.get(key)
+            if current == old:
+                environ[key] = new
+            elif old and new and old in new:
+                i = new.index(old)
+                environ[key] = new[:i] + (current or "") + new[i + len(old):]
+            elif old and new and _uniquePath(old) in new:
+                # a path from which the setup removed duplicates; so must we
+                old = _uniquePath(old)
+                i = new.index(old)
+                environ[key] = _uniquePath(new[:i] + (current or "") + new[i + len(old):])
+            else:
+                raise StaleSnapshot("$%s has changed" % key)
+
+        for key, val in environ.items():
+            if val is None:
+                eupsenv.unsetEnv(key)
+            else:
+                os.environ[key] = val
+
+        for key, val in self.aliases.items():
+            if val is None:
+                eupsenv.unsetAlias(key)
+            else:
+                eupsenv.setAlias(key, val)
+
+    def check(self):
+        """
+        raise StaleSnapshot if one of the databases that the snapshot was made
+        from, or one of the table files read, or the products that are setup
+        have changed.  This doesn't need an Eups instance, so it can be done
+        before one is built; apply() also checks the flavor and the path.
+
+        A database that has no generation recorded is only trusted if it is
+        empty, as for setup plans (see Eups.setup())
+        """
+        for p, generation, userGeneration in self.generations:
+            dbpath = os.path.join(p, "ups_db")
+            if not os.path.isdir(dbpath):
+                raise StaleSnapshot("%s no longer exists" % dbpath)
+            db = Database(dbpath)
+            if generation is None:
+                if db.findProductNames():
+                    raise StaleSnapshot("%s has no record of its updates" % dbpath)
+            elif db.getGeneration() != generation:
+                raise StaleSnapshot("the products declared in %s have changed" % p)
+
+        for tablefile, mtime, size in self.tables:
+            try:
+                st = os.stat(tablefile)
+            except OSError:
+                raise StaleSnapshot("%s no longer exists" % tablefile)
+            if st.st_mtime != mtime or st.st_size != size:
+                raise StaleSnapshot("%s has changed" % tablefile)
+
+        if self.setupEnv != _getSetupEnv(os.environ):
+            raise StaleSnapshot("the products that are setup have changed")
+
+    def write(self, file):
+        """
+        write the snapshot to a file
+        @param file   the name of the file, or a file object
+        """
+        data = { "version" : formatVersion,
+                 "product" : self.productName,
+                 "productVersion" : self.version,
+                 "versionName" : self.versionName,
+                 "tags" : self.tags,
+                 "postTags" : self.postTags,
+                 "flavor" : self.flavor,
+                 "generations" : self.generations,
+                 "setupEnv" : self.setupEnv,
+                 "environ" : self.environ,
+                 "aliases" : self.aliases,
+                 "tables" : self.tables, }
+
+        if hasattr(file, "write"):
+            fd = file
+        else:
+            fd = open(file, "w")
+        try:
+            json.dump(data, fd, indent=1, sort_keys=True)
+            fd.write("\n")
+        finally:
+            if fd is not file:
+                fd.close()
+
+    def read(file):
+        """
+        return the Snapshot written to a file by write()
+        @param file   the name of the file
+        @throws EupsException  if the file is not a snapshot that this
+                                 version of eups can read
+        """
+        fd = open(file)
+        try:
+            try:
+                data = json.load(fd)
+            except ValueError:
+                raise EupsException("%s is not a snapshot file" % file)
+        finally:
+            fd.close()
+
+        if not isinstance(data, dict) or data.get("version") != formatVersion:
+            raise EupsException("%s was written by an incompatible version of eups" % file)
+        data = utils.nativeStrings(data) # json's strings are unicode in python 2
+
+        snap = Snapshot(data["product"], data["productVersion"], data["flavor"],
+                        data["generations"], data["setupEnv"])
+        for key, (old, new) in data["environ"].items():
+            snap.environ[key] = (old, new)
+        snap.aliases = dict(data["aliases"])
+        snap.tables = data["tables"]
+        snap.versionName = data["versionName"]
+        snap.tags = data["tags"]
+        snap.postTags = data["postTags"]
+
+        return snap
+
+    read = staticmethod(read)
+
+def _uniquePath(path):
+    # return a path without empty or repeated elements, as setup leaves it
+    return ":".join(utils.uniq([el for el in path.split(":") if el]))
+
+def _getSetupEnv(environ):
+    # return the variables that record which products are setup
+    prefix = utils.setupEnvPrefix()
+    return dict([(k, v) for k, v in environ.items() if k.startswith(prefix)])
@@ -0,0 +1,99 @@
+"""
+reading table files ahead of time.
+
+A setup discovers its dependencies one table file at a time, so on a slow
+(e.g. network) filesystem the time taken to read the table files adds up
+over the whole depth of the dependency tree.  As soon as a table file has
+been parsed, Eups.prefetchTables() guesses which products its setupRequired
+lines will resolve to and hands their table files to a TablePrefetcher,
+which reads them in a pool of threads; Product.getTable() is then given the
+contents that have already been read (see Eups.takePrefetchedTable()).
+A wrong guess only costs a wasted read, as the dependencies are still
+resolved as usual.
+"""
+from __future__ import absolute_import
+import os
+from . import utils
+
+def _readTable(path):
+    # read a table file, returning its (mtime, size, lines), or None if it can't be read
+    try:
+        fd = open(path)
+    except (IOError, OSError):
+        return None
+    try:
+        try:
+            st = os.fstat(fd.fileno())
+            return st.st_mtime, st.st_size, fd.readlines()
+        except (IOError, OSError):
+            return None
+    finally:
+        fd.close()
+
+class TablePrefetcher(object):
+    """
+    a pool of threads reading table files that will probably be needed soon
+    """
+
+    def __init__(self, nthread=4):
+        """
+        @param nthread   the number of threads to read table files with
+        """
+        self.nthread = nthread
+        self._pool = None               # started when first needed
+
+        # the results of reading the table files that haven't been taken yet, by path
+        self._pending = {}
+
+    def prefetch(self, paths):
+        """
+        start reading some table files, unless they're already being read
+        """
+        for path in paths:
+            if path in self._pending or not utils.isRealFilename(path):
+                continue
+
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool # slow to import
+                self._pool = ThreadPool(self.nthread)
+            self._pending[path] = self._pool.apply_async(_readTable, (path,))
+
+    def take(self, path):
+        """
+        return the lines of a table file that has been prefetched, waiting for it to be read if
+        needs be, and forget them.  None is returned if the file wasn't prefetched, couldn't be
+        read, or has changed since it was read.
+        """
+        result = self._pending.pop(path, None)
+        if result is None:
+            return None
+
+        result = result.get()
+        if result is None:
+            return None
+
+        mtime, size, lines = result
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_mtime != mtime or st.st_size != size:
+            return None
+
+        return lines
+
+    def clear(self):
+        """
+        forget all the table files that have been read but not taken
+        """
+        self._pending = {}
+
+    def close(self):
+        """
+        forget the table files read, and stop the threads
+        """
+        self.clear()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
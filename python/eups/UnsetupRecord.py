@@ -0,0 +1,130 @@
+"""
+a record of what setting up a product did, so that it can be undone.
+
+Unsetting up a product used to mean finding it in its stack and reading
+its table file again, running the actions backwards.  This is slow, and
+fails if the product has been undeclared (or its table file changed) since
+it was setup.  Instead, Eups.setup() records the actions that will need to
+be undone in an UnsetupRecord, which is kept in an environment variable
+alongside the product's SETUP_ variable (see utils.unsetupEnvNameFor());
+Eups.setup(fwd=False) replays it without touching the stacks.
+
+Only the actions that do anything when unsetting up are recorded, and
+only the arguments that they need.  The record is written as a string
+that is safe to pass to the shell unquoted.
+"""
+from __future__ import absolute_import
+import re
+from .table import Action
+
+class UnsetupRecord(object):
+    """
+    the table actions to run backwards to unsetup a product
+    """
+
+    # the actions that are recorded, with the number of their arguments needed to undo them
+    # (None: all of them), keyed by the codes used in the record's string form
+    _codes = {
+        "p" : (Action.envPrepend, 3),
+        "e" : (Action.envSet, 1),
+        "a" : (Action.addAlias, 1),
+        "r" : (Action.setupRequired, None),
+        "o" : (Action.setupRequired, None), # optional
+        }
+    _cmdCodes = {
+        Action.envPrepend : "p",
+        Action.envSet : "e",
+        Action.addAlias : "a",
+        Action.setupRequired : "r",
+        }
+
+    _unsafe_re = re.compile(r"[^A-Za-z0-9_./+@-]")
+
+    def __init__(self):
+        self._actions = []              # the recorded actions, as (code, args) pairs
+
+    def addAction(self, action):
+        """
+        record that an action has been executed.  Actions that needn't be undone are ignored
+        """
+        code = self._cmdCodes.get(action.cmd)
+        if code is None:
+            return
+
+        nargs = self._codes[code][1]
+        args = action.args
+        if nargs is not None:
+            args = args[:nargs]
+        if action.cmd == Action.setupRequired and action.extra.get("optional"):
+            code = "o"
+
+        self._actions.append((code, list(args)))
+
+    def __len__(self):
+        return len(self._actions)
+
+    def getActions(self, topProduct=None):
+        """
+        return the recorded actions, ready to be executed with fwd=False
+        """
+        actions = []
+        for code, args in self._actions:
+            cmd = self._codes[code][0]
+            if cmd == Action.envPrepend:
+                extra = {"append" : False}
+            elif cmd == Action.setupRequired:
+                extra = {"optional" : code == "o"}
+            else:
+                extra = {}
+            action = Action("(unsetup record)", cmd, [], extra, topProduct=topProduct)
+            action.args = list(args)
+            actions.append(action)
+
+        return actions
+
+    def __str__(self):
+        # each action is written as its code followed by its arguments, separated by commas, with
+        # the actions separated by colons.  Other characters that aren't safe are escaped as %XX
+        return ":".join([",".join([code] + [self._escape(a) for a in args])
+                         for code, args in self._actions])
+
+    def _escape(self, value):
+        return self._unsafe_re.sub(lambda mat : "".join(["%%%02X" % b for b in
+                                                         bytearray(mat.group(0).encode("utf-8"))]),
+                                   value)
+
+    def fromString(value):
+        """
+        return the UnsetupRecord written as value (see __str__()).  A ValueError is raised if
+        value is not a valid record
+        """
+        record = UnsetupRecord()
+        for entry in value.split(":"):
+            if not entry:
+                continue
+            fields = entry.split(",")
+            code = fields.pop(0)
+            if code not in UnsetupRecord._codes:
+                raise ValueError("Unknown action \"%s\" in unsetup record" % code)
+            record._actions.append((code, [_unescape(f) for f in fields]))
+
+        return record
+
+    fromString = staticmethod(fromString)
+
+def _unescape(value):
+    # undo UnsetupRecord._escape()
+    if "%" not in value:
+        return value
+
+    out = bytearray()
+    i = 0
+    while i < len(value):
+        if value[i] == "%":
+            out.append(int(value[i + 1:i + 3], 16))
+            i += 3
+        else:
+            out.extend(value[i].encode("utf-8"))
+            i += 1
+
+    return out.decode("utf-8")
@@ -1,3 +1,5 @@
+import bisect
+import functools
 import re
 
 from .utils import cmp
@@ -16,6 +18,9 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
         return self.stdCompare(v1, v2, mustReturnInt=mustReturnInt)
 
     def stdCompare(self, v1, v2, suffix=True, mustReturnInt=True):
+        if suffix and self._isStandard():
+            return self._compareParsed(_parse(self, v1), _parse(self, v2), mustReturnInt, v1, v2)
+
         prim1, sec1, ter1 = self._splitVersion(v1)
         prim2, sec2, ter2 = self._splitVersion(v2)
 
@@ -145,3 +150,410 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
         """
         return self.compare(v1, v2, mustReturnInt)
 
+    def _isStandard(self, sorting=False):
+        """
+        return True if versions are compared by this class's stdCompare(), so that they may be
+        parsed once (see _parse()).  If sorting, sortKey() must also not have been overridden
+        """
+        cls = type(self)
+        if cls.stdCompare != VersionCompare.stdCompare or \
+           cls._splitVersion != VersionCompare._splitVersion:
+            return False
+        if sorting:
+            return cls.compare == VersionCompare.compare and cls.__call__ == VersionCompare.__call__
+        return True
+
+    def _compareParsed(self, p1, p2, mustReturnInt, v1, v2):
+        """
+        stdCompare() the versions v1 and v2, which have been parsed into p1 and p2.  This is the
+        same algorithm, without the need to split the versions again
+        """
+        if p1.prim == p2.prim:
+            sec1, ter1, sec2, ter2 = p1.sec, p1.ter, p2.sec, p2.ter
+            # the same primary release component 
+            if sec1 or sec2 or ter1 or ter2:
+                if sec1 or sec2:
+                    if (sec1 and sec2):
+                        ret = self.stdCompare(sec1, sec2, True)
+                    else:
+                        if sec1:
+                            return -1
+                        else:
+                            return 1
+
+                    if ret == 0:
+                        return self.stdCompare(ter1, ter2, True)
+                    else:
+                        return ret
+
+                return self.stdCompare(ter1, ter2, True)
+            else:
+                return 0
+
+        c1, c2 = p1.components, p2.components
+        n1 = len(c1); n2 = len(c2)
+        if n1 < n2:
+            n = n1
+        else:
+            n = n2
+
+        for i in range(n):
+            c1i, c2i = c1[i], c2[i]
+            c12AreIntegral = False      # are c1[i] and c2[i] integers?
+            try:                        # try to compare as integers, having stripped a common prefix
+                _c2i = None             # used in test for a successfully removing a common prefix
+
+                prefixi = p1.prefixes[i]
+                if prefixi is not None:
+                    if _prefixRegexp(prefixi).search(c2i):
+                        _c1i = int(c1i[len(prefixi):])
+                        _c2i = int(c2i[len(prefixi):])
+
+                if _c2i is None:
+                    _c1i, _c2i = p1.ints[i], p2.ints[i]
+                    if _c1i is None or _c2i is None:
+                        raise ValueError()
+
+                c1i, c2i = _c1i, _c2i
+                c12AreIntegral = True
+            except ValueError:
+                pass
+
+            different = cmp(c1i, c2i)
+            if different:
+                if mustReturnInt or c12AreIntegral:
+                    return different
+                else:
+                    if i == n - 1:
+                        if c2i.startswith(c1i):
+                            return -1
+                        elif c1i.startswith(c2i):
+                            return 1
+                        
+                    raise ValueError("Versions %s and %s cannot be sorted" % (v1, v2))
+
+        # So far, the two versions are identical.  The longer version should sort later
+        return cmp(n1, n2)
+
+    def sortKey(self, versions):
+        """
+        return a function giving the key to sort versions (an iterable of version strings) in
+        the order defined by compare(), and a flag saying if the keys are tuples (rather than
+        objects that call compare() each time they are compared)
+        """
+        if self._isStandard(sorting=True):
+            keys, shapes = self._getKeys(versions)
+            if keys is not None and _consistentShapes(shapes):
+                return keys.__getitem__, True
+
+        return functools.cmp_to_key(self), False
+
+    def rangeKey(self, versions):
+        """
+        return a function giving the key to sort versions as sortKey() does, provided that
+        compare(v1, v2, mustReturnInt=False) agrees with it (rather than raising ValueError) for
+        every pair of versions;  otherwise return None.  Versions that lie within a range (e.g.
+        ">= 12.0") may then be found by bisecting a sorted list of keys
+        """
+        if self._isStandard(sorting=True):
+            keys, shapes = self._getKeys(versions)
+            if keys is not None and _consistentShapes(shapes, strict=True):
+                return keys.__getitem__
+
+        return None
+
+    def _getKeys(self, versions):
+        # return a dict of the keys of versions and the set of their shapes, or (None, None)
+        keys, shapes = {}, set()
+        for v in versions:
+            if v in keys:
+                continue
+            info = _parse(self, v).getKeyInfo(self)
+            if info is None:
+                return None, None
+
+            keys[v] = info[0]
+            shapes.add(info[1])
+
+        return keys, shapes
+
+#
+# Parsing versions.  Each version is split into its components once, and the result remembered;
+# the same ordering as VersionCompare.stdCompare() is then given by _compareParsed() or, for a
+# set of versions that use the same kinds of component in the same places, by comparing
+# tuples (see _ParsedVersion.getKeyInfo())
+#
+_maxParsed = 100000                     # the number of parsed versions to remember
+_parsed = {}
+
+def _parse(versionCmp, version):
+    """Return the _ParsedVersion for a version string"""
+
+    try:
+        return _parsed[version]
+    except KeyError:
+        pass
+    except TypeError:                   # not hashable
+        return _ParsedVersion(versionCmp, version)
+
+    if len(_parsed) >= _maxParsed:
+        _parsed.clear()
+    p = _ParsedVersion(versionCmp, version)
+    _parsed[version] = p
+
+    return p
+
+_prefixRegexps = {}
+
+def _prefixRegexp(prefix):
+    """Return the compiled regular expression matching a component with the given prefix"""
+
+    try:
+        return _prefixRegexps[prefix]
+    except KeyError:
+        regexp = re.compile(r"^%s\d+$" % prefix)
+        _prefixRegexps[prefix] = regexp
+        return regexp
+
+_prefix_re = re.compile(r"^([^\d]+)\d+$")
+_alpha_re = re.compile(r"^[A-Za-z]+\Z")
+_canonicalInt_re = re.compile(r"^(0|[1-9][0-9]*)\Z")
+
+class _ParsedVersion(object):
+    """A version, split as VersionCompare.stdCompare() needs it"""
+
+    __slots__ = ("prim", "sec", "ter", "components", "prefixes", "ints", "_keyInfo")
+
+    def __init__(self, versionCmp, version):
+        self.prim, self.sec, self.ter = versionCmp._splitVersion(version)
+
+        self.components = tuple(re.split(r"[._]", self.prim))
+        prefixes, ints = [], []
+        for c in self.components:
+            mat = _prefix_re.search(c)
+            if mat:
+                prefixes.append(mat.group(1))
+            else:
+                prefixes.append(None)
+            try:
+                ints.append(int(c))
+            except ValueError:
+                ints.append(None)
+        self.prefixes, self.ints = tuple(prefixes), tuple(ints)
+
+        self._keyInfo = False           # not yet calculated
+
+    def getKeyInfo(self, versionCmp):
+        """
+        Return (key, shape) for this version, or None if it can't be given a key.  Keys sort in
+        the order given by stdCompare(), provided that the versions being sorted have consistent
+        shapes (see _consistentShapes())
+        """
+        if self._keyInfo is not False:
+            return self._keyInfo
+        self._keyInfo = None
+
+        primKey, shape = [], []
+        separators = [""] + re.findall(r"[._]", self.prim)
+        for i, c in enumerate(self.components):
+            if not c:                   # an empty component sorts before anything else
+                primKey.append((0,))
+                shape.append(("", i, separators[i], None))
+                continue
+
+            prefix = self.prefixes[i]
+            if prefix is not None:
+                tail = c[len(prefix):]
+                if not _alpha_re.search(prefix) or not _canonicalInt_re.search(tail):
+                    return None
+                value, kind = int(tail), "p" + prefix
+            elif self.ints[i] is not None:
+                if not _canonicalInt_re.search(c):
+                    return None
+                value, kind = self.ints[i], "i"
+            else:
+                value, kind = c, "s"
+
+            primKey.append((1, value))
+            shape.append(("", i, separators[i], kind))
+        #
+        # A version with a -sec sorts before one without;  a missing +ter sorts as an empty version
+        #
+        if self.sec:
+            info = _parse(versionCmp, self.sec).getKeyInfo(versionCmp)
+            if info is None:
+                return None
+            secKey = (0, info[0])
+            shape += [("s" + level, i, sep, kind) for level, i, sep, kind in _shapes[info[1]]]
+        else:
+            secKey = (1,)
+
+        if self.ter:
+            info = _parse(versionCmp, self.ter).getKeyInfo(versionCmp)
+            if info is None:
+                return None
+            terKey = info[0]
+            shape += [("t" + level, i, sep, kind) for level, i, sep, kind in _shapes[info[1]]]
+        elif self.prim or self.sec:
+            terKey = _emptyKey
+        else:
+            terKey = ()
+
+        self._keyInfo = ((tuple(primKey), secKey, terKey), _shapeId(tuple(shape)))
+        return self._keyInfo
+
+# the key of an empty version
+_emptyKey = (((0,),), (1,), ())
+#
+# The shape of a version lists the (level, index, separator, kind) of its components, where level
+# is "" for the primary component, and e.g. "s" or "ts" for those of its -sec or +ter's -sec, and
+# kind is "i", "s", or "p"+prefix for integers, strings, and prefixed integers (None if empty).
+# There are few distinct shapes, so each is given an integer id
+#
+_shapes = []
+_shapeIds = {}
+
+def _shapeId(shape):
+    try:
+        return _shapeIds[shape]
+    except KeyError:
+        _shapeIds[shape] = len(_shapes)
+        _shapes.append(shape)
+        return _shapeIds[shape]
+
+def _consistentShapes(shapeIds, strict=False):
+    """
+    Return True if the versions with the given shapes sort by key as stdCompare() sorts them,
+    i.e. if they have the same separators and kind of component in each position (an empty
+    component is compatible with any kind).  If strict, the primary components must also all be
+    (possibly prefixed) integers, so that stdCompare(mustReturnInt=False) never raises ValueError
+    """
+    kinds = {}
+    for shapeId in shapeIds:
+        for level, i, sep, kind in _shapes[shapeId]:
+            if strict and not level and kind in (None, "s"):
+                return False
+
+            old = kinds.get((level, i))
+            if old is None:
+                kinds[(level, i)] = (sep, kind)
+            elif old[0] != sep:
+                return False
+            elif old[1] != kind:
+                if old[1] is None:
+                    kinds[(level, i)] = (sep, kind)
+                elif kind is not None:
+                    return False
+
+    return True
+
+def versionSortKey(versionCmp, versions):
+    """
+    Return a function giving the key to sort versions (a list of version strings) in the order
+    defined by versionCmp (e.g. hooks.version_cmp)
+    """
+    return _sortKey(versionCmp, versions)[0]
+
+def latestVersion(versionCmp, versions):
+    """
+    Return the latest of versions (a list of version strings) in the order defined by versionCmp,
+    as the last element of the sorted list would be;  None if there are no versions
+    """
+    if not versions:
+        return None
+
+    key, isTuple = _sortKey(versionCmp, versions)
+    if isTuple:                         # the ordering is consistent, so max() will do
+        return max(reversed(versions), key=key)
+    else:
+        return sorted(versions, key=key)[-1]
+
+def _sortKey(versionCmp, versions):
+    if isinstance(versionCmp, VersionCompare):
+        return versionCmp.sortKey(versions)
+    else:
+        return functools.cmp_to_key(versionCmp), False
+
+def sortOrderId(versionCmp):
+    """
+    Return a string identifying the order in which versionCmp sorts versions, which may be
+    persisted (e.g. along with versions sorted that way) and compared in another process;  None
+    if the order can't be identified this way (e.g. versionCmp is a user-supplied function)
+    """
+    if isinstance(versionCmp, VersionCompare) and versionCmp._isStandard(sorting=True) and \
+       type(versionCmp).sortKey == VersionCompare.sortKey:
+        return _sortOrder
+    return None
+
+# the sortOrderId() of VersionCompare;  change it if stdCompare() sorts versions differently
+_sortOrder = "VersionCompare.stdCompare 1"
+
+class VersionIndex(object):
+    """
+    A list of versions sorted by a version comparator (e.g. hooks.version_cmp), in which the
+    latest version is found in constant time, and the versions in a range by bisection
+    """
+
+    def __init__(self, sortOrder, versions):
+        """
+        @param sortOrder   the sortOrderId() of the comparator used to sort the versions, or the
+                             comparator itself if it has none
+        @param versions    the sorted list of versions
+        """
+        self.sortOrder = sortOrder
+        self.versions = versions
+        self._keys = False              # the versions' keys; see bisect()
+        self._shapes = None
+
+    def build(versionCmp, versions):
+        """Return a VersionIndex of versions, sorting them as sort() would using versionCmp"""
+
+        sortOrder = sortOrderId(versionCmp)
+        if sortOrder is None:
+            sortOrder = versionCmp
+        return VersionIndex(sortOrder, sorted(versions, key=versionSortKey(versionCmp, versions)))
+    build = staticmethod(build)
+
+    def isSortedBy(self, versionCmp):
+        """Return True if the versions were sorted by versionCmp (or an equivalent comparator)"""
+
+        sortOrder = sortOrderId(versionCmp)
+        if sortOrder is None:
+            return self.sortOrder is versionCmp
+        return self.sortOrder == sortOrder
+
+    def isPersistent(self):
+        """Return True if the index may be used by another process (see sortOrderId())"""
+
+        return isinstance(self.sortOrder, str)
+
+    def latest(self):
+        """Return the latest version, as the last element of a sorted list would be;  None if empty"""
+
+        if self.versions:
+            return self.versions[-1]
+        return None
+
+    def bisect(self, versionCmp, version):
+        """
+        Return (lo, hi) such that versions[lo:hi] are those that versionCmp(v, version,
+        mustReturnInt=False) says are equal to version, those before them being older and those
+        after newer;  or None if version can't be found by bisection (see
+        VersionCompare.rangeKey()).  versionCmp must be the comparator that sorted the versions
+        """
+        if self._keys is False:
+            self._keys = None
+            if isinstance(versionCmp, VersionCompare) and versionCmp._isStandard(sorting=True):
+                keys, shapes = versionCmp._getKeys(self.versions)
+                if keys is not None and _consistentShapes(shapes, strict=True):
+                    self._keys = [keys[v] for v in self.versions]
+                    self._shapes = shapes
+
+        if self._keys is None:
+            return None
+
+        info = _parse(versionCmp, version).getKeyInfo(versionCmp)
+        if info is None or not _consistentShapes(self._shapes | set([info[1]]), strict=True):
+            return None
+
+        return bisect.bisect_left(self._keys, info[0]), bisect.bisect_right(self._keys, info[0])
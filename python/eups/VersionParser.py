@@ -2,6 +2,10 @@
 
 import os
 import re
+try:
+    from collections import OrderedDict
+except ImportError:                     # python < 2.7
+    OrderedDict = None
 
 class VersionParser(object):
     """Evaluate a logical expression, returning a Bool.  The grammar is:
@@ -27,9 +31,8 @@ class VersionParser(object):
 names are declared using VersionParser.define()
         """
     def __init__(self, exprStr):
-        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
-        self._tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
-        self._tokens = [p for p in self._tokens if p and not re.search(r"^\s*$", p)]
+        self._compiled = _compile(exprStr)
+        self._tokens = list(self._compiled.tokens)
         
         self._symbols = {}
         self._caseSensitive = False
@@ -109,6 +112,17 @@ names are declared using VersionParser.define()
         if isinstance(self._tokens, bool):
             return self._tokens
 
+        if self._compiled.evaluate and not self._caseSensitive:
+            try:
+                return self._compiled.evaluate(self._symbols)
+            except _Fallback:
+                pass
+
+        return self._interpret()
+
+    def _interpret(self):
+        """Evaluate the logical expression by recursive descent over its tokens"""
+
         val = self._expr()              # n.b. may not have consumed all tokens as || and && short circuit
 
         if val == "EOF":
@@ -181,3 +195,263 @@ names are declared using VersionParser.define()
             return term
 
         return self._next()
+
+#
+# Expressions are tokenized and compiled into closures once, and the results kept in a cache
+# shared by all VersionParsers.  The compiled form only exists for expressions that
+# VersionParser._interpret() would parse as a whole and that use no unusual syntax; it gives the
+# same result as _interpret() would, and raises _Fallback if it can't (e.g. if a symbol's value
+# is an operator).
+#
+_cacheSize = 1000                       # the number of compiled expressions to keep
+_cache = {}
+if OrderedDict:
+    _cache = OrderedDict()
+
+def _compile(exprStr):
+    """Return the _CompiledExpression for exprStr, from the cache if possible"""
+
+    try:
+        compiled = _cache.pop(exprStr)  # it'll be put back as the most recently used
+    except KeyError:
+        compiled = _CompiledExpression(exprStr)
+        while len(_cache) >= _cacheSize:
+            if OrderedDict:
+                _cache.popitem(last=False)
+            else:
+                _cache.clear()
+
+    _cache[exprStr] = compiled
+    return compiled
+
+class _Fallback(Exception):
+    """The compiled form of an expression can't be used to evaluate it"""
+    pass
+
+class _NotCompilable(Exception):
+    """An expression can't be compiled"""
+    pass
+
+_logicalOps = ("||", "or", "&&", "and")
+_comparisonOps = ("==", "=~", "!=", "!~", "<", "<=", ">", ">=")
+_prefixes = ("(", "!", "not")
+_envVar_re = re.compile(r"^\${([^:}]*)(:-([^\}*]*))?}")
+
+def _convert(tok):
+    """Convert a token's value to an int or bool, as VersionParser._peek() does"""
+
+    try:                            # maybe it's an int
+        tok = int(tok)
+    except TypeError:
+        pass
+    except ValueError:
+        pass
+
+    if tok == "True" or tok == "False": # or a bool
+        tok = (tok == "True")
+
+    return tok
+
+class _CompiledExpression(object):
+    """An expression's tokens and, if it could be compiled, a function to evaluate it"""
+
+    def __init__(self, exprStr):
+        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
+        tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
+        self.tokens = tuple([p for p in tokens if p and not re.search(r"^\s*$", p)])
+
+        self._pos = 0
+        self._depth = 0                 # how deeply we're nested within ( or !
+        self._keys = set()              # the tokens used as operators, in lower case
+        try:
+            evaluate = self._expr()
+            if self._pos != len(self.tokens):
+                raise _NotCompilable()
+        except _NotCompilable:
+            self.evaluate = None
+            return
+
+        keys = frozenset(self._keys)
+        def evaluateExpr(symbols):
+            if not keys.isdisjoint(symbols): # an operator has been redefined
+                raise _Fallback()
+
+            val = evaluate(symbols)
+            if val == "EOF":
+                return False
+            else:
+                return val
+
+        self.evaluate = evaluateExpr
+
+    def _peek(self):
+        if self._pos < len(self.tokens):
+            return self.tokens[self._pos]
+        return None
+
+    def _operator(self, tok):
+        # consume an operator
+        self._keys.add(tok.lower())
+        self._pos += 1
+
+    def _expr(self):
+        lhs = self._term()
+        terms = []                      # (isOr, term, peek) for each || or && and its term
+
+        while self._peek() in _logicalOps:
+            op = self._peek()
+            self._operator(op)
+            #
+            # If the operator short circuits, the term isn't parsed and the interpreter peeks at
+            # its first token to see if it's another operator;  unless we're at the top level,
+            # the interpreter then goes on to parse that token in a way that can't be compiled
+            #
+            if self._depth > 0:
+                def peek(symbols):
+                    raise _Fallback()
+            else:
+                peek = self._peekFunction()
+
+            terms.append((op == "||" or op == "or", self._term(), peek))
+
+        if not terms:
+            return lhs
+
+        def expr(symbols):
+            val = lhs(symbols)
+            for isOr, term, peek in terms:
+                if isOr:
+                    if val:
+                        peek(symbols)
+                        return val
+                else:
+                    if not val:
+                        peek(symbols)
+                        return val
+                val = term(symbols)
+
+            return val
+
+        return expr
+
+    def _peekFunction(self):
+        # return a function that looks at the next token as the interpreter's _peek() would
+        tok = self._peek()
+        if tok is None or tok in _prefixes:
+            return lambda symbols: None
+
+        operand = self._operandFunction(tok)
+        def peek(symbols):
+            if operand(symbols) in _logicalOps:
+                raise _Fallback()
+
+        return peek
+
+    def _term(self):
+        lhs = self._prim()
+
+        op = self._peek()
+        if op not in _comparisonOps:
+            return lhs
+        self._operator(op)
+
+        rhs = self._prim()
+
+        if op == "==":
+            def term(symbols):
+                l = lhs(symbols)
+                if isinstance(l, list):
+                    return rhs(symbols) in l
+                else:
+                    return l == rhs(symbols)
+        elif op == "=~":
+            def term(symbols):
+                l = lhs(symbols)
+                return re.search(rhs(symbols), l)
+        elif op == "!=":
+            def term(symbols):
+                l = lhs(symbols)
+                if isinstance(l, list):
+                    return not (rhs(symbols) in l)
+                else:
+                    return l != rhs(symbols)
+        elif op == "!~":
+            def term(symbols):
+                l = lhs(symbols)
+                return not re.search(rhs(symbols), l)
+        elif op == "<":
+            def term(symbols):
+                return lhs(symbols) < rhs(symbols)
+        elif op == "<=":
+            def term(symbols):
+                return lhs(symbols) <= rhs(symbols)
+        elif op == ">":
+            def term(symbols):
+                return lhs(symbols) > rhs(symbols)
+        else:
+            def term(symbols):
+                return lhs(symbols) >= rhs(symbols)
+
+        return term
+
+    def _prim(self):
+        tok = self._peek()
+
+        if tok is None:
+            return lambda symbols: "EOF"
+
+        if tok in _prefixes:
+            self._operator(tok)
+
+            self._depth += 1
+            term = self._expr()
+            self._depth -= 1
+
+            if tok == "(":
+                if self._peek() != ")":
+                    raise _NotCompilable()
+                self._operator(")")
+                return term
+            else:
+                return lambda symbols: not term(symbols)
+
+        self._pos += 1
+        return self._operandFunction(tok)
+
+    def _operandFunction(self, tok):
+        # return a function that returns the value of an operand, as the interpreter's _peek() would
+        mat = _envVar_re.search(tok)
+        if mat:
+            envVar, modifier, value = mat.groups()
+
+            if not value or value == "false":
+                value = False
+
+            def operand(symbols):
+                if envVar in os.environ:
+                    val = _convert(os.environ[envVar])
+                elif modifier:
+                    val = _convert(value)
+                else:
+                    raise RuntimeError("Environment variable $%s is not defined" % envVar)
+
+                if val in _prefixes or val == "EOF":
+                    raise _Fallback()
+                return val
+
+            return operand
+
+        literal = _convert(tok)
+        if literal == "EOF":
+            raise _NotCompilable()
+
+        key = tok.lower()
+        def operand(symbols):
+            if key in symbols:
+                val = _convert(symbols[key])
+                if val in _prefixes or val == "EOF":
+                    raise _Fallback()
+                return val
+            return literal
+
+        return operand
@@ -9,16 +9,17 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
-from .distrib import builder
 from .Eups           import Eups
 from .exceptions     import ProductNotFound
 from .tags           import Tag, checkTagsList
 from .Product import Product
+from .Snapshot       import Snapshot
 from .VersionParser  import VersionParser
 from .stack          import ProductStack, persistVersionName as cacheVersion
 from . import utils, table, hooks
 from .exceptions import EupsException
-from .utils import cmp_or_key, cmp
+from .utils import cmp
+from .VersionCompare import versionSortKey
 
 def printProducts(ostrm, productName=None, versionName=None, eupsenv=None, 
                   tags=None, setup=False, tablefile=False, directory=False, 
@@ -389,6 +390,8 @@ def expandBuildFile(ofd, ifd, product, version, svnroot=None, cvsroot=None, repo
     @param verbose  an integer verbosity level where larger values result 
                        in more messages
     """
+    from .distrib import builder
+
     builderVars = hooks.config.distrib["builder"]["variables"]
 
     if cvsroot:
@@ -605,7 +608,7 @@ def listCache(path=None, verbose=0, flavor=None):
 
         for productName in productNames:
             versionNames = cache.getVersions(productName)
-            versionNames.sort(**cmp_or_key(hooks.version_cmp))
+            versionNames.sort(key=versionSortKey(hooks.version_cmp, versionNames))
 
             print("  %-20s %s" % (productName, " ".join(versionNames)))
 
@@ -636,7 +639,10 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
     this function will assume that the old setup() signature is expected
     by the caller, and the parameters will be forwarded to osetup().
 
-    @param productName     the name of the desired product to setup.  
+    @param productName     the name of the desired product to setup.  This may
+                             also be a list of products to setup together (see
+                             below), in which case version, productRoot and
+                             tablefile may not be given.
     @param version         the desired version of the product.  This can be
                              either a string giving an explicit version
                              or a Tag instance.  
@@ -649,6 +655,16 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
     @param eupsenv         the Eups instance to use to do the setup.  If 
                              None, one will be created for it.
     @param fwd             If False, actually do an unsetup.
+
+    When a list of products is given, each element is either a product name or a
+    (name, version) or (name, version, noRecursion) tuple; noRecursion means that the
+    product's dependencies should not be setup (cf. setup -j).  The products are setup
+    in order by the same Eups instance, so dependencies that they share are only
+    resolved once, and the commands returned make all of the changes together.  Before
+    anything is setup, the products' dependencies are checked for conflicting versions
+    (unless eupsenv is quiet, as this resolves the dependencies twice; see findSetupConflicts()).
+    If any product cannot be setup the changes that it made are discarded and the
+    commands end with "false".
     """
     if isinstance(productName, Eups):
         # Note: this probably won't work if a mix of key-worded and 
@@ -658,9 +674,21 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         if productRoot is None:  productRoot = True
         return osetup(productName, version, prefTags, productRoot, productName.setupType)
 
+    if isinstance(productName, list):
+        if version or productRoot or tablefile:
+            raise EupsException("You may not specify a version, root, or table file " +
+                                "when setting up a list of products")
+        specs = [_setupSpec(s) for s in productName]
+    else:
+        specs = None
+
     if not eupsenv:
         eupsenv = Eups(readCache=False, exact_version=exact_version)
-        if version:
+        if specs:
+            versions = [v for n, v, j in specs if v]
+            if versions:
+                eupsenv.selectVRO(versionName=versions[0])
+        elif version:
             eupsenv.selectVRO(versionName=version)
 
     if isinstance(prefTags, str):
@@ -678,11 +706,58 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
     if postTags:
         checkTagsList(eupsenv, postTags)
 
+    if specs is None:
+        if not _setupProduct(eupsenv, productName, version, fwd, prefTags, postTags,
+                             productRoot=productRoot, tablefile=tablefile):
+            return ["false"]            # as in /bin/false
+        #
+        # Emit the commands to change the caller's environment
+        #
+        return _setupCommands(eupsenv, productName, fwd)
+    #
+    # Setup a list of products, reporting any conflicts first
+    #
+    if fwd and len(specs) > 1 and eupsenv.quiet <= 0:
+        for msg in findSetupConflicts(eupsenv, specs):
+            print(msg, file=utils.stdwarn)
+
+    ok = True
+    for name, version, noRecursion in specs:
+        eupsenv.pushStack("env")
+        if _setupProduct(eupsenv, name, version, fwd, prefTags, postTags, noRecursion=noRecursion):
+            eupsenv.dropStack("env")
+        else:
+            eupsenv.popStack("env")     # forget what it did
+            ok = False
+
+    productName = None
+    if "eups" in [n for n, v, j in specs]:
+        productName = "eups"            # _setupCommands() treats it specially
+    cmds = _setupCommands(eupsenv, productName, fwd)
+    if not ok:
+        cmds += ["false"]
+
+    return cmds
+
+def _setupSpec(spec):
+    # return a (productName, version, noRecursion) tuple for an element of setup()'s list of products
+    if isinstance(spec, str):
+        return spec, None, False
+
+    spec = tuple(spec)
+    if len(spec) == 2:
+        spec += (False,)
+    if len(spec) != 3:
+        raise EupsException("Unable to understand setup specification %s" % (spec,))
+    return spec
+
+def _setupProduct(eupsenv, productName, version, fwd, prefTags, postTags, productRoot=None,
+                  tablefile=None, noRecursion=False):
+    # setup (or unsetup) a product for setup(), reporting any problems.  Return True if all's well
     versionRequested = version
-    ok, version, reason = eupsenv.setup(productName, version, fwd,
+    ok, version, reason = eupsenv.setup(productName, version, fwd, noRecursion=noRecursion,
                                         productRoot=productRoot, tablefile=tablefile)
         
-    cmds = []
     if ok:
         #
         # Check that we got the desired tag
@@ -716,124 +791,226 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
 
                         print("No versions of %s are tagged%s %s; setup version is %s" % \
                               (productName, extra, ",".join(prefTags + postTags), version), file=utils.stdwarn)
+    elif fwd and version is None:
+        print("Unable to find an acceptable version of", productName, file=utils.stderr)
+        if eupsenv.verbose and os.path.exists(productName):
+            print("(Did you mean setup -r %s?)" % productName, file=utils.stderr)
+    else:
+        if fwd:
+            versionName = version
 
-        #
-        # Set new variables
-        #
-        for key, val in os.environ.items():
+            if eupsenv.isLegalRelativeVersion(versionName):
+                versionName = ""
+
+            if versionName:
+                versionName = " " + versionName
+        
+            print("Failed to setup %s%s: %s" % (productName, versionName, reason), file=utils.stderr)
+        else:
+            print("Failed to unsetup %s: %s" % (productName, reason), file=utils.stderr)
+
+    return ok
+
+def findSetupConflicts(eupsenv, specs):
+    """
+    Return a list of messages describing the products that would be required at different
+    versions by a list of products that are to be setup together (see setup()).  Products
+    that can't be found are ignored, as setup() will report them.
+    @param eupsenv    the Eups instance that will do the setup
+    @param specs      the products to setup:  a list of names or (name, version) or
+                        (name, version, noRecursion) tuples
+
+    N.b. each product's dependencies are resolved in full (by Eups.getDependentProducts()),
+    and are resolved again when the products are setup; the tables read are kept by the
+    product stacks, so the second time costs the lookups but not reading the table files.
+    """
+    required = {}                       # the versions required of each product, by name
+    order = []                          # the products' names, in the order first required
+    for name, version, noRecursion in [_setupSpec(s) for s in specs]:
+        try:
+            product = eupsenv.findProduct(name, version)
+        except EupsException:
+            product = None
+        if not product:
+            continue
+
+        products = [product]
+        if not noRecursion:
             try:
-                if val == eupsenv.oldEnviron[key]:
-                    continue
-            except KeyError:
+                products += [p for p, optional, depth in eupsenv.getDependentProducts(product)]
+            except EupsException:
                 pass
 
-            if val and not re.search(r"^['\"].*['\"]$", val) and \
-                   re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
-                val = "'%s'" % val
+        for p in products:
+            if p.name not in required:
+                required[p.name] = []
+                order.append(p.name)
+            for v, requirers in required[p.name]:
+                if v == p.version:
+                    if name not in requirers:
+                        requirers.append(name)
+                    break
+            else:
+                required[p.name].append((p.version, [name]))
+
+    msgs = []
+    for pname in order:
+        if len(required[pname]) > 1:
+            msgs.append("Conflicting versions of %s are required: %s; the last will be setup" %
+                        (pname, "; ".join(["%s by %s" % (v, ", ".join(requirers))
+                                           for v, requirers in required[pname]])))
+    return msgs
+
+def _setupCommands(eupsenv, productName, fwd=True):
+    # return the shell commands that make the changes to the environment (and the aliases) that
+    # eupsenv has made since it was created
+    cmds = []
+    #
+    # Set new variables
+    #
+    for key, val in os.environ.items():
+        try:
+            if val == eupsenv.oldEnviron[key]:
+                continue
+        except KeyError:
+            pass
 
-            if eupsenv.shell in ("sh", "zsh",):
-                cmd = "export %s=%s" % (key, val)
-            elif eupsenv.shell in ("csh",):
-                cmd = "setenv %s %s" % (key, val)
+        if val and not re.search(r"^['\"].*['\"]$", val) and \
+               re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
+            val = "'%s'" % val
 
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # these variables are an implementation detail
+        if eupsenv.shell in ("sh", "zsh",):
+            cmd = "export %s=%s" % (key, val)
+        elif eupsenv.shell in ("csh",):
+            cmd = "setenv %s %s" % (key, val)
 
-                cmd = "echo \"%s\"" % cmd
+        if eupsenv.noaction:
+            if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # these variables are an implementation detail
 
-            cmds += [cmd]
-        #
-        # Extra environment variables that EUPS uses
-        #
-        if not fwd and productName == "eups":
-            for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
-                if k in os.environ:
-                    del os.environ[k]
-        #
-        # unset ones that have disappeared
-        #
-        for key in eupsenv.oldEnviron.keys():
-            if productName != "eups":   # the world will break if we delete these
-                if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
-                    continue
+            cmd = "echo \"%s\"" % cmd
 
-            if key in os.environ:
+        cmds += [cmd]
+    #
+    # Extra environment variables that EUPS uses
+    #
+    if not fwd and productName == "eups":
+        for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
+            if k in os.environ:
+                del os.environ[k]
+    #
+    # unset ones that have disappeared
+    #
+    for key in eupsenv.oldEnviron.keys():
+        if productName != "eups":   # the world will break if we delete these
+            if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
                 continue
 
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unsetenv %s" % (key)
+        if key in os.environ:
+            continue
 
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # an implementation detail
+        if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif eupsenv.shell == "csh":
+            cmd = "unsetenv %s" % (key)
 
-                cmd = "echo \"%s\"" % cmd
+        if eupsenv.noaction:
+            if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # an implementation detail
 
-            cmds += [cmd]
-        #
-        # Now handle aliases
-        #
-        for key in eupsenv.aliases.keys():
-            value = eupsenv.aliases[key]
-
-            try:
-                if value == eupsenv.oldAliases[key]:
-                    continue
-            except KeyError:
-                pass
+            cmd = "echo \"%s\"" % cmd
 
-            if eupsenv.shell == "sh":
-                cmd = "%s() { %s ; }" % (key, value)
-            elif eupsenv.shell == "csh":
-                value = re.sub(r'"?\$@"?', r"\!*", value)
-                cmd = "alias %s \'%s\'" % (key, value)
-
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
+        cmds += [cmd]
+    #
+    # Now handle aliases
+    #
+    for key in eupsenv.aliases.keys():
+        value = eupsenv.aliases[key]
 
-            cmds += [cmd]
-        #
-        # and unset ones that used to be present, but are now gone
-        #
-        for key in eupsenv.oldAliases.keys():
-            if key in eupsenv.aliases:
+        try:
+            if value == eupsenv.oldAliases[key]:
                 continue
+        except KeyError:
+            pass
 
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unalias %s" % (key)
+        if eupsenv.shell == "sh":
+            cmd = "%s() { %s ; }" % (key, value)
+        elif eupsenv.shell == "csh":
+            value = re.sub(r'"?\$@"?', r"\!*", value)
+            cmd = "alias %s \'%s\'" % (key, value)
 
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % cmd
+        if eupsenv.noaction:
+            cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
 
-            cmds += [cmd]
-    elif fwd and version is None:
-        print("Unable to find an acceptable version of", productName, file=utils.stderr)
-        if eupsenv.verbose and os.path.exists(productName):
-            print("(Did you mean setup -r %s?)" % productName, file=utils.stderr)
-        cmds += ["false"]               # as in /bin/false
-    else:
-        if fwd:
-            versionName = version
+        cmds += [cmd]
+    #
+    # and unset ones that used to be present, but are now gone
+    #
+    for key in eupsenv.oldAliases.keys():
+        if key in eupsenv.aliases:
+            continue
 
-            if eupsenv.isLegalRelativeVersion(versionName):
-                versionName = ""
+        if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif eupsenv.shell == "csh":
+            cmd = "unalias %s" % (key)
 
-            if versionName:
-                versionName = " " + versionName
-        
-            print("Failed to setup %s%s: %s" % (productName, versionName, reason), file=utils.stderr)
-        else:
-            print("Failed to unsetup %s: %s" % (productName, reason), file=utils.stderr)
+        if eupsenv.noaction:
+            cmd = "echo \"%s\"" % cmd
 
-        cmds += ["false"]               # as in /bin/false
+        cmds += [cmd]
 
     return cmds
 
+def snapshot(productName, version=None, eupsenv=None, exact_version=False):
+    """
+    Setup a product and return a Snapshot (see eups.Snapshot) of the changes that the setup 
+    made to the environment, suitable for applying with setupFromSnapshot().  The setup is 
+    done in this process's environment.
+
+    @param productName     the name of the desired product to setup.  
+    @param version         the desired version of the product.  This can be
+                             either a string giving an explicit version
+                             or a Tag instance.  
+    @param eupsenv         the Eups instance to use to do the setup.  If 
+                             None, one will be created for it.
+    @throws EupsException  if the product cannot be setup
+    """
+    if not eupsenv:
+        eupsenv = Eups(readCache=False, exact_version=exact_version)
+        if version:
+            eupsenv.selectVRO(versionName=version)
+
+    environ0 = os.environ.copy()
+    ok, setupVersion, reason = eupsenv.setup(productName, version)
+    if not ok:
+        if setupVersion is None:
+            raise EupsException("Unable to find an acceptable version of %s" % productName)
+        raise EupsException("Failed to setup %s %s: %s" % (productName, setupVersion, reason))
+
+    snap = Snapshot.fromSetup(eupsenv, productName, setupVersion, environ0)
+    if isinstance(version, str):
+        snap.versionName = version
+    return snap
+
+def setupFromSnapshot(snap, eupsenv=None):
+    """
+    Return a set of shell commands which, when sourced, will make the changes to the environment
+    recorded in a Snapshot, i.e. setup the product that the snapshot was made of without 
+    resolving its dependencies again.
+
+    @param snap            the Snapshot to apply (see Snapshot.read())
+    @param eupsenv         the Eups instance to use.  If None, one will be created for it.
+    @throws StaleSnapshot  if the snapshot is out of date, in which case the product should be
+                             setup in the usual way instead
+    """
+    if not eupsenv:
+        eupsenv = Eups(readCache=False)
+
+    snap.apply(eupsenv)
+
+    return _setupCommands(eupsenv, snap.productName)
+
 def unsetup(productName, version=None, eupsenv=None):
     """ 
     Return a set of shell commands which, when sourced, will unsetup a product.
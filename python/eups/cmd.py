@@ -41,9 +41,7 @@ import eups
 from . import lock
 from . import tags
 from . import utils
-from . import distrib
 from . import hooks
-from .distrib.server import ServerConf, Mapping, importClass
 
 _errstrm = utils.stderr
 
@@ -84,6 +82,7 @@ Supported commands are:
         pkgroot [n]     Print the current eups pkgroot, or an element thereof
 	pkg-config	Return the options associated with product
 	remove          Remove an eups product from the system
+        snapshot        Save the environment setup by a product for setup --from-snapshot
         startup         List files used (or potentially used) to configure eups
         tags            List information about supported and known tags
 	undeclare	Undeclare a product
@@ -1503,7 +1502,7 @@ where it is installed.
 
 class AdminCmd(EupsCmd):
 
-    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|info|show] [-h|--help] [-r root]"
+    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|convertDb|daemon|info|show] [-h|--help] [-r root]"
 
     # set this to True if the description is preformatted.  If false, it 
     # will be automatically reformatted to fit the screen
@@ -1694,6 +1693,7 @@ class AdminClearServerCacheCmd(EupsCmd):
 
         myeups = eups.Eups(readCache=False)
         # FIXME: this is not clearing caches in the user's .eups dir.
+        from .distrib.server import ServerConf
         ServerConf.clearConfigCache(myeups, pkgroots, self.opts.verbose)
 
         return 0
@@ -1777,7 +1777,12 @@ class AdminInfoCmd(EupsCmd):
                 if vfile:
                     vfile = vfile.file
             else:
-                vfile = db._findVersionFile(productName, versionName)
+                vfile = db._readVersionFile(productName, versionName)
+                if vfile:
+                    vfile = vfile.file
+
+            if vfile and not os.path.exists(vfile):
+                vfile = getattr(db, "dbfile", vfile) # the data are in an SQLite database
                 
             if vfile:
                 print(vfile)
@@ -1795,6 +1800,66 @@ class AdminInfoCmd(EupsCmd):
         self.err(msg)
         return 1
 
+class AdminConvertDbCmd(EupsCmd):
+
+    usage = "%prog admin convertDb [-h|--help] [options] sqlite|files [path ...]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Convert the databases of the given EUPS_PATH directories (by default, all of the writable
+ones) to the given format:  "sqlite" stores all declarations and global tags in a single
+SQLite file; "files" stores them as individual version and chain files.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) < 1 or self.args[0] not in ("sqlite", "files"):
+            self.err("Please specify the format to convert to: sqlite or files")
+            return 2
+        toFormat = self.args.pop(0)
+
+        from .db import SqliteDatabase
+
+        paths = self.args
+        if not paths:
+            paths = [p for p in eups.Eups.setEupsPath(self.opts.path, self.opts.dbz)
+                     if utils.isDbWritable(p)]
+
+        for path in paths:
+            dbpath = os.path.join(path, "ups_db")
+            if not os.path.isdir(dbpath):
+                self.err("%s is not an EUPS_PATH directory" % path)
+                return 1
+            if not utils.isDbWritable(path):
+                self.err("You don't have permission to convert the database in %s" % path)
+                return 1
+
+            if SqliteDatabase.isSqliteDatabase(dbpath) == (toFormat == "sqlite"):
+                if self.opts.verbose:
+                    print("%s is already in %s format" % (dbpath, toFormat), file=utils.stdinfo)
+                continue
+
+            if self.opts.noaction:
+                print("Convert %s to %s format" % (dbpath, toFormat))
+                continue
+
+            if toFormat == "sqlite":
+                n = SqliteDatabase.toSqlite(dbpath, verbose=self.opts.verbose)
+            else:
+                n = SqliteDatabase.fromSqlite(dbpath, verbose=self.opts.verbose)
+            if self.opts.verbose:
+                print("Converted %d products in %s" % (n, dbpath), file=utils.stdinfo)
+
+        return 0
+
 class AdminShowCmd(EupsCmd):
     usage = "%prog admin show [-h|--help] [options] what"
 
@@ -1859,6 +1924,62 @@ class AdminListCacheCmd(EupsCmd):
 
         return 0
 
+class AdminDaemonCmd(EupsCmd):
+
+    usage = "%prog admin daemon [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Start a daemon that keeps eups and its product caches loaded, and which runs the eups and setup
+commands that are sent to it rather than each starting afresh.  Commands that may change a
+database are still run by the calling process, as are all commands if $EUPS_NO_DAEMON is set.
+The daemon listens on $EUPS_DAEMON_SOCKET (default: ~/.eups/_caches_/daemon.sock), and exits
+when stopped with --stop or when it has been idle for a while.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        self.clo.add_option("--foreground", dest="foreground", action="store_true", default=False,
+                            help="Don't detach the daemon from the terminal")
+        self.clo.add_option("--idle-timeout", dest="idleTimeout", action="store", type="int",
+                            default=3600, metavar="SECONDS",
+                            help="Exit after this many seconds without a command (0: never)")
+        self.clo.add_option("--socket", dest="socket", action="store", default=None,
+                            help="The socket to listen on")
+        self.clo.add_option("--stop", dest="stop", action="store_true", default=False,
+                            help="Stop the running daemon")
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) > 0:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 2
+
+        from . import daemon
+
+        if self.opts.stop:
+            if not daemon.stopDaemon(self.opts.socket):
+                self.err("No eups daemon is running")
+                return 1
+            return 0
+
+        if self.opts.noaction:
+            return 0
+
+        d = daemon.Daemon(self.opts.socket, self.opts.idleTimeout or None, self.opts.verbose)
+        d.listen()
+        if not self.opts.foreground:
+            daemon.detach()
+        d.serve()
+
+        return 0
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 class DistribCmd(EupsCmd):
@@ -1992,6 +2113,8 @@ If no product or version is provided, all defined tags are defined.
             self.err("Please use --server-dir to specify where you want to declare this tag")
             return 2
             
+        from . import distrib
+        from .distrib.server import importClass
         server = distrib.Repository(myeups, pkgroot)
         clsname = server.distServer.getConfigProperty('DISTRIB_CLASS', 'eups.distrib.Distrib.DefaultDistrib').split(':')[-1]
         distribClass = importClass(clsname)
@@ -2080,6 +2203,7 @@ class DistribListCmd(EupsCmd):
                     return 3
                 options[name] = val
 
+        from . import distrib
         try:
             repos = distrib.Repositories(pkgroots, options, myeups, verbosity=self.opts.verbose)
 
@@ -2144,6 +2268,7 @@ tag will be installed.
                             help="Prevent automatic assignment of server/global tags")
         self.clo.add_option("--noclean", dest="noclean", action="store_true", default=False,
                             help="Don't clean up after successfully building the product")
+        from . import distrib
         self.clo.add_option("-j", "--nodepend", dest="depends", action="store_const",
                             const=distrib.Repositories.DEPS_NONE,
                             help="Just install product, but not its dependencies")
@@ -2302,6 +2427,7 @@ tag will be installed.
         if self.opts.quiet:
             log = open("/dev/null", "w")
 
+        from . import distrib
         try:
             repos = distrib.Repositories(self.opts.root, dopts, myeups, 
                                          self.opts.flavor, 
@@ -2417,6 +2543,7 @@ product will be fully removed, even if its installation was successful.
             e.status = 9
             raise
 
+        from . import distrib
         try:
             repos = distrib.Repositories(self.opts.root, dopts, myeups, 
                                          self.opts.flavor, allowEmptyPkgroot=True,
@@ -2646,6 +2773,7 @@ class DistribCreateCmd(EupsCmd):
             if not topProduct:
                 raise RuntimeError("I can't find product %s %s" % (productName, version))
 
+            from .distrib.server import Mapping
             mapping = Mapping()
             mapping.add(inProduct=productName, inVersion=version,
                         outVersion=self.incrBuildVersion(myeups, productName, version))
@@ -2697,6 +2825,7 @@ class DistribCreateCmd(EupsCmd):
             if self.opts.quiet:
                 log = open("/dev/null", "w")
 
+            from . import distrib
             try:
                 repos = None
                 if not self.opts.force:
@@ -2909,6 +3038,90 @@ same arguments.
 
         return 0
 
+class SnapshotCmd(EupsCmd):
+
+    usage = "%prog snapshot [-h|--help] [options] product [version]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = True
+
+    description = \
+"""Write a snapshot of the changes to the environment made by setting up a
+product, as resolved with the same arguments given to the setup command.  The
+snapshot can be applied with "setup --from-snapshot", which doesn't need to
+resolve the setup again and so is much faster; e.g.
+      eups snapshot -t v23 -o lsst_apps.snapshot lsst_apps
+      setup --from-snapshot lsst_apps.snapshot
+
+The snapshot records the state of the stacks on the path; if a product is
+declared or undeclared, a tag is changed, or one of the products' table
+files is modified, the snapshot is out of date and setup --from-snapshot
+will resolve the setup in the usual way.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        # these options are used to configure the Eups instance
+        self.addEupsOptions()
+
+        self.clo.add_option("-c", "--current", dest="current", action="store_true", default=False,
+                            help="same as --postTag=current")
+        self.clo.add_option("-e", "--exact", dest="exact_version", action="store_true", default=False, 
+                            help="Use the as-installed versions, not the dependencies in the table file")
+        self.clo.add_option("-i", "--ignore-versions", dest="ignorever", action="store_true", default=False,
+                            help="Ignore any explicit versions in table files")
+        self.clo.add_option("-k", "--keep", dest="keep", action="store_true", default=False,
+                            help="Keep any products already setup (regardless of their versions)")
+        self.clo.add_option("-o", "--output", dest="outfile", action="store", metavar="FILE",
+                            help="Write the snapshot to FILE (default: standard out)")
+        self.clo.add_option("-T", "--postTag", dest="postTag", action="append",
+                            help="Put TAG after version(Expr)? in VRO (may be repeated; precedence is left-to-right)")
+        self.clo.add_option("-t", "--tag", dest="tag", action="append",
+                            help="Put TAG near the start of the VRO (may be repeated; precedence is left-to-right)")
+
+    def execute(self):
+        if len(self.args) == 0:
+            self.err("Please specify a product name")
+            return 3
+        productName = self.args[0]
+        versionName = None
+        if len(self.args) > 1:
+            versionName = self.args[1]
+
+        if self.opts.current:
+            if not self.opts.postTag:
+                self.opts.postTag = []
+            self.opts.postTag += ['current']
+
+        myeups = self.createEups(self.opts, versionName, readCache=False)
+
+        myeups._processDefaultTags(self.opts)
+        myeups.selectVRO(self.opts.tag, None, versionName, self.opts.dbz,
+                         postTag=self.opts.postTag)
+
+        for p, generation, userGeneration in myeups.getDatabaseGenerations():
+            if generation is None:
+                self.err("Warning: %s has no record of its updates, so changes to it will not be noticed"
+                         % p)
+
+        try:
+            snap = eups.snapshot(productName, versionName, myeups)
+        except eups.EupsException as e:
+            e.status = 2
+            raise
+        snap.tags = self.opts.tag or []
+        snap.postTags = self.opts.postTag or []
+
+        if self.opts.outfile:
+            snap.write(self.opts.outfile)
+        else:
+            snap.write(sys.stdout)
+
+        return 0
+
 class HelpCmd(EupsCmd):
 
     usage = "%prog help [-h|--help]"
@@ -3025,6 +3238,7 @@ register("pkg-config",   PkgconfigCmd, lockType=lock.LOCK_SH)
 register("uses",         UsesCmd, lockType=lock.LOCK_SH)
 register("expandbuild",  ExpandbuildCmd, lockType=lock.LOCK_SH)
 register("expandtable",  ExpandtableCmd, lockType=lock.LOCK_SH)
+register("snapshot",     SnapshotCmd, lockType=lock.LOCK_SH)
 register("declare",      DeclareCmd)
 register("undeclare",    UndeclareCmd)
 register("remove",       RemoveCmd)
@@ -3036,6 +3250,8 @@ register("admin clearLocks",       AdminClearLocksCmd, lockType=None)
 register("admin listLocks",        AdminListLocksCmd, lockType=None)
 register("admin listCache",        AdminListCacheCmd, lockType=lock.LOCK_SH)
 register("admin info",             AdminInfoCmd, lockType=lock.LOCK_SH)
+register("admin convertDb",        AdminConvertDbCmd)
+register("admin daemon",           AdminDaemonCmd, lockType=None)
 register("admin show",             AdminShowCmd, lockType=None)
 register("distrib",         DistribCmd, lockType=None) # must be None, as subcommands take locks
 register("distrib clean",   DistribCleanCmd)
@@ -0,0 +1,356 @@
+"""
+a resident process that runs eups and setup commands for the shell wrappers.
+
+Every eups or setup command starts a new python, imports eups, loads the
+user's customizations and reads the product caches before it does any work.
+A daemon (started with "eups admin daemon") does all that once, and then
+listens on a Unix socket (see eupsclient.socketPath()) for commands sent by
+the eups and setup programmes (see eupsclient.run()), which it runs in its
+own process with the caller's environment, arguments and working directory,
+returning their output.  The ProductStacks it reads are kept in memory (see
+WarmStacks) and reused for as long as their databases and caches are
+unchanged.
+
+Commands that change a database (those that take an exclusive lock) are
+declined, as are commands using --debug and commands from an environment
+in which a different set of startup files would be loaded; declined
+commands are run in-process by the caller as before.  Commands are run one
+at a time.
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import socket
+import eupsclient
+from eupsclient import sendMessage, receiveMessage
+from . import hooks
+from . import lock
+from . import utils
+from .exceptions import EupsException
+from .Eups import Eups
+from .stack import WarmStacks
+
+class _Declined(Exception):
+    # raised when a command should be run by the caller instead
+    pass
+
+class _MessageFile(object):
+    # a file-like object that sends what's written to it as messages
+    def __init__(self, sock, stream):
+        self._sock = sock
+        self._stream = stream
+
+    def write(self, text):
+        if text:
+            sendMessage(self._sock, { self._stream : str(text) })
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        raise IOError("a daemon's client stream has no file descriptor")
+
+class Daemon(object):
+    """
+    a server that runs eups and setup commands sent to it over a Unix socket
+    """
+
+    def __init__(self, path=None, idleTimeout=3600, verbose=0):
+        """
+        @param path         the socket to listen on.  Default:
+                              eupsclient.socketPath()
+        @param idleTimeout  exit after this many seconds without a command
+                              (None means never)
+        @param verbose      the verbosity of the daemon's own messages
+        """
+        if not path:
+            path = eupsclient.socketPath()
+        self.path = path
+        self.idleTimeout = idleTimeout
+        self.verbose = verbose
+
+        # the startup files that have been loaded, and the environment that
+        # they were loaded into;  commands that would load others are declined
+        self.customization = self._getCustomization(hooks.customisationFiles or [])
+        self.eupsDir = os.environ.get("EUPS_DIR")
+
+        self._server = None
+        self._stopping = False
+
+    def _getCustomization(self, files):
+        # describe a set of startup files, so that we can tell if they change
+        out = []
+        for f in files:
+            try:
+                out.append((f, os.stat(f).st_mtime))
+            except OSError:
+                out.append((f, None))
+        return out
+
+    def listen(self):
+        """
+        start listening on the socket.  Commands sent once this has been
+        called will be run by serve().
+        @throws EupsException  if another daemon is listening on the socket
+        """
+        if isRunning(self.path):
+            raise EupsException("An eups daemon is already listening on %s" % self.path)
+
+        sockdir = os.path.dirname(self.path)
+        if sockdir and not os.path.isdir(sockdir):
+            os.makedirs(sockdir)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)         # only we may talk to the daemon
+        try:
+            self._server.bind(self.path)
+        finally:
+            os.umask(umask)
+        self._server.listen(16)
+        self._server.settimeout(self.idleTimeout)
+
+    def serve(self):
+        """
+        run the commands sent to the socket until told to stop (see stop())
+        or idle for idleTimeout seconds
+        """
+        if self._server is None:
+            self.listen()
+        server = self._server
+
+        Eups.warmStacks = WarmStacks()
+        if self.verbose:
+            print("eups daemon listening on %s" % self.path, file=utils.stdinfo)
+
+        try:
+            while not self._stopping:
+                try:
+                    conn, addr = server.accept()
+                except socket.timeout:
+                    if self.verbose:
+                        print("eups daemon exiting after %ss idle" % self.idleTimeout,
+                              file=utils.stdinfo)
+                    break
+                try:
+                    conn.settimeout(None)
+                    self.handle(conn)
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            Eups.warmStacks = None
+
+    def stop(self):
+        """
+        make serve() return once the current command is done
+        """
+        self._stopping = True
+
+    def handle(self, conn):
+        """
+        read a request from a connection and run it, sending back the output
+        """
+        try:
+            request = receiveMessage(conn)
+        except ValueError:
+            return
+        if not request:
+            return
+
+        try:
+            if request.get("version") != eupsclient.protocolVersion:
+                raise _Declined("protocol version %s" % request.get("version"))
+
+            if request.get("tool") == "stop":
+                self.stop()
+                status = 0
+            else:
+                status = self._run(request, conn)
+            sendMessage(conn, dict(status=status))
+        except _Declined as e:
+            if self.verbose > 1:
+                print("eups daemon declined %s %s: %s" % (request.get("tool"),
+                                                          " ".join(request.get("argv", [])), e),
+                      file=utils.stdinfo)
+            sendMessage(conn, dict(fallback=str(e)))
+        except socket.error:
+            pass                        # the client went away
+        except Exception as e:
+            # leave it to the client, which will at least report the problem
+            try:
+                sendMessage(conn, dict(fallback=str(e)))
+            except socket.error:
+                pass
+
+    def _run(self, request, conn):
+        # run the requested command in the client's environment, returning
+        # its exit status.  The process's global state is restored afterwards
+        request = utils.nativeStrings(request) # json's strings are unicode in python 2
+        environ = request["environ"]
+        if environ.get("EUPS_DIR") != self.eupsDir:
+            raise _Declined("different EUPS_DIR")
+
+        savedEnviron = os.environ.copy()
+        savedCwd = os.getcwd()
+        savedArgv = sys.argv
+        savedStreams = sys.stdout, sys.stderr
+        coloredFiles = [utils.stderr, utils.stdinfo, utils.stdwarn, utils.stdok]
+        savedColoredFiles = [(f._fileObj, f._isatty) for f in coloredFiles]
+        savedConfig = hooks.saveConfig() # commands may change the configuration
+
+        out = _MessageFile(conn, "stdout")
+        err = _MessageFile(conn, "stderr")
+        try:
+            os.environ.clear()
+            os.environ.update(environ)
+            try:
+                os.chdir(request["cwd"])
+            except OSError:
+                raise _Declined("cannot chdir to %s" % request["cwd"])
+            sys.argv = ["eups"] + request["argv"]
+            sys.stdout, sys.stderr = out, err
+            for f in coloredFiles:
+                f._fileObj, f._isatty = err, request.get("isatty", False)
+
+            if request["tool"] == "setup":
+                return self._runSetup(request["argv"])
+            elif request["tool"] == "eups":
+                return self._runEups(request["argv"])
+            else:
+                raise _Declined("unknown tool %s" % request["tool"])
+        finally:
+            for f, saved in zip(coloredFiles, savedColoredFiles):
+                f._fileObj, f._isatty = saved
+            sys.stdout, sys.stderr = savedStreams
+            sys.argv = savedArgv
+            os.chdir(savedCwd)
+            os.environ.clear()
+            os.environ.update(savedEnviron)
+            hooks.restoreConfig(savedConfig)
+
+    def _checkCustomization(self, path):
+        # decline the command if it would load other startup files than we did
+        files = hooks.loadCustomization(execute=False, reset=True, path=path)
+        if self._getCustomization(files) != self.customization:
+            raise _Declined("different startup files")
+
+    def _runSetup(self, argv):
+        # run the setup programme; cf. bin/eups_setup_impl.py
+        import eups.setupcmd
+        import eups.debug
+
+        try:
+            setup = eups.setupcmd.EupsSetup(args=argv)
+        except SystemExit as e:
+            return e.code
+
+        if setup.opts.debug:
+            raise _Declined("--debug")
+        eups.debug.parseDebugOption("")
+        self._checkCustomization(Eups.setEupsPath(dbz=setup.opts.dbz))
+
+        try:
+            return setup.run()
+        except SystemExit as e:
+            return e.code
+        except Exception as e:
+            setup.err(utils.Color(e, utils.Color.classes["ERROR"]))
+            print("false")
+            return getattr(e, "status", 9)
+
+    def _runEups(self, argv):
+        # run the eups programme; cf. bin/eups_impl.py
+        import eups.cmd
+        import eups.debug
+
+        try:
+            cmd = eups.cmd.EupsCmd(args=argv, toolname="eups")
+        except SystemExit as e:
+            return e.code
+
+        if cmd.opts.debug:
+            raise _Declined("--debug")
+        # only run commands that can't change a database (or the daemon)
+        cmdName = cmd.cmd
+        if cmdName in ("admin", "distrib") and cmd.args:
+            cmdName = "%s %s" % (cmdName, cmd.args[0])
+            readOnly = eups.cmd._cmdLookup.get(cmdName, (None, None))[1] == lock.LOCK_SH
+        else:
+            readOnly = cmdName in eups.cmd._cmdLookup and \
+                eups.cmd._cmdLookup[cmdName][1] in (None, lock.LOCK_SH)
+        if not readOnly:
+            raise _Declined("eups %s may change a database" % cmdName)
+        eups.debug.parseDebugOption("")
+        self._checkCustomization(Eups.setEupsPath(path=cmd.opts.path, dbz=cmd.opts.dbz))
+
+        try:
+            return cmd.run()
+        except SystemExit as e:
+            return e.code
+        except Exception as e:
+            cmd.err(str(e))
+            return getattr(e, "status", 9)
+
+def isRunning(path=None):
+    """
+    return True if a daemon is listening on a socket
+    @param path   the daemon's socket.  Default: eupsclient.socketPath()
+    """
+    if not path:
+        path = eupsclient.socketPath()
+    if not os.path.exists(path):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            return True
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+
+def detach():
+    """
+    detach the process from its terminal and from the process that started
+    it, as daemons do.  The calling process exits, and a grandchild returns.
+    """
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+
+    os.chdir("/")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+def stopDaemon(path=None):
+    """
+    ask the daemon listening on a socket to exit, returning True if it
+    was running
+    @param path   the daemon's socket.  Default: eupsclient.socketPath()
+    """
+    if not path:
+        path = eupsclient.socketPath()
+    if not os.path.exists(path):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            sendMessage(sock, dict(version=eupsclient.protocolVersion, tool="stop"))
+            return receiveMessage(sock) is not None
+        except socket.error:
+            return False
+    finally:
+        sock.close()
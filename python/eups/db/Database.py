@@ -7,7 +7,7 @@ from .ChainFile import ChainFile
 import eups.tags
 from eups.Product import Product
 from eups.exceptions import UnderSpecifiedProduct, ProductNotFound, TableFileNotFound
-from eups.utils import xrange, cmp_or_key
+from eups.utils import xrange, cmp_or_key, AtomicFile
 
 versionFileExt = "version"
 versionFileTmpl = "%s." + versionFileExt
@@ -15,6 +15,7 @@ versionFileRe = re.compile(r'^(\w.*)\.%s$' % versionFileExt)
 tagFileExt = "chain"
 tagFileTmpl = "%s." + tagFileExt
 tagFileRe = re.compile(r'^(\w.*)\.%s$' % tagFileExt)
+generationFileName = ".generation"
 
 try:
     _databases
@@ -47,7 +48,11 @@ def Database(dbpath, userTagRoot=None, defStackRoot=None, owner=None):
 
     key = (dbpath, defStackRoot)
     if key not in _databases:
-        _databases[key] = _Database(dbpath, defStackRoot)
+        from . import SqliteDatabase
+        if SqliteDatabase.isSqliteDatabase(dbpath):
+            _databases[key] = SqliteDatabase._SqliteDatabase(dbpath, defStackRoot)
+        else:
+            _databases[key] = _Database(dbpath, defStackRoot)
 
     if userTagRoot:
         _databases[key].addUserTagDb(userTagRoot, defStackRoot, userId=owner)
@@ -153,6 +158,74 @@ class _Database(object):
 
         return None
 
+    def _hasProduct(self, productName):
+        # return true if any version of the product is declared
+        return os.path.exists(self._productDir(productName))
+
+    def _readVersionFile(self, productName, version):
+        # return the VersionFile for a declared version or None if it 
+        # is not declared
+        vfile = self._findVersionFile(productName, version)
+        if vfile is None:
+            return None
+        return VersionFile(vfile, productName, version)
+
+    def _writeVersionFile(self, versionFile, trimDir=None):
+        # record the (updated) contents of a VersionFile
+        pdir = os.path.dirname(versionFile.file)
+        if not versionFile.isEmpty() and not os.path.exists(pdir):
+            os.mkdir(pdir)
+
+        versionFile.write(trimDir)
+        self._bumpGeneration()
+
+    def _generationFile(self, dbdir=None):
+        if not dbdir:  dbdir = self.dbpath
+        return os.path.join(dbdir, generationFileName)
+
+    def getGeneration(self, dbdir=None):
+        """
+        return the generation number of the database:  a number that is 
+        incremented every time a product is declared or undeclared or a 
+        tag assignment is changed.  None is returned if the database has 
+        no generation recorded (e.g. it has never been updated by a version
+        of EUPS that records it).
+        @param dbdir   the database directory to consult.  If None, the 
+                          main database (rather than the user tag area) is 
+                          consulted.
+        """
+        try:
+            fd = open(self._generationFile(dbdir))
+            try:
+                return int(fd.read())
+            finally:
+                fd.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def getGenerations(self):
+        """
+        return a dictionary giving the current generation number (see 
+        getGeneration()) of the main database and, if set, of the user tag 
+        area, keyed by directory.
+        """
+        out = { self.dbpath: self.getGeneration() }
+        if self._getUserTagDb():
+            out[self._getUserTagDb()] = self.getGeneration(self._getUserTagDb())
+        return out
+
+    def _bumpGeneration(self, dbdir=None):
+        # record that the database has been updated.  Concurrent updates 
+        # are expected to be serialized by the callers' locks (see lock.py)
+        if not dbdir:  dbdir = self.dbpath
+        generation = self.getGeneration(dbdir)
+        if generation is None:
+            generation = 0
+
+        fd = AtomicFile(self._generationFile(dbdir), "w")
+        fd.write("%d\n" % (generation + 1))
+        fd.close()
+
     def isWritable(self):
         """
         return true if the user has write permission for this database
@@ -169,11 +242,10 @@ class _Database(object):
         @param flavor :   the desired platform flavor
         @return Product : the matched product or None if not found
         """
-        vfile = self._findVersionFile(name, version)
-        if vfile is None:
+        verdata = self._readVersionFile(name, version)
+        if verdata is None:
             return None
 
-        verdata = VersionFile(vfile, name, version)
         product = None
         try:
             product = verdata.makeProduct(flavor, self.defStackRoot, 
@@ -193,11 +265,10 @@ class _Database(object):
         @param version :     the desired version of the product
         @param flavor :      the desired platform flavor
         """
-        pdir = self._productDir(productName)
-        if not os.path.exists(pdir):
+        if not self._hasProduct(productName):
             raise ProductNotFound(productName, version, flavor, self.dbpath)
 
-        tags = self._findTagsInDir(pdir, productName, version, flavor)
+        tags = self._findGlobalTags(productName, version, flavor)
         if self._getUserTagDb():
             udir = self._productDir(productName, self._getUserTagDb())
             if os.path.isdir(udir):
@@ -206,6 +277,10 @@ class _Database(object):
 
         return tags
 
+    def _findGlobalTags(self, productName, version, flavor):
+        return self._findTagsInDir(self._productDir(productName), productName,
+                                   version, flavor)
+
     def _findTagsInDir(self, dir, productName, version, flavor):
         # look tag assignments via chain files in a given directory
 
@@ -277,8 +352,9 @@ class _Database(object):
 
         out = []
         for version in versions:
-            vfile = self._versionFile(productName, version)
-            vfile = VersionFile(vfile, productName, version)
+            vfile = self._readVersionFile(productName, version)
+            if vfile is None:
+                continue
             flavors = vfile.getFlavors()
             for f in flavors:
                 if f not in out:  out.append(f)
@@ -308,11 +384,10 @@ class _Database(object):
 
         out = {}
         for vers in versions:
-            vfile = self._versionFile(name, vers)
-            if not os.path.exists(vfile):
+            vfile = self._readVersionFile(name, vers)
+            if vfile is None:
                 continue
-            vfile = VersionFile(vfile, name, vers)
-                                
+
             flavs = flavors
             declared = vfile.getFlavors()
             if flavs is None:  flavs = declared
@@ -325,8 +400,7 @@ class _Database(object):
         if len(out.keys()) == 0:
             return []
 
-        pdir = self._productDir(name)
-        if not os.path.exists(pdir):
+        if not self._hasProduct(name):
           raise RuntimeError("programmer error: product directory disappeared")
 
         # add in the tags 
@@ -358,27 +432,31 @@ class _Database(object):
         @param user            if true (default), include the user tags
         """
         out = []
-        loc = [None, None]
-        if glob:  loc[0] = self._productDir(productName) 
+        if glob:
+            out.extend(self._globalTagAssignments(productName))
         if user and self._getUserTagDb():
-            loc[1] = self._productDir(productName, self._getUserTagDb())
-
-        tgroup = ""
-        for i in xrange(len(loc)):
-            if not loc[i]: continue
-            if i > 0:  
-                tgroup = "user:"
-                if not os.path.exists(loc[i]):
-                    continue
+            udir = self._productDir(productName, self._getUserTagDb())
+            if os.path.exists(udir):
+                out.extend(("user:"+tag, vers, flavor) for tag, vers, flavor
+                           in self._tagAssignmentsInDir(udir, productName))
+
+        return out
 
-            for file in os.listdir(loc[i]):
-                mat = tagFileRe.match(file)
-                if mat: 
-                    tag = mat.group(1)
-                    file = ChainFile(os.path.join(loc[i],file), productName,tag)
-                    for flavor in file.getFlavors():
-                        vers = file.getVersion(flavor)
-                        out.append( (tgroup+tag, vers, flavor) )
+    def _globalTagAssignments(self, productName):
+        return self._tagAssignmentsInDir(self._productDir(productName), 
+                                         productName)
+
+    def _tagAssignmentsInDir(self, dir, productName):
+        # list the tag assignments recorded via chain files in a given directory
+        out = []
+        for file in os.listdir(dir):
+            mat = tagFileRe.match(file)
+            if mat: 
+                tag = mat.group(1)
+                file = ChainFile(os.path.join(dir,file), productName, tag)
+                for flavor in file.getFlavors():
+                    vers = file.getVersion(flavor)
+                    out.append( (tag, vers, flavor) )
 
         return out
 
@@ -426,10 +504,33 @@ class _Database(object):
         default one will be searched for (in the ups subdirectory of the 
         install directory).
 
-        @param product : the Product instance to register
+        @param product : the Product instance to register, or a list of
+                           them to declare together.  If declaring one
+                           of the list fails, those already declared by 
+                           this call are undeclared again (though a tag 
+                           moved by the declaration is not restored to 
+                           the version it was previously assigned to).
         @throws UnderSpecifiedProduct if the name, version, and flavor are
                    not all set
         """
+        if isinstance(product, list):
+            declared = []
+            try:
+                for p in product:
+                    isNew = isinstance(p, Product) and \
+                        not self.isDeclared(p.name, p.version, p.flavor)
+                    self.declare(p)
+                    if isNew:
+                        declared.append(p)
+            except:
+                for p in reversed(declared):
+                    try:
+                        self.undeclare(p)
+                    except Exception:
+                        pass
+                raise
+            return
+
         if not isinstance(product, Product):
             raise RuntimeError("Database.declare(): argument not a Product:" +
                                product)
@@ -450,21 +551,20 @@ class _Database(object):
                                         msg="Unable to located a table file in default location: " + tablefile)
 
         # set the basic product information
-        pdir = self._productDir(prod.name)
-        vfile = self._versionFileInDir(pdir, prod.version)
-        versionFile = VersionFile(vfile, prod.name, prod.version)
+        versionFile = self._readVersionFile(prod.name, prod.version)
+        if versionFile is None:
+            versionFile = VersionFile(self._versionFile(prod.name, prod.version),
+                                      prod.name, prod.version, readFile=False)
         versionFile.addFlavor(prod.flavor, prod.dir, tablefile, prod.ups_dir)
 
         # seal the deal
-        if not os.path.exists(pdir):
-            os.mkdir(pdir)
-
+        trimDir = None
         if prod.dir:
             trimDir = prod.stackRoot()
             if trimDir and not os.path.exists(trimDir):
                 trimDir = None
                 
-        versionFile.write(trimDir)
+        self._writeVersionFile(versionFile, trimDir)
 
         # now assign any tags
         for tag in prod.tags:
@@ -493,10 +593,10 @@ class _Database(object):
 
         pdir = self._productDir(product.name)
         vfile = self._versionFileInDir(pdir, product.version)
-        if not os.path.exists(vfile):
+        versionFile = self._readVersionFile(product.name, product.version)
+        if versionFile is None:
             return False
 
-        versionFile = VersionFile(vfile)
         if versionFile.hasFlavor(product.flavor):
             # unassign tags associated with this product
             tags = self.findTags(product.name, product.version, product.flavor)
@@ -504,7 +604,8 @@ class _Database(object):
                 self.unassignTag(tag, product.name, product.flavor)
 
         changed = versionFile.removeFlavor(product.flavor)
-        if changed:  versionFile.write()
+        if changed:
+            self._writeVersionFile(versionFile)
 
         # do a little clean up: if we got rid of the version file, try 
         # deleting the directory
@@ -525,20 +626,19 @@ class _Database(object):
                               prepended by a "user:" label to be found
         @param productName  the name of the product
         """
-        pdir = self._productDir(productName)
-        if not os.path.exists(pdir):
+        if not self._hasProduct(productName):
             raise ProductNotFound(productName, stack=self.dbpath);
 
         if isinstance(tag, str):
             tag = eups.tags.Tag(tag)
 
+        if not (searchUserDB and tag.isUser()):
+            return self._globalChainFile(tag.name, productName)
+
         pdirs = []
-        if searchUserDB and tag.isUser():
-            for d in self._getUserTagDb(values=True):
-                if d:
-                    pdirs.append(self._productDir(productName, d))
-        else:
-            pdirs.append(pdir)
+        for d in self._getUserTagDb(values=True):
+            if d:
+                pdirs.append(self._productDir(productName, d))
 
         for pdir in pdirs:
             tfile = self._tagFileInDir(pdir, tag.name)
@@ -546,6 +646,12 @@ class _Database(object):
                 return ChainFile(tfile)
 
         return None
+
+    def _globalChainFile(self, tag, productName):
+        tfile = self._tagFile(productName, tag)
+        if os.path.exists(tfile):
+            return ChainFile(tfile)
+        return None
         
     def getTaggedVersion(self, tag, productName, flavor, searchUserDB=True):
         """
@@ -580,8 +686,7 @@ class _Database(object):
         if isinstance(tag, str):
             tag = eups.tags.Tag(tag)
 
-        vf = VersionFile(self._versionFile(productName, version))
-        declaredFlavors = vf.getFlavors()
+        declaredFlavors = self.findFlavors(productName, version)
         if len(declaredFlavors) == 0:
             raise ProductNotFound(productName, version)
 
@@ -608,17 +713,28 @@ class _Database(object):
             if not self._getUserTagDb():
                 raise RuntimeError("Unable to assign user tags (user db not available)")
 
-            pdir = self._productDir(productName, self._getUserTagDb())
+            dbroot = self._getUserTagDb()
+            pdir = self._productDir(productName, dbroot)
             if not os.path.exists(pdir):
                 os.makedirs(pdir)
         else:
-            pdir = self._productDir(productName)
-        
-        tfile = self._tagFileInDir(pdir, tag.name)
-        tagFile = ChainFile(tfile, productName, tag.name)
+            self._assignGlobalTag(tag.name, productName, version, flavors)
+            return
+
+        self._assignTagInDir(dbroot, tag.name, productName, version, flavors)
+
+    def _assignGlobalTag(self, tag, productName, version, flavors):
+        self._assignTagInDir(self.dbpath, tag, productName, version, flavors)
+
+    def _assignTagInDir(self, dbroot, tag, productName, version, flavors):
+        # record a tag assignment in a chain file under the given database 
+        # directory
+        tfile = self._tagFileInDir(self._productDir(productName, dbroot), tag)
+        tagFile = ChainFile(tfile, productName, tag)
 
         tagFile.setVersion(version, flavors)
         tagFile.write()
+        self._bumpGeneration(dbroot)
             
 
     def unassignTag(self, tag, productNames, flavors=None):
@@ -636,7 +752,7 @@ class _Database(object):
                                  flavors.
         @return bool : False if tag was not assigned to any of the products.
         """
-        dbroot = self.dbpath
+        dbroot = None
         if tag.startswith("user:"):
             dbroot = self._getUserTagDb(upsdb=self.defStackRoot)
             if not dbroot:
@@ -650,6 +766,16 @@ class _Database(object):
         if flavors is not None and not isinstance(flavors, list):
             flavors = [flavors]
 
+        if dbroot is None:
+            return self._unassignGlobalTag(tag, productNames, flavors)
+        return self._unassignTagInDir(dbroot, tag, productNames, flavors)
+
+    def _unassignGlobalTag(self, tag, productNames, flavors):
+        return self._unassignTagInDir(self.dbpath, tag, productNames, flavors)
+
+    def _unassignTagInDir(self, dbroot, tag, productNames, flavors):
+        # remove tag assignments from the chain files under the given 
+        # database directory
         unassigned = False
         for prod in productNames:
             tfile = self._tagFileInDir(self._productDir(prod,dbroot), tag)
@@ -672,8 +798,49 @@ class _Database(object):
                 tf.write()
                 unassigned = True
 
+        if unassigned:
+            self._bumpGeneration(dbroot)
+
         return unassigned
 
+    def getProductStamps(self, productNames=None):
+        """
+        return a dictionary giving, for each declared product, a stamp that 
+        changes whenever the product's declaration or tag assignments 
+        change.  The stamp is the latest modification time of the product's 
+        directory and of the version and chain files within it (including 
+        those in the user tag area, if set).  Two stamps for a product 
+        should be compared for equality only.
+        @param productNames   the names of the products to return stamps 
+                                 for.  If None, all declared products are
+                                 included.
+        """
+        if productNames is None:
+            productNames = self.findProductNames()
+
+        dirs = [self.dbpath]
+        if self._getUserTagDb():
+            dirs.append(self._getUserTagDb())
+
+        out = {}
+        for prod in productNames:
+            mtimes = []
+            for dbdir in dirs:
+                pdir = self._productDir(prod, dbdir)
+                if not os.path.isdir(pdir):
+                    continue
+                
+                mtimes.append(os.stat(pdir).st_mtime)
+                for file in os.listdir(pdir):
+                    if not versionFileRe.match(file) and \
+                       not tagFileRe.match(file):
+                        continue
+                    mtimes.append(os.stat(os.path.join(pdir, file)).st_mtime)
+            if mtimes:
+                out[prod] = max(mtimes)
+
+        return out
+
     def isNewerThan(self, timestamp, dbrootdir=None):
         """
         return true if the state of this database is newer than a given time
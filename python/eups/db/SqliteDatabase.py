@@ -0,0 +1,450 @@
+"""
+an implementation of the EUPS database that keeps all of the product
+declarations and (global) tag assignments of a database in a single SQLite
+file rather than in individual version and chain files.
+
+A database directory (ups_db) that contains a file called eups.sqlite3 is
+managed by this implementation; otherwise, the file-based implementation in
+the Database module is used.  Both present the same interface.  The
+functions toSqlite() and fromSqlite() convert a database directory between
+the two formats (see also "eups admin convertDb").
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import contextlib
+import threading
+import sqlite3
+from .VersionFile import VersionFile
+from .ChainFile import ChainFile
+from .Database import _Database, _databases, versionFileRe, tagFileRe
+from eups.utils import isRealFilename, AtomicFile
+
+sqliteFileName = "eups.sqlite3"
+
+# the version of the table layout written by createSqliteDb()
+schemaVersion = 1
+
+# the per-flavor properties stored for each declared version (see VersionFile)
+_versionFields = "productDir ups_dir table_file declarer declared modifier modified".split()
+
+# the properties stored for each tag assignment (see ChainFile)
+_tagFields = "declarer declared modifier modified".split()
+
+_schema = """
+CREATE TABLE meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE versions (
+    product TEXT NOT NULL,
+    version TEXT NOT NULL,
+    flavor TEXT NOT NULL,
+    %s,
+    PRIMARY KEY (product, version, flavor)
+);
+CREATE TABLE tags (
+    tag TEXT NOT NULL,
+    product TEXT NOT NULL,
+    flavor TEXT NOT NULL,
+    version TEXT NOT NULL,
+    %s,
+    PRIMARY KEY (tag, product, flavor)
+);
+CREATE INDEX tags_by_version ON tags (product, version, flavor);
+CREATE TABLE stamps (
+    product TEXT PRIMARY KEY,
+    stamp INTEGER NOT NULL
+);
+""" % (",\n    ".join("%s TEXT" % f for f in _versionFields),
+       ",\n    ".join("%s TEXT" % f for f in _tagFields))
+
+def _connectSqlite(file):
+    # text is read back as native strings; under python 2 sqlite3 would
+    # otherwise return unicode (which e.g. Product takes for its deprecated API)
+    conn = sqlite3.connect(file)
+    conn.text_factory = str
+    return conn
+
+def isSqliteDatabase(dbpath):
+    """
+    return True if the given database directory is managed as an SQLite
+    database.
+    """
+    return os.path.isfile(os.path.join(dbpath, sqliteFileName))
+
+def createSqliteDb(file, generation=0):
+    """
+    create an empty SQLite database file.
+    @param file        the path of the file to create.
+    @param generation  the initial generation number of the database
+    """
+    conn = _connectSqlite(file)
+    try:
+        conn.executescript(_schema)
+        conn.executemany("INSERT INTO meta (name, value) VALUES (?, ?)",
+                         [("schema", str(schemaVersion)),
+                          ("generation", str(generation))])
+        conn.commit()
+    finally:
+        conn.close()
+
+class _SqliteDatabase(_Database):
+    """
+    An interface to a product database recorded in a single SQLite file
+    within the database directory.  Lookups are made via indexed queries,
+    and a list of products passed to declare() is recorded in a single
+    transaction.
+
+    Only the global data are stored in the SQLite file; user tags are still
+    recorded as chain files in the user tag area (see _Database).
+    """
+
+    def __init__(self, dbpath, defStackRoot):
+        """
+        create an instance of a database; see Database() for details"""
+        _Database.__init__(self, dbpath, defStackRoot)
+
+        # the SQLite file holding the data
+        self.dbfile = os.path.join(dbpath, sqliteFileName)
+
+        # each thread gets its own connection
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connectSqlite(self.dbfile)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def _transaction(self):
+        # make the enclosed updates all-or-nothing; transactions may nest,
+        # in which case only the outermost one commits
+        conn = self._connect()
+        self._local.depth += 1
+        try:
+            yield conn
+        except:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.rollback()
+            raise
+        else:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.commit()
+    _transaction = contextlib.contextmanager(_transaction)
+
+    def _query(self, sql, args=()):
+        return self._connect().execute(sql, args).fetchall()
+
+    def _touch(self, conn, productName=None):
+        # increment the generation number and mark the product as changed
+        generation = int(conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]) + 1
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'generation'", (str(generation),))
+        if productName:
+            conn.execute("INSERT OR REPLACE INTO stamps (product, stamp) VALUES (?, ?)",
+                         (productName, generation))
+
+    def getGeneration(self, dbdir=None):
+        if dbdir and dbdir != self.dbpath:
+            return _Database.getGeneration(self, dbdir)
+
+        rows = self._query("SELECT value FROM meta WHERE name = 'generation'")
+        if not rows:
+            return None
+        return int(rows[0][0])
+    getGeneration.__doc__ = _Database.getGeneration.__doc__
+
+    def _bumpGeneration(self, dbdir=None):
+        if dbdir and dbdir != self.dbpath:
+            return _Database._bumpGeneration(self, dbdir)
+
+        with self._transaction() as conn:
+            self._touch(conn)
+
+    def _hasProduct(self, productName):
+        return len(self._query("SELECT 1 FROM versions WHERE product = ? LIMIT 1",
+                               (productName,))) > 0
+
+    def _readVersionFile(self, productName, version):
+        rows = self._query("SELECT flavor, %s FROM versions WHERE product = ? AND version = ?" %
+                           ", ".join(_versionFields), (productName, version))
+        if not rows:
+            return None
+
+        out = VersionFile(self._versionFile(productName, version),
+                          productName, version, readFile=False)
+        for row in rows:
+            info = {}
+            for k, value in zip(_versionFields, row[1:]):
+                if value is not None:
+                    info[k] = value
+
+            # apply the defaults that VersionFile assumes when reading a file
+            if "productDir" not in info:
+                info["productDir"] = None
+            if "table_file" not in info:
+                info["table_file"] = "none"
+            if "ups_dir" not in info and isRealFilename(info["table_file"]):
+                info["ups_dir"] = "none"
+
+            out.info[row[0]] = info
+
+        return out
+
+    def _writeVersionFile(self, versionFile, trimDir=None):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM versions WHERE product = ? AND version = ?",
+                         (versionFile.name, versionFile.version))
+            for flavor in versionFile.getFlavors():
+                info = versionFile.normalizedInfo(flavor, trimDir)
+                conn.execute("INSERT INTO versions (product, version, flavor, %s) VALUES (?, ?, ?, %s)" %
+                             (", ".join(_versionFields), ", ".join(["?"] * len(_versionFields))),
+                             [versionFile.name, versionFile.version, flavor] +
+                             [info.get(k) for k in _versionFields])
+            self._touch(conn, versionFile.name)
+
+    def declare(self, product):
+        with self._transaction():
+            _Database.declare(self, product)
+    declare.__doc__ = _Database.declare.__doc__
+
+    def undeclare(self, product):
+        with self._transaction():
+            return _Database.undeclare(self, product)
+    undeclare.__doc__ = _Database.undeclare.__doc__
+
+    def _findGlobalTags(self, productName, version, flavor):
+        return [r[0] for r in
+                self._query("SELECT tag FROM tags WHERE product = ? AND version = ? AND flavor = ?",
+                            (productName, version, flavor))]
+
+    def findProductNames(self):
+        return [r[0] for r in self._query("SELECT DISTINCT product FROM versions")]
+    findProductNames.__doc__ = _Database.findProductNames.__doc__
+
+    def findVersions(self, productName):
+        return [r[0] for r in self._query("SELECT DISTINCT version FROM versions WHERE product = ?",
+                                          (productName,))]
+    findVersions.__doc__ = _Database.findVersions.__doc__
+
+    def isDeclared(self, productName, version=None, flavor=None):
+        sql = "SELECT 1 FROM versions WHERE product = ?"
+        args = [productName]
+        if version is not None:
+            sql += " AND version = ?"
+            args.append(version)
+        if flavor is not None:
+            sql += " AND flavor = ?"
+            args.append(flavor)
+
+        return len(self._query(sql + " LIMIT 1", args)) > 0
+    isDeclared.__doc__ = _Database.isDeclared.__doc__
+
+    def _globalTagAssignments(self, productName):
+        return [tuple(r) for r in self._query("SELECT tag, version, flavor FROM tags WHERE product = ?",
+                                              (productName,))]
+
+    def _globalChainFile(self, tag, productName):
+        rows = self._query("SELECT flavor, version, %s FROM tags WHERE tag = ? AND product = ?" %
+                           ", ".join(_tagFields), (tag, productName))
+        if not rows:
+            return None
+
+        out = ChainFile(self._tagFile(productName, tag), productName, tag, readFile=False)
+        for row in rows:
+            info = { "version": row[1] }
+            for k, value in zip(_tagFields, row[2:]):
+                if value is not None:
+                    info[k] = value
+            out.info[row[0]] = info
+
+        return out
+
+    def _assignGlobalTag(self, tag, productName, version, flavors):
+        with self._transaction() as conn:
+            chain = self._globalChainFile(tag, productName)
+            if chain is None:
+                chain = ChainFile(self._tagFile(productName, tag), productName, tag,
+                                  readFile=False)
+            chain.setVersion(version, flavors)
+
+            for flavor in flavors:
+                info = chain.info[flavor]
+                conn.execute("INSERT OR REPLACE INTO tags (tag, product, flavor, version, %s) VALUES (?, ?, ?, ?, %s)" %
+                             (", ".join(_tagFields), ", ".join(["?"] * len(_tagFields))),
+                             [tag, productName, flavor, version] + [info.get(k) for k in _tagFields])
+            self._touch(conn, productName)
+
+    def _unassignGlobalTag(self, tag, productNames, flavors):
+        unassigned = False
+        with self._transaction() as conn:
+            for prod in productNames:
+                sql = "DELETE FROM tags WHERE tag = ? AND product = ?"
+                args = [tag, prod]
+                if flavors is not None:
+                    sql += " AND flavor IN (%s)" % ", ".join(["?"] * len(flavors))
+                    args.extend(flavors)
+
+                if conn.execute(sql, args).rowcount > 0:
+                    self._touch(conn, prod)
+                    unassigned = True
+
+        return unassigned
+
+    def getProductStamps(self, productNames=None):
+        if productNames is None:
+            productNames = self.findProductNames()
+
+        # the stamps of all the declared products, in a single query
+        stamps = dict(self._query("SELECT v.product, MAX(IFNULL(s.stamp, 0)) FROM versions v "
+                                  "LEFT JOIN stamps s ON s.product = v.product GROUP BY v.product"))
+        userdb = self._getUserTagDb()
+
+        out = {}
+        for prod in productNames:
+            if prod not in stamps:
+                continue
+
+            # changes to the user tag area are seen via file times
+            mtimes = []
+            if userdb:
+                udir = self._productDir(prod, userdb)
+                if os.path.isdir(udir):
+                    mtimes.append(os.stat(udir).st_mtime)
+                    mtimes.extend(os.stat(os.path.join(udir, f)).st_mtime
+                                  for f in os.listdir(udir) if tagFileRe.match(f))
+            out[prod] = (stamps[prod], mtimes and max(mtimes) or None)
+
+        return out
+    getProductStamps.__doc__ = _Database.getProductStamps.__doc__
+
+    def isNewerThan(self, timestamp, dbrootdir=None):
+        if os.environ.get("_EUPS_ASSUME_CACHES_UP_TO_DATE", "0") == "1":
+            return False
+
+        return os.stat(self.dbfile).st_mtime > timestamp
+    isNewerThan.__doc__ = _Database.isNewerThan.__doc__
+
+def _forgetDatabases(dbpath):
+    # drop the singleton database objects for a directory whose format
+    # has changed
+    for key in list(_databases.keys()):
+        if key[0] == dbpath:
+            del _databases[key]
+
+def toSqlite(dbpath, verbose=0):
+    """
+    convert a file-based database to an SQLite one.  The declarations and
+    global tag assignments are loaded into a new SQLite file, and the
+    version and chain files that they were read from are removed.
+    @param dbpath    the database directory (ups_db) to convert
+    @param verbose   if > 0, print the names of products as they are
+                        converted
+    @return int : the number of products converted
+    """
+    if isSqliteDatabase(dbpath):
+        raise RuntimeError("%s is already an SQLite database" % dbpath)
+
+    filedb = _Database(dbpath, os.path.dirname(dbpath))
+    generation = filedb.getGeneration() or 0
+
+    tmpfile = os.path.join(dbpath, sqliteFileName + ".tmp")
+    if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+    createSqliteDb(tmpfile, generation + 1)
+
+    conn = _connectSqlite(tmpfile)
+    products = filedb.findProductNames()
+    try:
+        for prod in products:
+            if verbose > 0:
+                print("Converting %s" % prod)
+            for version in filedb.findVersions(prod):
+                vf = filedb._readVersionFile(prod, version)
+                for flavor in vf.getFlavors():
+                    info = vf.normalizedInfo(flavor)
+                    conn.execute("INSERT INTO versions (product, version, flavor, %s) VALUES (?, ?, ?, %s)" %
+                                 (", ".join(_versionFields), ", ".join(["?"] * len(_versionFields))),
+                                 [prod, version, flavor] + [info.get(k) for k in _versionFields])
+
+            for tag in _globalTagNames(filedb, prod):
+                cf = filedb._globalChainFile(tag, prod)
+                for flavor in cf.getFlavors():
+                    conn.execute("INSERT INTO tags (tag, product, flavor, version, %s) VALUES (?, ?, ?, ?, %s)" %
+                                 (", ".join(_tagFields), ", ".join(["?"] * len(_tagFields))),
+                                 [tag, prod, flavor, cf.getVersion(flavor)] +
+                                 [cf.info[flavor].get(k) for k in _tagFields])
+
+            conn.execute("INSERT INTO stamps (product, stamp) VALUES (?, ?)", (prod, generation + 1))
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.rename(tmpfile, os.path.join(dbpath, sqliteFileName))
+
+    # the SQLite file now holds the data
+    for prod in products:
+        pdir = filedb._productDir(prod)
+        for file in os.listdir(pdir):
+            if versionFileRe.match(file) or tagFileRe.match(file):
+                os.remove(os.path.join(pdir, file))
+        try:
+            os.rmdir(pdir)
+        except OSError:
+            pass
+
+    _forgetDatabases(dbpath)
+    return len(products)
+
+def fromSqlite(dbpath, verbose=0):
+    """
+    convert an SQLite database to a file-based one.  A version file is
+    written for each declared version and a chain file for each global tag,
+    after which the SQLite file is removed.
+    @param dbpath    the database directory (ups_db) to convert
+    @param verbose   if > 0, print the names of products as they are
+                        converted
+    @return int : the number of products converted
+    """
+    if not isSqliteDatabase(dbpath):
+        raise RuntimeError("%s is not an SQLite database" % dbpath)
+
+    sqldb = _SqliteDatabase(dbpath, os.path.dirname(dbpath))
+    generation = sqldb.getGeneration() or 0
+
+    products = sqldb.findProductNames()
+    for prod in products:
+        if verbose > 0:
+            print("Converting %s" % prod)
+        pdir = sqldb._productDir(prod)
+        if not os.path.exists(pdir):
+            os.mkdir(pdir)
+
+        for version in sqldb.findVersions(prod):
+            sqldb._readVersionFile(prod, version).write()
+
+        for tag in _globalTagNames(sqldb, prod):
+            sqldb._globalChainFile(tag, prod).write()
+
+    fd = AtomicFile(sqldb._generationFile(), "w")
+    fd.write("%d\n" % (generation + 1))
+    fd.close()
+
+    conn = getattr(sqldb._local, "conn", None)
+    if conn is not None:
+        conn.close()
+    os.remove(sqldb.dbfile)
+
+    _forgetDatabases(dbpath)
+    return len(products)
+
+def _globalTagNames(db, productName):
+    out = []
+    for tag, version, flavor in db._globalTagAssignments(productName):
+        if tag not in out:
+            out.append(tag)
+    return out
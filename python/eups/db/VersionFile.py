@@ -432,6 +432,59 @@ class VersionFile(object):
         fd.close()
         
 
+    def normalizedInfo(self, flavor, trimDir=None):
+        """
+        return a copy of the data for a given flavor in the form that it is 
+        written out by write():  paths under trimDir are made relative to 
+        it, and an unset product directory or table file is given as "none".
+
+        @param flavor   the flavor (including any qualifiers) to return 
+                          the data for
+        @param trimDir  strip off this leading directory name from all
+                          paths.
+        @return dict :  the properties, keyed as in the info attribute
+        """
+        # Make sure we correctly identify subpaths
+        if trimDir:
+            trimDir = os.path.realpath(trimDir)
+
+        #
+        # Strip trimDir from directory names
+        #
+        info = self.info[flavor].copy()
+
+        for k in info.keys():
+            value = info[k]
+
+            if os.path.isfile(value) or os.path.isdir(value):
+                if trimDir and eups.utils.isSubpath(value, trimDir):
+                    value = os.path.realpath(value)
+                    if trimDir == value:
+                        pass        # special case: we are setting something to trimDir
+                    else:
+                        info[k] = value[len(trimDir) + 1:]
+
+                        if k.lower() == "table_file":
+                            dirName = info.get("productDir")
+                            if dirName and "ups_dir" in info:
+                                dirName = os.path.join(dirName, info["ups_dir"])
+
+                            if dirName and eups.utils.isSubpath(info[k], dirName):
+                                info[k] = re.sub("^%s/" % dirName, "", info[k])
+
+                if os.path.isabs(info[k]):
+                    if info[k] != trimDir:
+                        print("Warning: path %s is absolute, not relative to EUPS_PATH" % info[k], file=eups.utils.stdwarn)
+
+        for k in list(info.keys()):
+            if not info[k]:
+                if k == "productDir" or k == "table_file":
+                    info[k] = "none"
+                else:
+                    del info[k]
+
+        return info
+
     def write(self, trimDir=None, file=None):
         """
         write the data out to a file.  If this version file contains no
@@ -448,10 +501,6 @@ class VersionFile(object):
             if os.path.exists(file):  os.remove(file)
             return
 
-        # Make sure we correctly identify subpaths
-        if trimDir:
-            trimDir = os.path.realpath(trimDir)
-
         fd = open(file, "w")
 
         print("""FILE = version
@@ -473,33 +522,7 @@ Group:
    QUALIFIERS = "%s"\
 """ % (flavor, qualifier), file=fd)
         
-            #
-            # Strip trimDir from directory names
-            #
-            info = self.info[fq].copy()
-
-            for k in info.keys():
-                value = info[k]
-
-                if os.path.isfile(value) or os.path.isdir(value):
-                    if trimDir and eups.utils.isSubpath(value, trimDir):
-                        value = os.path.realpath(value)
-                        if trimDir == value:
-                            pass        # special case: we are setting something to trimDir
-                        else:
-                            info[k] = value[len(trimDir) + 1:]
-
-                            if k.lower() == "table_file":
-                                dirName = info.get("productDir")
-                                if dirName and "ups_dir" in info:
-                                    dirName = os.path.join(dirName, info["ups_dir"])
-
-                                if dirName and eups.utils.isSubpath(info[k], dirName):
-                                    info[k] = re.sub("^%s/" % dirName, "", info[k])
-
-                    if os.path.isabs(info[k]):
-                        if info[k] != trimDir:
-                            print("Warning: path %s is absolute, not relative to EUPS_PATH" % info[k], file=eups.utils.stdwarn)
+            info = self.normalizedInfo(fq, trimDir)
 
             for field in self._fields:
                 if field == "PROD_DIR":
@@ -508,22 +531,7 @@ Group:
                     k = field.lower()
 
                 if k in info:
-                    value = info[k]
-                            
-                    if not value:
-                        if k == "productDir":
-                            value = "none"
-                        elif k == "table_file":
-                            value = "none"
-                        else:
-                            continue
-
-                    if field.upper() == "TABLE_FILE" and os.path.isabs(value):
-                        if False:
-                            print("Detected absolute table filename (tell RHL): %s" % value, file=eups.utils.stdwarn)
-                        pass
-
-                    print("   %s = %s" % (field.upper(), value), file=fd)
+                    print("   %s = %s" % (field.upper(), info[k]), file=fd)
 
         print("End:", file=fd)
 
@@ -12,6 +12,9 @@ The main classes in this module are:
    ChainFile    an interface into the data about the assignment of a 
                  specific tag to a product, which is stored in a single 
                  file in the database.
+
+A database may instead keep all of its data in a single SQLite file; see 
+the SqliteDatabase module.
 """
 from .VersionFile import VersionFile 
 from .ChainFile import ChainFile
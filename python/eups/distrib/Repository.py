@@ -6,7 +6,8 @@ from __future__ import absolute_import, print_function
 import sys
 import eups
 from eups.tags      import Tag, TagNotRecognized
-from eups.utils     import Flavor, isDbWritable, cmp_or_key, xrange
+from eups.utils     import Flavor, isDbWritable, xrange
+from eups.VersionCompare import versionSortKey
 from eups.exceptions import EupsException, ProductNotFound
 from .server         import ServerConf, Manifest, Mapping, TaggedProductList
 from .server         import LocalTransporter
@@ -156,7 +157,8 @@ class Repository(object):
             lookup[prod]["_sortOrder"] = keys
 
             for flav in lookup[prod]["_sortOrder"]:
-                lookup[prod][flav].sort(**cmp_or_key(self.eups.version_cmp))
+                versions = lookup[prod][flav]
+                versions.sort(key=versionSortKey(self.eups.version_cmp, versions))
 
         return lookup
 
@@ -345,7 +347,8 @@ class Repository(object):
         for name in names:
             for flav in flavors:
                 latest = [p for p in prods if p[0] == name and p[2] == flav]
-                latest.sort(**cmp_or_key(lambda a,b: self.eups.version_cmp(a[1],b[1])))
+                key = versionSortKey(self.eups.version_cmp, [p[1] for p in latest])
+                latest.sort(key=lambda p: key(p[1]))
                 out.extend(latest)
 
         return out
@@ -290,3 +290,18 @@ class OperationForbidden(EupsException):
         """
         EupsException.__init__(self, message)
 
+
+class StaleSnapshot(EupsException):
+    """
+    an exception indicating that a snapshot of a setup (see eups.Snapshot)
+    may no longer be applied, as something that the setup depended on has
+    changed since it was made.
+    """
+
+    def __init__(self, reason):
+        """
+        create the exception
+        @param reason   the description of what has changed
+        """
+        EupsException.__init__(self, "snapshot is out of date: %s" % reason)
+        self.reason = reason
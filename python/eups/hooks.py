@@ -4,6 +4,13 @@ Module that enables user configuration and hooks.
 from __future__ import absolute_import, print_function
 import os
 import re
+import sys
+import copy
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from . import utils
 import eups
 import eups.exceptions
@@ -34,8 +41,11 @@ def defineProperties(names, parentName=None):
 
 # various configuration properties settable by the user
 config = defineProperties("Eups distrib site user")
-config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize", "Eups")
+config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize cacheFormat paranoidCacheCheck lazyStackLoading cacheLoadThreads cacheTables cacheJournalSize cacheSetupPlans recordUnsetup tablePrefetchThreads cacheStartupFiles", "Eups")
 config.Eups.setType("verbose", int)
+config.Eups.setType("cacheLoadThreads", int)
+config.Eups.setType("tablePrefetchThreads", int)
+config.Eups.setType("cacheJournalSize", int)
 
 config.Eups.userTags = []
 config.Eups.defaultTags = dict(pre=[], post=[])
@@ -71,6 +81,68 @@ config.Eups.defaultProduct = {"name" : "implicitProducts", "version" : None, "ta
 
 config.Eups.colorize = False
 #
+# The format of the product cache files: "pickle" (one pickle per flavor) or "indexed" (a product-name
+# index with per-product records that are only decoded when needed; faster to load for large stacks)
+#
+config.Eups.cacheFormat = "pickle"
+#
+# Product caches are normally validated by comparing the generation number recorded in the cache with the one
+# that EUPS updates in the database whenever a product is (un)declared or (un)tagged.  If the database may be
+# modified behind EUPS's back (e.g. by older versions of EUPS), set this to True to check file modification
+# times and the list of declared products instead.
+#
+config.Eups.paranoidCacheCheck = False
+#
+# Read the product cache of each EUPS_PATH directory only when a lookup first needs it, rather than
+# reading them all at startup.  The order in which the directories are searched is unchanged, so a
+# product that is only found late on EUPS_PATH still causes the earlier stacks to be read.
+#
+config.Eups.lazyStackLoading = False
+#
+# The number of threads used to read the product caches of several EUPS_PATH directories at once (e.g. at
+# startup, or for "eups list"); reading is dominated by I/O, so this helps with stacks on network filesystems.
+# The default of 1 reads them one at a time, as the state shared by the stacks' databases and caches isn't
+# protected by locks.
+#
+config.Eups.cacheLoadThreads = 1
+#
+# If true, parsed table files are cached (next to the product cache) and reused until the table file changes
+#
+config.Eups.cacheTables = True
+#
+# Updates to a product cache (e.g. declaring a product) are appended to a journal file next to it rather than
+# rewriting the whole cache; once the journal is larger than this many bytes, the cache is rewritten.  Set to 0
+# to always rewrite the cache.
+#
+config.Eups.cacheJournalSize = 1000000
+#
+# If true, remember how each setup was resolved (the products and versions chosen, and the table actions
+# executed) and replay it the next time the same setup is done, provided that no database or table file involved
+# has changed and the same products are already setup.  Plans aren't saved for tables whose conditions or
+# setupRequired lines refer to environment variables, but a plan does not capture anything else in the
+# environment that a setup might depend on, so this is off by default
+#
+config.Eups.cacheSetupPlans = False
+#
+# If true, record what setting up each product did in an environment variable (EUPS_UNSETUP_<product>), so
+# that unsetup can undo it without finding the product in its stack or reading its table file again
+#
+config.Eups.recordUnsetup = True
+#
+# The number of threads used to read the table files of the products that a setup is about to need, while it
+# is still working on the products that require them (this hides the latency of a network filesystem).
+# Set to 0 to read each table file only when it is needed.
+#
+config.Eups.tablePrefetchThreads = 4
+#
+# If true, the configuration set by the startup files is cached (in the user data directory) and reused
+# without executing them until one of them changes.  Startup files that define callbacks (or anything other
+# than configuration properties) are always executed, but nothing else that a file does (e.g. reading the
+# environment or the time, or writing a file) is repeated when the cache is used, so this is only turned on
+# by setting it in a startup file;  it takes effect from the next command.
+#
+config.Eups.cacheStartupFiles = False
+#
 # Configure things that apply to the entire site
 #
 config.site = defineProperties("lockDirectoryBase", "site")
@@ -182,6 +254,25 @@ def loadCustomization(verbose=0, log=utils.stdinfo, execute=True, quiet=True, pa
         if not reset:
             return customisationFiles
 
+    state = None                        # the state before executing the files, if we may cache their effects
+    if execute:
+        cacheFile = _startupCacheFile()
+        if cacheFile and (config.Eups.cacheStartupFiles or os.path.exists(cacheFile)):
+            # we may be able to use the configuration that these files set last time (the cache is only
+            # written if the files turn on cacheStartupFiles, so they'll set it again if we use it)
+            files = loadCustomization(verbose, log, execute=False, quiet=True, path=path, reset=True,
+                                      filename=filename)
+            signature = _startupSignature(files)
+            if signature is not None:
+                changes = _readStartupCache(files, signature)
+                if changes is not None:
+                    if verbose > 2:
+                        print("using the configuration cached from", " ".join(files), file=log)
+                    _applyStartupChanges(changes)
+                    return customisationFiles
+
+        state = _StartupState()
+
     customisationDirs = []
     customisationFilename = filename
 
@@ -228,9 +319,249 @@ def loadCustomization(verbose=0, log=utils.stdinfo, execute=True, quiet=True, pa
                         raise eups.exceptions.CustomizationError(msg)
                     else:
                         print(msg, file=log)
+                    state = None        # don't cache the results of a broken file
+
+    if state is not None and config.Eups.cacheStartupFiles:
+        changes = state.getChanges()
+        signature = _startupSignature(customisationFiles)
+        if changes is not None and signature is not None:
+            _writeStartupCache(customisationFiles, signature, changes)
 
     return customisationFiles
 
+#
+# The cache of the configuration set by the startup files, kept in the user data directory
+#
+startupCacheFormatVersion = 1
+maxStartupCacheEntries = 10
+
+# the class of the configuration properties (which isn't utils.ConfigProperty if utils has been reloaded)
+_ConfigProperty = type(config)
+
+class _StartupState(object):
+    """
+    the things that executing startup files may change, as they were before the files were executed
+    """
+
+    # module variables that loadCustomization() itself sets
+    _ourVariables = ("customisationDirs", "customisationFiles", "customisationFilename")
+
+    def __init__(self):
+        self.properties = dict([(names, (value, valueCopy)) for names, value, valueCopy in _listConfig(config)])
+        self.fallbackFlavors = copy.deepcopy(getattr(utils.Flavor, "_fallbackFlavors", None))
+        self.nCallbacks = self._getNCallbacks()
+        self.variables = self._getVariables()
+
+    def _getNCallbacks(self):
+        # the number of command callbacks;  there can't be any if eups.cmd hasn't been imported
+        # (and we don't want to import it just to find out)
+        cmd = sys.modules.get("eups.cmd")
+        if cmd is None:
+            return 0
+        return len(cmd.CommandCallbacks.callbacks)
+
+    def _getVariables(self):
+        return dict([(k, id(v)) for k, v in globals().items()
+                     if k not in self._ourVariables and not k.startswith('__')])
+
+    def getChanges(self):
+        """
+        return a list of the changes made to the configuration properties since the state was
+        recorded, or None if anything else has changed (e.g. a callback has been defined)
+        """
+        if self._getNCallbacks() != self.nCallbacks or self._getVariables() != self.variables:
+            return None
+
+        changes = []
+        for names, value, valueCopy in _listConfig(config):
+            if names in self.properties:
+                oldValue, oldCopy = self.properties[names]
+                if value is oldValue:
+                    if isinstance(value, _ConfigProperty):
+                        continue
+                    try:
+                        if value == oldCopy:
+                            continue
+                    except Exception:
+                        pass
+
+            if isinstance(value, _ConfigProperty):
+                attrnames = [a for a in value.__dict__.keys() if not a.startswith('_')]
+                changes.append(("properties", names, (attrnames, value._parent, dict(value._types))))
+            elif callable(value):
+                return None             # a callback
+            else:
+                changes.append(("value", names, value))
+
+        if getattr(utils.Flavor, "_fallbackFlavors", None) != self.fallbackFlavors:
+            changes.append(("fallbackFlavors", (), copy.deepcopy(getattr(utils.Flavor, "_fallbackFlavors", None))))
+
+        try:
+            pickle.dumps(changes, protocol=2)
+        except Exception:
+            return None
+
+        return changes
+
+def _listConfig(prop, names=()):
+    # return the configuration properties in prop and its sub-properties, as a list of
+    # (names, value, copy of value) tuples
+    out = []
+    for name in sorted(prop.__dict__.keys()):
+        if name.startswith('_'):
+            continue
+
+        value = prop.__dict__[name]
+        if isinstance(value, _ConfigProperty):
+            out.append((names + (name,), value, None))
+            out += _listConfig(value, names + (name,))
+        else:
+            try:
+                valueCopy = copy.deepcopy(value)
+            except Exception:
+                valueCopy = None
+            out.append((names + (name,), value, valueCopy))
+
+    return out
+
+def _applyStartupChanges(changes):
+    # make the changes returned by _StartupState.getChanges()
+    for what, names, value in changes:
+        if what == "fallbackFlavors":
+            utils.Flavor._fallbackFlavors = copy.deepcopy(value)
+            continue
+
+        prop = config
+        for name in names[:-1]:
+            prop = getattr(prop, name)
+
+        if what == "properties":
+            attrnames, parentName, types = value
+            value = _ConfigProperty(attrnames, parentName)
+            object.__setattr__(value, '_types', dict(types))
+        else:
+            value = copy.deepcopy(value)
+
+        object.__setattr__(prop, names[-1], value)
+
+def saveConfig():
+    """
+    return the state of the configuration properties (config), which restoreConfig() will
+    reinstate;  this allows changes that e.g. a command makes to the configuration to be undone
+    """
+    state = []
+
+    def save(prop):
+        values = {}
+        for name, value in prop.__dict__.items():
+            if isinstance(value, _ConfigProperty):
+                save(value)
+            else:
+                try:
+                    value = copy.deepcopy(value)
+                except Exception:
+                    pass
+            values[name] = value
+        state.append((prop, values))
+
+    save(config)
+    return state
+
+def restoreConfig(state):
+    """
+    reinstate the configuration properties saved by saveConfig().  The properties are
+    restored in place, so references to them remain valid.  A state may only be restored once
+    """
+    for prop, values in state:
+        prop.__dict__.clear()
+        for name, value in values.items():
+            object.__setattr__(prop, name, value)
+
+def _startupCacheFile():
+    try:
+        return os.path.join(utils.defaultUserDataDir(), "_caches_", "startup.pickle")
+    except RuntimeError:
+        return None
+
+def _startupSignature(files):
+    # return the modification times and sizes of the startup files (and of this file, which sets
+    # the defaults), or None if they can't be determined
+    signature = []
+    for f in [__file__] + [f for f in files if os.path.exists(f)]:
+        try:
+            st = os.stat(f)
+        except OSError:
+            return None
+        signature.append((st.st_mtime, st.st_size))
+
+    return tuple(signature)
+
+def _startupCacheKey(files):
+    # the key of the entry for files in the startup cache.  Each major version of python has its own
+    # entries, as python 2 would read the strings pickled by python 3 as unicode
+    return (sys.version_info[0],) + tuple(files)
+
+def _readStartupCache(files, signature):
+    # return the changes that executing files made last time, or None if they aren't cached
+    cacheFile = _startupCacheFile()
+    if not cacheFile:
+        return None
+
+    try:
+        fd = open(cacheFile, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            data = pickle.load(fd)
+        except Exception:
+            return None
+    finally:
+        fd.close()
+
+    if not isinstance(data, dict) or data.get("version") != startupCacheFormatVersion:
+        return None
+
+    entry = data["entries"].get(_startupCacheKey(files))
+    if entry is None or entry[1] != signature:
+        return None
+
+    return entry[2]
+
+def _writeStartupCache(files, signature, changes):
+    # remember the changes that executing files made.  Failure to write the cache is silently ignored
+    cacheFile = _startupCacheFile()
+    if not cacheFile:
+        return
+
+    entries = {}
+    try:
+        fd = open(cacheFile, "rb")
+        try:
+            data = pickle.load(fd)
+        finally:
+            fd.close()
+        if isinstance(data, dict) and data.get("version") == startupCacheFormatVersion:
+            entries = data["entries"]
+    except Exception:
+        pass
+
+    entries[_startupCacheKey(files)] = (time.time(), signature, changes)
+    if len(entries) > maxStartupCacheEntries:
+        oldest = sorted(entries.keys(), key=lambda k: entries[k][0])
+        for k in oldest[:len(entries) - maxStartupCacheEntries]:
+            del entries[k]
+
+    try:
+        cacheDir = os.path.dirname(cacheFile)
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        fd = utils.AtomicFile(cacheFile, "wb")
+        pickle.dump({"version": startupCacheFormatVersion, "entries": entries}, fd, protocol=2)
+        fd.close()
+    except (IOError, OSError):
+        pass
+
 def execute_file(startupFile):
     import eups
     from eups import hooks
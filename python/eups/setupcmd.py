@@ -18,6 +18,7 @@ import os
 import sys
 from .cmd import EupsOptionParser
 from .exceptions import EupsException
+from .Snapshot import Snapshot
 import eups
 from . import lock
 from . import hooks
@@ -36,7 +37,7 @@ class EupsSetup(object):
 
     """
 
-    usage = "%prog [-h|--help|-V|--version] [options] [product [version]]"
+    usage = "%prog [-h|--help|-V|--version] [options] [product [version]] [--also \"[-j] product [version]\" ...]"
 
     # set this to True if the description is preformatted.  If false, it 
     # will be automatically reformatted to fit the screen
@@ -88,6 +89,9 @@ product and all its dependencies into the environment so that it can be used.
 
     def addOptions(self):
 
+        self.clo.add_option("--also", dest="also", action="append", metavar="SPEC",
+                            help="Also setup the product given by SPEC (\"[-j] product [version]\"), " +
+                            "resolving all the products together (may be repeated)")
         self.clo.add_option("-c", "--current", dest="tag", action="callback", callback=append_current,
                             help="Use the current tag (equivalent to --postTag current)")
         self.clo.add_option("--noCallbacks", dest="noCallbacks", action="store_true",
@@ -101,6 +105,8 @@ product and all its dependencies into the environment so that it can be used.
                             help="Don't use exact matching even though an explicit version is specified")
         self.clo.add_option("-f", "--flavor", dest="flavor", action="store",
                             help="Assume this target platform flavor (e.g. 'Linux')")
+        self.clo.add_option("--from-snapshot", dest="snapshot", action="store", metavar="FILE",
+                            help="Apply the setup saved in FILE by \"eups snapshot\" (if it's up to date)")
         self.clo.add_option("-E", "--inexact", dest="inexact_version", action="store_true", default=False,
                             help="Don't use exact matching even though an explicit version is specified")
         self.clo.add_option("-F", "--force", dest="force", action="store_true", default=False,
@@ -173,6 +179,60 @@ product and all its dependencies into the environment so that it can be used.
             self.opts.exact_version = False
             self.opts.inexact_version = False
 
+        also = []                       # other products to setup at the same time
+        if self.opts.also:
+            if self.opts.snapshot or self.opts.tablefile or self.opts.productDir:
+                self.err("You may not specify --also with --from-snapshot, --table or --root")
+                return 3
+            if not productName:
+                self.err("Please specify a product")
+                print(self.clo.get_usage(), file=utils.stderr)
+                return 3
+
+            for spec in self.opts.also:
+                words = spec.split()
+                just = len(words) > 0 and words[0] in ("-j", "--just")
+                if just:
+                    words.pop(0)
+                if len(words) not in (1, 2):
+                    self.err("Unable to understand --also \"%s\"; expected \"[-j] product [version]\"" %
+                             spec)
+                    return 3
+                also.append((words[0], (words[1:] or [None])[0], just))
+
+        snap = None
+        if self.opts.snapshot:          # we're applying a setup saved by "eups snapshot"
+            if self.opts.unsetup or self.opts.tablefile or self.opts.productDir:
+                self.err("You may not specify --from-snapshot with --unsetup, --table or --root")
+                return 3
+            try:
+                snap = Snapshot.read(self.opts.snapshot)
+            except IOError as e:
+                self.err("Unable to read %s: %s" % (self.opts.snapshot, e))
+                return 3
+            except EupsException as e:
+                e.status = 3
+                raise
+
+            if not productName:
+                productName, versionName = snap.productName, snap.versionName
+            elif productName != snap.productName:
+                self.err("%s is a snapshot of %s, not %s" % (self.opts.snapshot, snap.productName,
+                                                              productName))
+                return 3
+            # if we have to resolve the setup, do so as the snapshot did
+            if not self.opts.tag and not self.opts.postTag:
+                self.opts.tag = snap.tags or None
+                self.opts.postTag = snap.postTags or None
+            #
+            # Check what we can before building an Eups
+            #
+            try:
+                snap.check()
+            except eups.StaleSnapshot as e:
+                self.err("%s: %s; setting up %s in the usual way" % (self.opts.snapshot, e, productName))
+                snap = None
+
         if self.opts.tablefile:         # we're setting up a product based only on a tablefile
             if self.opts.unsetup:
                 self.err("Ignoring --table as I'm unsetting up a product")
@@ -218,7 +278,8 @@ product and all its dependencies into the environment so that it can be used.
             if self.opts.max_depth > 0:
                 self.err("You may not specify both --just and --max_depth")
                 return 3
-            self.opts.max_depth = 0
+            if not also:                # with --also, -j only applies to productName
+                self.opts.max_depth = 0
 
         path = eups.Eups.setEupsPath(self.opts.path, self.opts.dbz)
         locks = lock.takeLocks("setup", path, lock.LOCK_SH,
@@ -250,7 +311,10 @@ product and all its dependencies into the environment so that it can be used.
                         e.status = 9
                         raise
 
-                Eups.selectVRO(self.opts.tag, self.opts.productDir, versionName, self.opts.dbz,
+                vroVersionName = versionName
+                if not vroVersionName:  # the VRO is shared by all the products
+                    vroVersionName = ([v for n, v, j in also if v] or [None])[0]
+                Eups.selectVRO(self.opts.tag, self.opts.productDir, vroVersionName, self.opts.dbz,
                                inexact_version=self.opts.inexact_version, postTag=self.opts.postTag)
 
                 if self.opts.tag:
@@ -262,22 +326,37 @@ product and all its dependencies into the environment so that it can be used.
                 for user in Eups.tags.owners.values():
                     Eups.includeUserDataDirInPath(eups.utils.defaultUserDataDir(user))
                 #
-                # If they specify a productDir in addition to a complete product + version specification
-                # Use that product + version's expanded table file, but this directory
+                # Apply the snapshot if it's up to date;  if not, resolve the setup as usual
                 #
-                if self.opts.productDir and not self.opts.tablefile and productName and versionName:
-                    prod = Eups.findProduct(productName, versionName)
-                    if not prod:
-                        self.err("Unable to find %s %s" % (productName, versionName))
-                        return 3
-
-                    tablefile = prod.tablefile
-                else:
-                    tablefile=self.opts.tablefile
-
-                cmds = eups.setup(productName, versionName, self.opts.tag, self.opts.productDir,
-                                  Eups, fwd=not self.opts.unsetup, tablefile=tablefile,
-                                  postTags=self.opts.postTag)
+                cmds = None
+                if snap:
+                    try:
+                        cmds = eups.setupFromSnapshot(snap, Eups)
+                    except eups.StaleSnapshot as e:
+                        self.err("%s: %s; setting up %s in the usual way" %
+                                 (self.opts.snapshot, e, productName))
+                if cmds is None and also:
+                    cmds = eups.setup([(productName, versionName, self.opts.nodepend)] + also,
+                                      None, self.opts.tag, None,
+                                      Eups, fwd=not self.opts.unsetup, postTags=self.opts.postTag)
+                if cmds is None:
+                    #
+                    # If they specify a productDir in addition to a complete product + version specification
+                    # Use that product + version's expanded table file, but this directory
+                    #
+                    if self.opts.productDir and not self.opts.tablefile and productName and versionName:
+                        prod = Eups.findProduct(productName, versionName)
+                        if not prod:
+                            self.err("Unable to find %s %s" % (productName, versionName))
+                            return 3
+
+                        tablefile = prod.tablefile
+                    else:
+                        tablefile=self.opts.tablefile
+
+                    cmds = eups.setup(productName, versionName, self.opts.tag, self.opts.productDir,
+                                      Eups, fwd=not self.opts.unsetup, tablefile=tablefile,
+                                      postTags=self.opts.postTag)
 
             except EupsException as e:
                 e.status = 1
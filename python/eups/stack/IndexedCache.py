@@ -0,0 +1,168 @@
+"""
+an indexed, memory-mappable file format for caching the products of a
+single flavor of a ProductStack.
+
+A cache file in this format starts with a short header giving a magic
+string and the length of a product-name index.  The index (itself a small
+pickled dictionary) maps each product name to the location of its
+ProductFamily record within the file; each record is a separately pickled
+ProductFamily.  The records may be followed by an optional pickled
+dictionary of metadata about the cache.  When a cache file is read, only
+the header, the index, and the metadata are decoded; a ProductFamily is
+unpickled only when it is first accessed.  This makes loading a cache proportional to the number of products actually
+used rather than to the size of the stack.
+"""
+from __future__ import absolute_import
+import os
+import mmap
+import struct
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+# the magic string that starts every indexed cache file
+magic = b"EUPSIDX1"
+
+# the format of the header that follows the magic string:  the length of the
+# pickled index
+_headerFmt = ">Q"
+_headerLen = len(magic) + struct.calcsize(_headerFmt)
+
+def isIndexedCache(file):
+    """
+    return True if the given file appears to be a cache file written in
+    the indexed format.
+    """
+    fd = open(file, "rb")
+    try:
+        return fd.read(len(magic)) == magic
+    finally:
+        fd.close()
+
+class IndexedCache(MutableMapping):
+    """
+    a dictionary of ProductFamily instances, keyed by product name, that
+    is backed by a memory-mapped cache file in the indexed format.  Each
+    family is decoded from the file the first time it is looked up;
+    families that are added or replaced are held in memory only (until
+    the cache is written out again).
+    """
+
+    def __init__(self, file):
+        """
+        open a cache file for reading
+        @param file    the path to the cache file written by write()
+        """
+        self.file = file
+
+        # the decoded (or newly added) ProductFamily instances, by name
+        self._loaded = {}
+
+        fd = open(file, "rb")
+        try:
+            self._mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+        if self._mm[:len(magic)] != magic:
+            raise IOError("%s: not an indexed product cache file" % file)
+        idxlen = struct.unpack(_headerFmt, self._mm[len(magic):_headerLen])[0]
+
+        # the location of each encoded record in the file:  a lookup of
+        # (offset, length) tuples by product name, where the offset is
+        # relative to the end of the index.
+        self._index = pickle.loads(self._mm[_headerLen:_headerLen+idxlen])
+        self._dataStart = _headerLen + idxlen
+
+        # metadata stored along with the product data
+        self.meta = {}
+        dataEnd = self._dataStart + sum([l for o, l in self._index.values()])
+        if dataEnd < len(self._mm):
+            self.meta = pickle.loads(self._mm[dataEnd:])
+
+    def __getitem__(self, name):
+        try:
+            return self._loaded[name]
+        except KeyError:
+            pass
+
+        family = pickle.loads(self._rawRecord(name))   # raises KeyError
+        self._loaded[name] = family
+        return family
+
+    def __setitem__(self, name, family):
+        self._loaded[name] = family
+
+    def __delitem__(self, name):
+        found = self._index.pop(name, None) is not None
+        if self._loaded.pop(name, None) is not None:
+            found = True
+        if not found:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._loaded or name in self._index
+
+    def __iter__(self):
+        for name in self._index:
+            yield name
+        for name in self._loaded:
+            if name not in self._index:
+                yield name
+
+    def __len__(self):
+        return len(self._index) + \
+            len([n for n in self._loaded if n not in self._index])
+
+    def isLoaded(self, name):
+        """
+        return True if the ProductFamily for the named product has been
+        decoded (or was added since the file was read).
+        """
+        return name in self._loaded
+
+    def _rawRecord(self, name):
+        # return the encoded record for a product as it appears in the file
+        offset, length = self._index[name]
+        start = self._dataStart + offset
+        return self._mm[start:start+length]
+
+    def write(fd, families, meta=None):
+        """
+        write a dictionary of ProductFamily instances to an open file in
+        the indexed format.
+        @param fd        the file object to write to (opened in binary mode)
+        @param families  a dictionary of ProductFamily instances keyed by
+                           product name.  If this is an IndexedCache, the
+                           records of families that have not been decoded
+                           are copied without being unpickled.
+        @param meta      a dictionary of metadata to store with the 
+                           families.  If None, none is written.
+        """
+        index = {}
+        records = []
+        offset = 0
+        for name in sorted(families.keys()):
+            if isinstance(families, IndexedCache) and \
+               not families.isLoaded(name):
+                rec = families._rawRecord(name)
+            else:
+                rec = pickle.dumps(families[name], protocol=2)
+            index[name] = (offset, len(rec))
+            records.append(rec)
+            offset += len(rec)
+
+        idx = pickle.dumps(index, protocol=2)
+        fd.write(magic)
+        fd.write(struct.pack(_headerFmt, len(idx)))
+        fd.write(idx)
+        for rec in records:
+            fd.write(rec)
+        if meta is not None:
+            pickle.dump(meta, fd, protocol=2)
+    write = staticmethod(write)
@@ -0,0 +1,135 @@
+"""
+a dictionary of ProductStacks that loads each stack only when it is first
+needed.
+"""
+from __future__ import absolute_import
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+class LazyStacks(MutableMapping):
+    """
+    a dictionary of ProductStack instances keyed by EUPS_PATH directory.  A
+    stack may be added either directly or as a function that loads it (see
+    addLoader()); in the latter case, the function is called the first time
+    the stack is looked up.  A directory with a loader counts as a key (so
+    "dir in stacks" does not load anything), and keys are kept in the order
+    they were added.
+    """
+
+    def __init__(self):
+        # the loaded stacks, by directory
+        self._stacks = {}
+
+        # the functions that will load the stacks not yet loaded
+        self._loaders = {}
+
+        # the directories, in the order they were added
+        self._order = []
+
+        # the directories whose stacks have been loaded via their loaders,
+        # in the order they were loaded
+        self.loaded = []
+
+    def addLoader(self, dir, loader):
+        """
+        register a function that loads the stack for a directory.  Any
+        stack already set for the directory is forgotten.
+        @param dir     the EUPS_PATH directory
+        @param loader  a function taking no arguments that returns the
+                          ProductStack for dir
+        """
+        if dir in self._stacks:
+            del self._stacks[dir]
+        if dir not in self._order:
+            self._order.append(dir)
+        self._loaders[dir] = loader
+
+    def isLoaded(self, dir):
+        """
+        return True if the stack for the given directory is in memory
+        """
+        return dir in self._stacks
+
+    def load(self, dir):
+        """
+        make sure that the stack for the given directory is loaded,
+        returning it.
+        """
+        return self[dir]
+
+    def loadAll(self, dirs=None, nthread=1):
+        """
+        load the stacks that are not yet loaded.  Several threads may be 
+        used so that the (largely I/O-bound) loading of different stacks 
+        overlaps; the loaded stacks are recorded in the order of dirs 
+        regardless.
+        @param dirs      the directories whose stacks should be loaded.  If 
+                            None, load the stacks of all directories, in 
+                            the order they were added.
+        @param nthread   the maximum number of threads to use
+        """
+        if dirs is None:
+            dirs = self._order
+
+        toload = []
+        for dir in dirs:
+            if dir in self._loaders and dir not in toload:
+                toload.append(dir)
+
+        if nthread <= 1 or len(toload) <= 1:
+            for dir in toload:
+                self.load(dir)
+            return
+
+        from multiprocessing.pool import ThreadPool # only needed here, and slow to import
+
+        loaders = [self._loaders[dir] for dir in toload]
+        pool = ThreadPool(min(nthread, len(toload)))
+        try:
+            stacks = pool.map(lambda loader: loader(), loaders)
+        finally:
+            pool.close()
+            pool.join()
+
+        for dir, stack in zip(toload, stacks):
+            del self._loaders[dir]
+            self._stacks[dir] = stack
+            self.loaded.append(dir)
+
+    def __getitem__(self, dir):
+        try:
+            return self._stacks[dir]
+        except KeyError:
+            pass
+
+        stack = self._loaders[dir]()    # raises KeyError
+        del self._loaders[dir]
+        self._stacks[dir] = stack
+        self.loaded.append(dir)
+
+        return stack
+
+    def __setitem__(self, dir, stack):
+        if dir in self._loaders:
+            del self._loaders[dir]
+        if dir not in self._order:
+            self._order.append(dir)
+        self._stacks[dir] = stack
+
+    def __delitem__(self, dir):
+        if dir not in self._order:
+            raise KeyError(dir)
+        self._order.remove(dir)
+        self._stacks.pop(dir, None)
+        self._loaders.pop(dir, None)
+
+    def __contains__(self, dir):
+        return dir in self._stacks or dir in self._loaders
+
+    def __iter__(self):
+        return iter(list(self._order))
+
+    def __len__(self):
+        return len(self._order)
@@ -1,9 +1,36 @@
 import os
+try:
+    from sys import intern
+except ImportError:
+    pass                                # a builtin in python 2
 from eups import utils
 from eups.Product import Product
 import eups.tags
 from eups.exceptions import ProductNotFound, TableFileNotFound
 from eups.table import Table
+from eups.VersionCompare import VersionIndex
+
+# the prefix marking a table file path that is recorded relative to the 
+# product's installation directory (see _packTablefile())
+prodDirPrefix = "$PROD_DIR/"
+
+def _packTablefile(installdir, tablefile):
+    # return the form of a table file path to record for a version.  The
+    # usual table file, under the installation directory, is recorded as an 
+    # interned path relative to it; as this is the same for every version 
+    # of a product, a single string is shared (in memory and in pickled 
+    # caches) by all of them.
+    if installdir and tablefile:
+        installdir = installdir.rstrip("/")
+        if installdir and tablefile.startswith(installdir + "/"):
+            return intern(prodDirPrefix + tablefile[len(installdir)+1:])
+    return tablefile
+
+def _unpackTablefile(installdir, tablefile):
+    # return the table file path recorded by _packTablefile()
+    if tablefile and tablefile.startswith(prodDirPrefix):
+        return installdir.rstrip("/") + "/" + tablefile[len(prodDirPrefix):]
+    return tablefile
 
 class ProductFamily(object):
     """
@@ -22,19 +49,78 @@ class ProductFamily(object):
         # a lookup for version-specific information where the keys are the 
         # version names and the values are tuples containing the installation 
         # directory, the dependencies table, and a corresponding instance of
-        # Table (which may be None).
+        # Table (which may be None).  The path to the table file is recorded 
+        # in a compact form (see _packTablefile()).
         self.versions = {}
 
         # a lookup of tag assignments where each key is a tag name and its 
         # value is the version name assigned to the tag.
         self.tags = {}
 
+        # the reverse of the tags lookup:  each key is a version name and its
+        # value is the list of tag names assigned to it.  This is kept in 
+        # step with self.tags by assignTag() and unassignTag().
+        self.versionTags = {}
+
+        # the version names sorted by a version comparator (a VersionIndex), 
+        # or None if they haven't been sorted since they last changed (see 
+        # getVersionIndex()).
+        self._versionIndex = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the index is pickled as plain data (so that older versions of EUPS
+        # can still read the cache), and only if another process can tell 
+        # whether it was sorted by the comparator it's using
+        index = self._versionIndex
+        if index is not None:
+            if index.isPersistent():
+                state["_versionIndex"] = (index.sortOrder, index.versions)
+            else:
+                state["_versionIndex"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "versionTags" not in state:
+            # unpickled from a cache written before the reverse lookup 
+            # was added
+            self.versionTags = {}
+            for tag, version in self.tags.items():
+                self.versionTags.setdefault(version, []).append(tag)
+
+        index = state.get("_versionIndex")
+        if index is not None:
+            index = VersionIndex(*index)
+        self._versionIndex = index
+
     def getVersions(self):
         """
         return a list containing the verison names in this product family
         """
         return list(self.versions.keys())
 
+    def getVersionIndex(self, versionCmp):
+        """
+        return the version names in this product family as a VersionIndex 
+        sorted by versionCmp (e.g. hooks.version_cmp).  The index is 
+        remembered (and persisted with the stack cache) until a version is
+        added or removed, or it is asked for with a different comparator.
+        """
+        if self._versionIndex is None or \
+           not self._versionIndex.isSortedBy(versionCmp):
+            self._versionIndex = VersionIndex.build(versionCmp, 
+                                                    self.getVersions())
+        return self._versionIndex
+
+    def getLatestVersion(self, versionCmp):
+        """
+        return the name of the latest version in this product family, as 
+        sorted by versionCmp (e.g. hooks.version_cmp), or None if there 
+        are no versions
+        """
+        return self.getVersionIndex(versionCmp).latest()
+
     def getProduct(self, version, dbpath=None, flavor=None):
         """
         return the Product of the requested version or None if not found.
@@ -47,11 +133,10 @@ class ProductFamily(object):
         """
         try:
             versdata = self.versions[version]
-            tags = [item[0] for item in [x for x in self.tags.items() if x[1] == version]]
             out = Product(self.name, version, flavor, 
                           versdata[0],    # the install directory
-                          versdata[1],    # the table file
-                          tags, dbpath)
+                          _unpackTablefile(versdata[0], versdata[1]), # the table file
+                          self.versionTags.get(version), dbpath)
             if versdata[2]:
                 out._table = versdata[2]
             return out
@@ -66,6 +151,12 @@ class ProductFamily(object):
         """
         return list(self.tags.keys())
 
+    def getTagsFor(self, version):
+        """
+        return a list of the tag names assigned to a given version
+        """
+        return list(self.versionTags.get(version, []))
+
     def isTagAssigned(self, tag):
         """
         return true if the give tag is currently assigned to a version
@@ -137,7 +228,10 @@ class ProductFamily(object):
             msg = "Missing version name while registering new version " + \
                 "for product %s: %s"
             raise RuntimeError(msg % (self.name, version))
-        self.versions[version] = (installdir, tablefile, table)
+        if version not in self.versions:
+            self._versionIndex = None
+        self.versions[version] = (installdir, 
+                                  _packTablefile(installdir, tablefile), table)
 
     def hasVersion(self, version):
         """
@@ -156,10 +250,10 @@ class ProductFamily(object):
         @return bool :
         """
         if self.hasVersion(version):
-            itsTags = [y[0] for y in [x for x in self.versions.items() if x[1] == version]]
-            for tag in itsTags:
+            for tag in self.getTagsFor(version):
                 self.unassignTag(tag)
             del self.versions[version]
+            self._versionIndex = None
             return True
         else:
             return False
@@ -177,7 +271,9 @@ class ProductFamily(object):
             raise ProductNotFound(self.name, version)
 
         tag = str(tag)
+        self.unassignTag(tag)
         self.tags[tag] = version
+        self.versionTags.setdefault(version, []).append(tag)
 
     def unassignTag(self, tag, file=None):
         """
@@ -189,7 +285,13 @@ class ProductFamily(object):
         @return bool :  false if the tag was not previously assigned
         """
         if tag in self.tags:
-            del self.tags[tag]
+            version = self.tags.pop(tag)
+            tags = self.versionTags.get(version)
+            if tags is not None:
+                if tag in tags:
+                    tags.remove(tag)
+                if not tags:
+                    del self.versionTags[version]
             return True
         else:
             return False
@@ -208,12 +310,13 @@ class ProductFamily(object):
         try:
             verdata = self.versions[version]
             if not table:
-                if not utils.isRealFilename(verdata[1]):
+                tablefile = _unpackTablefile(verdata[0], verdata[1])
+                if not utils.isRealFilename(tablefile):
                     return
-                if not os.path.exists(verdata[1]):
-                    raise TableFileNotFound(verdata[1], self.name, version)
+                if not os.path.exists(tablefile):
+                    raise TableFileNotFound(tablefile, self.name, version)
                 prod = self.getProduct(version)
-                table = Table(verdata[1]).expandEupsVariables(prod)
+                table = Table(tablefile).expandEupsVariables(prod)
             self.versions[version] = (verdata[0], verdata[1], table)
         except KeyError:
             raise ProductNotFound(self.name, version)
@@ -226,3 +329,11 @@ class ProductFamily(object):
         for ver in self.getVersions():
             self.loadTableFor(ver)
 
+    def unloadTables(self):
+        """
+        forget the parsed tables cached into memory by loadTableFor()
+        """
+        for ver, verdata in self.versions.items():
+            if verdata[2] is not None:
+                self.versions[ver] = (verdata[0], verdata[1], None)
+
@@ -1,14 +1,19 @@
 from __future__ import absolute_import, print_function
 import re, os, sys
+import struct
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 from eups import utils
 from eups import Product
+from eups import hooks
 from .ProductFamily import ProductFamily
+from .IndexedCache import IndexedCache, isIndexedCache
+from .TableCache import TableCache
 from eups.exceptions import EupsException,ProductNotFound, UnderSpecifiedProduct
 from eups.db import Database
+from eups.VersionCompare import sortOrderId
 from ..utils import xrange
 
 # Issues:
@@ -59,7 +64,26 @@ class ProductStack(object):
     # static variable: name of file extension to use to persist data
     userTagFileExt = "pickleTag%s" % dotre.sub('_', persistVersionName)
 
-    def __init__(self, dbpath, persistDir=None, autosave=True):
+    # static variable: name of file extension to use to persist data in 
+    # the indexed format (see IndexedCache)
+    indexFileExt = "indexDB%s" % dotre.sub('_', persistVersionName)
+
+    # static variable: the file extensions used by the supported cache 
+    # formats, by format name
+    cacheFileExts = { "pickle": persistFileExt, "indexed": indexFileExt }
+
+    # static variable: regexp for cache file names in any supported format
+    cacheFileRe = re.compile(r'^(\w\S*)\.(%s)$' % "|".join(cacheFileExts.values()))
+
+    # static variable: name of file extension of the journal of updates 
+    # made to a cache file since it was written (see save())
+    journalFileExt = "journalDB%s" % dotre.sub('_', persistVersionName)
+
+    # static variable: name of the file to persist parsed table files to
+    # (see TableCache)
+    tableCacheFile = "tables.tableDB%s" % dotre.sub('_', persistVersionName)
+
+    def __init__(self, dbpath, persistDir=None, autosave=True, cacheFormat=None):
         """
         create the stack with a given database
         @param dbpath             the path to the ups_db directory
@@ -68,6 +92,10 @@ class ProductStack(object):
                                      directory.
         @param autosave           if true (default), all updates will be 
                                      saved to disk.
+        @param cacheFormat        the format to persist the cache in, either
+                                     "pickle" or "indexed".  If None, the 
+                                     value of hooks.config.Eups.cacheFormat
+                                     is used.
         """
         # the path to the ups_db directory
         self.dbpath = dbpath
@@ -93,6 +121,19 @@ class ProductStack(object):
         # pending
         self.updated = []
 
+        # the changes to each updated flavor, as a lookup by flavor of lists 
+        # of journal records (see _applyJournalRecord()).  The value is None 
+        # for a flavor that has changed in a way that can only be saved by
+        # rewriting its cache file.
+        self.pending = {}
+
+        # a lookup by cache file name of the identifier recorded in the 
+        # cache file that a journal must carry to apply to it (None if
+        # the cache file may not be journaled to), and of the size of the 
+        # journal when the data was loaded or last saved.
+        self.journalIds = {}
+        self.journalSizes = {}
+
         # a lookup of modification times for the underlying cachefiles 
         # by cachefile name when data was loaded in from this cache.  
         # If a target cache file has been updated since then, we should
@@ -116,9 +157,38 @@ class ProductStack(object):
         # the values at the bottom are version names
         self.usertags = {}
 
+        # the state of the database when the product data for each flavor 
+        # was read from it, as a lookup by flavor of the product stamps 
+        # returned by Database.getProductStamps().  This is persisted along
+        # with the product data so that a cache can be brought up to date by 
+        # re-reading only the products that have changed.
+        self.stamps = {}
+
+        # the generation numbers of the database (and user tag area) when 
+        # the product data for each flavor was read from it, as a lookup by
+        # flavor of the dictionaries returned by _getGenerations().
+        # This is persisted along with the product data so that a cache can 
+        # be validated without scanning the database.
+        self.generations = {}
+
+        # the flavors whose product data was read from a cache written by
+        # another major version of python, whose strings python 2 reads as
+        # unicode;  such data is replaced by that read from the database
+        self.foreignFlavors = set()
+
+        # the cache of parsed table files; created when first needed
+        self._tableCache = None
+
         # True if python is new enough to pickle the cache data
         self.canCache = utils.canPickle()
 
+        # the format used when persisting the cache
+        if cacheFormat is None:
+            cacheFormat = hooks.config.Eups.cacheFormat
+        if cacheFormat not in self.cacheFileExts:
+            raise RuntimeError("Unsupported product cache format: " + 
+                               str(cacheFormat))
+        self.cacheFormat = cacheFormat
 
     def getDbPath(self):
         """
@@ -169,6 +239,20 @@ class ProductStack(object):
         except KeyError:
           return []
 
+    def getVersionIndex(self, productName, flavor, versionCmp):
+        """
+        return the versions declared for a product as a VersionIndex sorted 
+        by versionCmp (see ProductFamily.getVersionIndex()), or None if the 
+        product is not declared for the flavor
+        @param productName   the name of the product of interest
+        @param flavor        the flavor to search
+        @param versionCmp    the version comparator, e.g. hooks.version_cmp
+        """
+        try:
+            return self.lookup[flavor][productName].getVersionIndex(versionCmp)
+        except KeyError:
+            return None
+
     def hasProduct(self, name, flavor=None, version=None):
         """
         return true if a desired product is registered.
@@ -213,16 +297,35 @@ class ProductStack(object):
             raise ProductNotFound(name, version, flavor)
 
     # @staticmethod   # requires python 2.4
-    def persistFilename(flavor):
-        return "%s.%s" % (flavor, ProductStack.persistFileExt)
+    def persistFilename(flavor, cacheFormat="pickle"):
+        return "%s.%s" % (flavor, ProductStack.cacheFileExts[cacheFormat])
     persistFilename = staticmethod(persistFilename)  # works since python 2.2
 
+    def journalFilename(flavor):
+        return "%s.%s" % (flavor, ProductStack.journalFileExt)
+    journalFilename = staticmethod(journalFilename)  # works since python 2.2
+
+    def _journalPath(self, file):
+        # the journal that goes with a cache file
+        mat = self.cacheFileRe.match(os.path.basename(file))
+        if not mat:
+            return "%s.%s" % (file, self.journalFileExt)
+        return os.path.join(os.path.dirname(file), 
+                            self.journalFilename(mat.group(1)))
+
     def save(self, flavors=None, dir=None):
         """
         persist the product information to disk.  If a cache file for a 
         flavor is newer than when we loaded from it last, that flavor 
         will not be saved, and a RuntimeError will be raised.  Other flavors,
         will be saved, though.
+
+        Rather than rewriting the cache file of a flavor, the individual 
+        updates made since it was loaded (such as added products and tag 
+        assignments) are appended to a journal file next to it, which is
+        replayed when the cache is next read (see reload()).  Once the 
+        journal grows beyond hooks.config.Eups.cacheJournalSize bytes, the
+        cache file is rewritten and the journal removed.
         @param flavors  the flavors to persist.  This can be a single string 
                            (for a single flavor) or a list of flavors.  If 
                            None, save all flavors that appear to need updating
@@ -242,16 +345,112 @@ class ProductStack(object):
                 outofsync.append(file)
                 continue
 
-            self.persist(flavor, file)
+            records = None
+            if dir is None:
+                records = self.pending.get(flavor)
+            if records is None or not self._appendJournal(file, records):
+                self.persist(flavor, file)
             if dir is None:
                 self.updated = [x for x in self.updated if x != flavor]
+                self.pending.pop(flavor, None)
 
         if len(outofsync) > 0:
             raise CacheOutOfSync(outofsync)
 
     def _cacheFileIsInSync(self, file):
-        return (file not in self.modtimes or 
-                os.stat(file).st_mtime <= self.modtimes[file])
+        if file not in self.modtimes:
+            return True
+        return os.stat(file).st_mtime <= self.modtimes[file] and \
+            _fileSize(self._journalPath(file)) == self.journalSizes.get(file, 0)
+
+    def _appendJournal(self, file, records):
+        # append journal records to the journal of a cache file, returning 
+        # False if the cache file should be rewritten instead
+        journalId = self.journalIds.get(file)
+        maxsize = hooks.config.Eups.cacheJournalSize
+        if journalId is None or not maxsize or not os.path.exists(file):
+            return False
+
+        size = self.journalSizes.get(file, 0)
+        data = [_encodeRecord(r) for r in records]
+        if size == 0:
+            data.insert(0, _encodeRecord(("journal", journalId)))
+        data = b"".join(data)
+        if size + len(data) > maxsize:
+            return False
+
+        # each update is a single write to the end of the file, so that a 
+        # reader sees either all of it or (if it reads at the same time) 
+        # a truncated last record, which it ignores.
+        fd = open(self._journalPath(file), "ab")
+        try:
+            fd.write(data)
+        finally:
+            fd.close()
+        self.journalSizes[file] = size + len(data)
+        return True
+
+    def _replayJournal(self, flavor, file):
+        # apply the updates recorded in the journal of a cache file that 
+        # has just been read
+        journal = self._journalPath(file)
+        size = _fileSize(journal)
+        self.journalSizes[file] = size
+        if not size:
+            return
+
+        fd = open(journal, "rb")
+        try:
+            data = fd.read(size)
+        finally:
+            fd.close()
+
+        records, complete = _decodeRecords(data)
+        if not records or records[0] != ("journal", self.journalIds.get(file)):
+            # a journal left over from an earlier version of the cache file; 
+            # the cache file gets rewritten (and the journal removed) the 
+            # next time it is saved
+            self.journalIds[file] = None
+            return
+        if not complete:
+            # the last update is being written as we read (or its writing
+            # was never finished); don't add to this journal
+            self.journalIds[file] = None
+
+        for record in records[1:]:
+            self._applyJournalRecord(flavor, record)
+
+    def _applyJournalRecord(self, flavor, record):
+        # apply an update recorded in a journal.  The records are tuples 
+        # whose first item names the update:
+        #   ("add", product, version, dir, tablefile, tags)
+        #   ("remove", product, version)
+        #   ("tag", tag, product, version)
+        #   ("untag", tag, product)
+        #   ("journal", id)   -- identifies the cache file (first record only)
+        op = record[0]
+        lookup = self.lookup.setdefault(flavor, {})
+        try:
+            if op == "add":
+                name, version, dir, tablefile, tags = record[1:]
+                if name not in lookup:
+                    lookup[name] = ProductFamily(name)
+                lookup[name].addVersion(version, dir, tablefile)
+                for tag in tags:
+                    lookup[name].assignTag(tag, version)
+            elif op == "remove":
+                name, version = record[1:]
+                if lookup[name].removeVersion(version) and \
+                   len(lookup[name].getVersions()) == 0:
+                    del lookup[name]
+            elif op == "tag":
+                tag, name, version = record[1:]
+                lookup[name].assignTag(tag, version)
+            elif op == "untag":
+                tag, name = record[1:]
+                lookup[name].unassignTag(tag)
+        except (KeyError, ProductNotFound):
+            pass
 
     def cacheIsInSync(self, flavors=None):
         """
@@ -277,8 +476,22 @@ class ProductStack(object):
                 dir = self.dbpath
         return dir
 
+    def getTableCache(self):
+        """
+        return the TableCache holding the parsed table files of this 
+        stack's products, or None if table caching is turned off (via
+        hooks.config.Eups.cacheTables) or not possible.
+        """
+        if not hooks.config.Eups.cacheTables or not self.canCache:
+            return None
+        if self._tableCache is None:
+            self._tableCache = \
+                TableCache(os.path.join(self._persistDir(), self.tableCacheFile))
+        return self._tableCache
+
     def _persistPath(self, flavor, dir=None):
-        return os.path.join(self._persistDir(dir), self.persistFilename(flavor))
+        return os.path.join(self._persistDir(dir), 
+                            self.persistFilename(flavor, self.cacheFormat))
 
     def persist(self, flavor, file=None):
         """
@@ -292,17 +505,52 @@ class ProductStack(object):
             dir = self.persistDir
             if not dir:
                 dir = self.dbpath
-            file = os.path.join(dir, persistFilename(flavor))
+            file = os.path.join(dir, 
+                                self.persistFilename(flavor, self.cacheFormat))
 
         if flavor not in self.lookup:
             self.lookup[flavor] = {}
         flavorData = self.lookup[flavor]
 
+        meta = {}
+        if flavor in self.stamps:
+            meta["stamps"] = self.stamps[flavor]
+        if flavor in self.generations:
+            meta["generations"] = self.generations[flavor]
+        # python 2 unpickles the strings written by python 3 as unicode
+        meta["python"] = sys.version_info[0]
+
+        # sort the versions of the products that have been read, so that 
+        # readers of the file needn't (see ProductFamily.getVersionIndex())
+        if sortOrderId(hooks.version_cmp) is not None:
+            for name in flavorData:
+                if not isinstance(flavorData, IndexedCache) or \
+                   flavorData.isLoaded(name):
+                    flavorData[name].getVersionIndex(hooks.version_cmp)
+
+        # identify this version of the file, so that a journal written for
+        # an earlier version is not applied to it
+        import uuid
+        meta["journal"] = uuid.uuid4().hex
+
         fd = utils.AtomicFile(file, "wb")
-        pickle.dump(flavorData, fd, protocol=2)
+        if self.cacheFormat == "indexed":
+            IndexedCache.write(fd, flavorData, meta)
+        else:
+            if isinstance(flavorData, IndexedCache):
+                flavorData = dict(flavorData.items())
+            pickle.dump(flavorData, fd, protocol=2)
+            # the metadata follows the product data so that older versions 
+            # of EUPS can still read the file
+            pickle.dump(meta, fd, protocol=2)
         fd.close()
         self.modtimes[file] = os.stat(file).st_mtime
 
+        # the updates in the journal are now in the file
+        _removeFile(self._journalPath(file))
+        self.journalIds[file] = meta["journal"]
+        self.journalSizes[file] = 0
+
     def export(self):
         """
         return a hierarchical dictionary of all the Products in the stack, 
@@ -386,19 +634,29 @@ class ProductStack(object):
         for tag in prod.tags:
             self.lookup[flavor][prod.name].assignTag(tag, prod.version)
 
-        self._flavorsUpdated(flavor)
+        self._flavorsUpdated(flavor, ("add", prod.name, prod.version, prod.dir,
+                                      prod.tablefile, list(prod.tags)))
         if self.autosave: self.save(flavor)
 
-    def _flavorsUpdated(self, flavors=None):
+    def _flavorsUpdated(self, flavors=None, record=None):
         # this function is called whenever the stack is updated to add
         # the updated flavors to self.updated.  The value of self.updated,
-        # therefore, indicates which flavors need to updated to disk.
+        # therefore, indicates which flavors need to updated to disk.  
+        # If the update can be journaled (see save()), record is the 
+        # journal record describing it.
         if flavors is None:
-            self.updated = self.getFlavors()
-        elif isinstance(flavors, list):
-            self.updated.extend(x for x in flavors if x not in self.updated)
-        elif flavors not in self.updated:
-            self.updated.append(flavors)
+            flavors = self.getFlavors()
+        elif not isinstance(flavors, list):
+            flavors = [flavors]
+
+        for flavor in flavors:
+            if flavor not in self.updated:
+                self.updated.append(flavor)
+                self.pending[flavor] = []
+            if record is None:
+                self.pending[flavor] = None
+            elif self.pending.get(flavor) is not None:
+                self.pending[flavor].append(record)
 
     def saveNeeded(self, flavors=None):
         """
@@ -461,7 +719,7 @@ class ProductStack(object):
             if updated:
                 if len(self.lookup[flavor][name].getVersions()) == 0:
                     del self.lookup[flavor][name]
-                self._flavorsUpdated(flavor)
+                self._flavorsUpdated(flavor, ("remove", name, version))
                 if self.autosave: self.save(flavor)
         except KeyError:
             return False
@@ -506,7 +764,7 @@ class ProductStack(object):
         if flavors is None:
             return self.assignTag(tag, product, version, list(self.lookup.keys()))
 
-        notfound = True
+        updated = []
         if not isinstance(flavors, list):
             flavors = [flavors]
         for flavor in flavors:
@@ -514,15 +772,15 @@ class ProductStack(object):
                 self.lookup[flavor][product].assignTag(tag, version)
 #                if tag.startswith(userPrefix):
 #                    self._setUserTag(flavor, tag, product, version)
-                notfound = False
+                updated.append(flavor)
             except KeyError:
                 pass
-        if notfound:
+        if not updated:
             raise ProductNotFound(product, version, flavors, self.dbpath)
 
-        self._flavorsUpdated(flavors)
+        self._flavorsUpdated(updated, ("tag", str(tag), product, version))
         if self.autosave: 
-            self.save(flavors)
+            self.save(updated)
 
     def unassignTag(self, tag, product, flavors=None):
         """
@@ -541,18 +799,19 @@ class ProductStack(object):
         if not isinstance(flavors, list):
             flavors = [flavors]
 
-        updated = False
+        updated = []
         for flavor in flavors:
             try:
                 if (self.lookup[flavor][product].unassignTag(tag)):
-                    updated = True
-                    self._flavorsUpdated(flavor)
+                    updated.append(flavor)
             except KeyError:
                 pass
 
-        if updated and self.autosave: 
-            self.save(flavors)
-        return updated
+        if updated:
+            self._flavorsUpdated(updated, ("untag", str(tag), product))
+            if self.autosave: 
+                self.save(updated)
+        return len(updated) > 0
 
     def loadTableFor(self, productName, version, flavor, table=None):
         """
@@ -609,6 +868,16 @@ class ProductStack(object):
                 except KeyError:
                     pass
 
+    def unloadTables(self):
+        """
+        forget the parsed tables cached into memory (by loadTables() or 
+        loadTableFor()), so that they will be read again from their table 
+        files when next needed.  
+        """
+        for flavor in self.lookup.keys():
+            for family in self.lookup[flavor].values():
+                family.unloadTables()
+
     def cacheIsUpToDate(self, flavor, cacheDir=None):
         """
         return True if there is a cache file on disk with product information
@@ -624,8 +893,12 @@ class ProductStack(object):
         if not os.path.exists(cache):
             return False
 
-        # get the modification time of the cache file
+        # get the modification time of the cache file (including any 
+        # updates journaled since it was written)
         cache_mtime = os.stat(cache).st_mtime
+        journal = self._journalPath(cache)
+        if os.path.exists(journal):
+            cache_mtime = max(cache_mtime, os.stat(journal).st_mtime)
 
         # check for user tag updates
         if cacheDir != self.dbpath and \
@@ -639,7 +912,7 @@ class ProductStack(object):
     def clearCache(self, flavors=None, cachedir=None, verbose=0):
         """
         remove the cache file containing the persisted product information for 
-        the given flavors.  
+        the given flavors, along with the cache of parsed table files.  
         @param flavors    the platform flavors to clear caches for.  This value
                             can be a single flavor name (as a string) or a list 
                             of flavors.
@@ -654,11 +927,23 @@ class ProductStack(object):
             flavors = [flavors]
 
         for flavor in flavors:
-            fileName = self._persistPath(flavor, cachedir)
-            if os.path.exists(fileName):
-                if verbose > 0:
-                    print("Deleting %s" % (fileName), file=sys.stderr)
-                os.remove(fileName)
+            fileNames = [self.persistFilename(flavor, cacheFormat)
+                         for cacheFormat in self.cacheFileExts]
+            fileNames.append(self.journalFilename(flavor))
+            for fileName in fileNames:
+                fileName = os.path.join(self._persistDir(cachedir), fileName)
+                if os.path.exists(fileName):
+                    if verbose > 0:
+                        print("Deleting %s" % (fileName), file=sys.stderr)
+                    os.remove(fileName)
+
+        fileName = os.path.join(self._persistDir(cachedir), self.tableCacheFile)
+        if os.path.exists(fileName):
+            if verbose > 0:
+                print("Deleting %s" % (fileName), file=sys.stderr)
+            os.remove(fileName)
+        if self._tableCache is not None and self._tableCache.file == fileName:
+            self._tableCache.clear()
 
     def reload(self, flavors=None, persistDir=None, verbose=0):
         """
@@ -681,48 +966,158 @@ class ProductStack(object):
             raise RuntimeError(persistDir + ": not an existing directory")
 
         if flavors is None:
-            flavors = self.findCachedFlavors(persistDir)
+            flavors = self.findCachedFlavors(persistDir, self.cacheFormat)
         if not isinstance(flavors, list):
             flavors = [flavors]
 
         for flavor in flavors:
             fileName = self._persistPath(flavor,persistDir)
             self.modtimes[fileName] = os.stat(fileName).st_mtime
-            fd = open(fileName, "rb")
-            lookup = pickle.load(fd)
-            fd.close()
+            if isIndexedCache(fileName):
+                # product families are only decoded when first looked up
+                lookup = IndexedCache(fileName)
+                meta = lookup.meta
+            else:
+                fd = open(fileName, "rb")
+                lookup = pickle.load(fd)
+                try:
+                    meta = pickle.load(fd)
+                except EOFError:        # written by an older version
+                    meta = {}
+                fd.close()
 
             self.lookup[flavor] = lookup
+            # only patch data written by the same major version of python
+            # (python 2 would read the strings of python 3 as unicode)
+            sameVersion = meta.get("python") == sys.version_info[0]
+            if sameVersion or "python" not in meta:
+                self.foreignFlavors.discard(flavor)
+            else:
+                self.foreignFlavors.add(flavor)
+            for name, value in (("stamps", self.stamps), 
+                                ("generations", self.generations)):
+                if name in meta and sameVersion:
+                    value[flavor] = meta[name]
+                else:
+                    value.pop(flavor, None)
+
+            self.journalIds[fileName] = meta.get("journal")
+            self._replayJournal(flavor, fileName)
+
+            # any updates not yet saved have been thrown away
+            self.pending.pop(flavor, None)
 
     @staticmethod
-    def findCachedFlavors(dir):
-
+    def findCachedFlavors(dir, cacheFormat=None):
+        """
+        return the flavors that have cache files in the given directory
+        @param dir          the directory to search
+        @param cacheFormat  if not None, only consider cache files in this
+                              format ("pickle" or "indexed")
+        """
         flavors = []
         # list contents of directory
         for c in os.listdir(dir):
             # match file against cache file pattern
-            b = ProductStack.persistFileRe.match(c)
+            b = ProductStack.cacheFileRe.match(c)
             if b:
+                if cacheFormat and \
+                   b.group(2) != ProductStack.cacheFileExts[cacheFormat]:
+                    continue
                 # grab only cache files
-                flavors.append(b.group(1))
+                if b.group(1) not in flavors:
+                    flavors.append(b.group(1))
         return flavors
 
-    def refreshFromDatabase(self, userTagDir=None):
+    def refreshFromDatabase(self, userTagDir=None, flavors=None):
         """
         load product information directly from the database files on disk,
         overwriting any previous information.  If userTagDir is provided,
         user tag assignments will be explicitly loaded into the stack 
         (otherwise, the stack may not have user tags in it).
+        @param userTagDir  the directory where user tag data is persisted.
+        @param flavors     flavors to register (see addFlavor()) even if 
+                              no products are declared for them.
         """
         db = Database(self.dbpath, userTagDir)
 
-        # forget!
+        # forget!  (including the cache files that the data came from, 
+        # which can no longer be brought up to date just by journaling)
         self.lookup = {}
+        self.journalIds = {}
 
-        for prodname in db.findProductNames():
+        # record the state of the database before reading it so that any 
+        # updates made while we do so are picked up next time
+        generations = self._getGenerations(userTagDir)
+        stamps = db.getProductStamps()
+
+        for prodname in stamps.keys():
             for product in db.findProducts(prodname):
                 self.addProduct(product)
 
+        if flavors:
+            for flavor in flavors:
+                self.addFlavor(flavor)
+        self.stamps = {}
+        self.generations = {}
+        for flavor in self.lookup.keys():
+            self.stamps[flavor] = stamps
+            self.generations[flavor] = generations
+
+    def refreshChangedProducts(self, flavors=None, userTagDir=None, verbose=0):
+        """
+        bring the product information for the given flavors up to date 
+        with the database by re-reading only the products whose database 
+        entries have changed since the information was read (as recorded 
+        in the product stamps).  Products that have been added to or 
+        removed from the database are added or removed accordingly.  
+        Return False (without changing anything) if product stamps are not
+        available for all the flavors, in which case refreshFromDatabase() 
+        is needed instead.
+        @param flavors     the flavors to refresh; if None, refresh all 
+                              flavors.
+        @param userTagDir  the directory where user tag data is persisted.
+        @param verbose     if > 1, print the names of re-read products
+        """
+        if flavors is None:
+            flavors = self.getFlavors()
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+        for flavor in flavors:
+            if flavor not in self.lookup or flavor not in self.stamps:
+                return False
+
+        db = Database(self.dbpath, userTagDir)
+        generations = self._getGenerations(userTagDir)
+        stamps = db.getProductStamps()
+
+        changed = []
+        for flavor in flavors:
+            recorded = self.stamps[flavor]
+            changed.extend(p for p in stamps.keys() 
+                           if recorded.get(p) != stamps[p] and p not in changed)
+            changed.extend(p for p in recorded.keys()
+                           if p not in stamps and p not in changed)
+
+        for prodname in changed:
+            if verbose > 1:
+                print("Re-reading %s from %s" % (prodname, self.dbpath), file=sys.stderr)
+            for flavor in flavors:
+                if prodname in self.lookup[flavor]:
+                    del self.lookup[flavor][prodname]
+            if prodname in stamps:
+                for product in db.findProducts(prodname):
+                    if product.flavor in flavors:
+                        self.addProduct(product)
+
+        for flavor in flavors:
+            self.stamps[flavor] = stamps
+            self.generations[flavor] = generations
+        if changed:
+            self._flavorsUpdated(flavors)
+
+        return True
+
     def _loadUserTags(self, userTagDir=None):
         if not userTagDir:
             userTagDir = self.persistDir
@@ -737,7 +1132,8 @@ class ProductStack(object):
             
 
     # @staticmethod   # requires python 2.4
-    def fromDatabase(dbpath, persistDir=None, userTagDir=None, autosave=True):
+    def fromDatabase(dbpath, persistDir=None, userTagDir=None, autosave=True,
+                     cacheFormat=None):
         """
         return a ProductStack that has all products loaded in from an EUPS
         database.  If a userTagDir is provided, user tag assignments will be
@@ -748,15 +1144,17 @@ class ProductStack(object):
         @param userTagDir  the directory where user tag data is persisted.
         @param autosave    if true (default), all updates will be saved to 
                               disk.
+        @param cacheFormat the format to persist the cache in; see the 
+                              ProductStack constructor.
         """
-        out = ProductStack(dbpath, persistDir, autosave)
+        out = ProductStack(dbpath, persistDir, autosave, cacheFormat)
         out.refreshFromDatabase(userTagDir)
         return out
     fromDatabase = staticmethod(fromDatabase)    # works since python2.2
 
     # @staticmethod   # requires python 2.4
     def fromCache(dbpath, flavors, persistDir=None, userTagDir=None, 
-                  updateCache=True, autosave=True, verbose=0):
+                  updateCache=True, autosave=True, verbose=0, cacheFormat=None):
         """
         return a ProductStack that has all products loaded in from the 
         available caches.  If they are out of date (or non-existent), this 
@@ -783,6 +1181,8 @@ class ProductStack(object):
                                appear out of date
         @param autosave     if true (default), all updates will be 
                                saved to disk.
+        @param cacheFormat  the format of the cache to read and write; see 
+                               the ProductStack constructor.
         """
         if not flavors:
             raise RuntimeError("ProductStack.fromCache(): at least one flavor needed as input" +
@@ -790,16 +1190,22 @@ class ProductStack(object):
         if not isinstance(flavors, list):
             flavors = [flavors]
 
-        out = ProductStack(dbpath, persistDir, False)
+        out = ProductStack(dbpath, persistDir, False, cacheFormat)
 
-        cacheOkay = out._tryCache(dbpath, persistDir, flavors, verbose=verbose)
-        if not cacheOkay:
-            cacheOkay = out._tryCache(dbpath, dbpath, flavors)
+        cacheOkay = out._tryCache(dbpath, persistDir, flavors, userTagDir, 
+                                  verbose=verbose)
+        if cacheOkay:
+            # save any products refreshed from the database
+            if updateCache and out.saveNeeded():  out.save()
+        elif persistDir != dbpath:
+            cacheOkay = out._tryCache(dbpath, dbpath, flavors, userTagDir)
             if cacheOkay:
+                # save any refreshed products before adding the user tags
+                if updateCache and out.saveNeeded():  out.save()
                 out._loadUserTags(userTagDir)
 
         if not cacheOkay:
-            out.refreshFromDatabase(userTagDir)
+            out.refreshFromDatabase(userTagDir, flavors)
             out._flavorsUpdated(flavors)
             if updateCache:  out.save()
 
@@ -808,38 +1214,151 @@ class ProductStack(object):
 
     fromCache = staticmethod(fromCache)    # works since python2.2
 
-    def _tryCache(self, dbpath, cacheDir, flavors, verbose=0):
+    def _tryCache(self, dbpath, cacheDir, flavors, userTagDir=None, verbose=0):
+        # load the cache in cacheDir if it is up to date.  If it is out of 
+        # date and is the cache we persist to, bring it up to date by 
+        # re-reading the products that have changed.  (Other caches, e.g.
+        # the one in dbpath, may not include our user tags.)
         if not cacheDir or not os.path.exists(cacheDir):
             return False
 
-        cacheOkay = True
+        canRefresh = (cacheDir == self._persistDir())
+
         for flav in flavors:
-            if not self.cacheIsUpToDate(flav, cacheDir):
-                cacheOkay = False
+            if not os.path.exists(self._persistPath(flav, cacheDir)):
                 if verbose > 1:
-                    print("Regenerating missing or out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
-                break
+                    print("Regenerating missing cache for %s in %s" % (flav, dbpath), file=sys.stderr)
+                return False
 
-        if cacheOkay:
+        generations = None
+        if not hooks.config.Eups.paranoidCacheCheck:
+            # the user tags only matter in the cache that we persist to; they're loaded
+            # separately into a stack read from any other cache
+            if canRefresh:
+                generations = self._currentGenerations(userTagDir)
+            else:
+                generations = self._currentGenerations()
+
+        if generations is not None:
+            # the database generations tell us whether the cache is current
+            # without our having to scan the database
             self.reload(flavors, cacheDir, verbose=verbose)
+            cacheOkay = True
+            for flav in flavors:
+                recorded = self.generations.get(flav, {})
+                for dir, gen in generations.items():
+                    if dir not in recorded or recorded[dir] != gen:
+                        cacheOkay = False
+        else:
+            cacheOkay = True
+            for flav in flavors:
+                if not self.cacheIsUpToDate(flav, cacheDir):
+                    cacheOkay = False
+                    if verbose > 1:
+                        print("Out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
+                    break
+
+            if cacheOkay or canRefresh:
+                self.reload(flavors, cacheDir, verbose=verbose)
 
-            # do a final consistency check; do we have the same products
-            dbnames = Database(dbpath).findProductNames()
-            dbnames.sort()
-            dbnames = " ".join(dbnames)
+            if cacheOkay:
+                # do a final consistency check; do we have the same products
+                dbnames = Database(dbpath).findProductNames()
+                dbnames.sort()
+                dbnames = " ".join(dbnames)
+
+                cachenames = self.getProductNames()
+                cachenames.sort()
+                cachenames = " ".join(cachenames)
 
-            cachenames = self.getProductNames()
-            cachenames.sort()
-            cachenames = " ".join(cachenames)
+                if dbnames != cachenames:
+                    cacheOkay = False
+                    if verbose:
+                      print("Out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
 
-            if dbnames != cachenames:
+            if cacheOkay and self.foreignFlavors.intersection(flavors):
                 cacheOkay = False
-                self.lookup = {}   # forget loaded data
-                if verbose:
-                  print("Regenerating out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
+                if verbose > 1:
+                    print("Cache for %s in %s was written by another version of python" %
+                          (" ".join(flavors), dbpath), file=sys.stderr)
+
+        if not cacheOkay and canRefresh:
+            # patch the cache with the products that have changed
+            cacheOkay = self.refreshChangedProducts(flavors, userTagDir, verbose)
+            if cacheOkay and verbose > 1 and self.saveNeeded():
+                print("Updated out-of-date cache for %s in %s" % (" ".join(flavors), dbpath), file=sys.stderr)
+
+        if not cacheOkay:
+            if verbose > 1:
+                print("Regenerating cache for %s in %s" % (" ".join(flavors), dbpath), file=sys.stderr)
+            self.lookup = {}   # forget loaded data
+            self.stamps = {}
+            self.generations = {}
+            self.foreignFlavors = set()
 
         return cacheOkay
 
+    def _getGenerations(self, userTagDir=None):
+        # return the current generations of the database directories that a 
+        # cache depends on (see Database.getGeneration()), keyed by directory:
+        # the database itself and, if given and different, userTagDir, where
+        # user tags are recorded.  The same keys are used when the stack is
+        # read from the database and when a cache is checked (see _tryCache())
+        db = Database(self.dbpath)
+        out = { self.dbpath: db.getGeneration() }
+        if userTagDir and userTagDir != self.dbpath:
+            out[userTagDir] = db.getGeneration(userTagDir)
+        return out
+
+    def _currentGenerations(self, userTagDir=None):
+        # as _getGenerations(), but None is returned if the database has no 
+        # generation
+        out = self._getGenerations(userTagDir)
+        if out[self.dbpath] is None:
+            return None
+        return out
+
+def _fileSize(file):
+    # the size of a file, or 0 if it does not exist
+    try:
+        return os.stat(file).st_size
+    except OSError:
+        return 0
+
+def _removeFile(file):
+    try:
+        os.remove(file)
+    except OSError:
+        pass
+
+# the format of the length that precedes each record in a journal file
+_recordLenFmt = ">I"
+_recordLenSize = struct.calcsize(_recordLenFmt)
+
+def _encodeRecord(record):
+    # encode a journal record as it is written to a journal file
+    data = pickle.dumps(record, protocol=2)
+    return struct.pack(_recordLenFmt, len(data)) + data
+
+def _decodeRecords(data):
+    # decode the contents of a journal file, returning the list of records 
+    # and whether the last of them was complete
+    records = []
+    pos = 0
+    while pos < len(data):
+        if pos + _recordLenSize > len(data):
+            return records, False
+        length = struct.unpack(_recordLenFmt, data[pos:pos+_recordLenSize])[0]
+        pos += _recordLenSize
+        if pos + length > len(data):
+            return records, False
+        try:
+            records.append(pickle.loads(data[pos:pos+length]))
+        except Exception:
+            return records, False
+        pos += length
+    return records, True
+
 def _uniquify(lis):
     for i in xrange(len(lis)):
         item = lis.pop(0)
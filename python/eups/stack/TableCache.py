@@ -0,0 +1,170 @@
+"""
+a persistent cache of parsed table files.
+
+Parsing a table file is one of the more expensive steps of a setup, and the
+same table files are parsed again by every invocation of eups.  A TableCache
+holds the parsed (but not yet expanded; see Table.expandEupsVariables())
+contents of table files in a single pickled file, stored alongside the
+product cache of a ProductStack.  Each entry records the modification time
+and size of the table file it was parsed from, so that an entry is used
+only while its table file is unchanged.
+"""
+from __future__ import absolute_import
+import os
+import sys
+import atexit
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from eups import utils
+from eups import hooks
+from eups.table import Table
+
+# the version of the layout of the cache file.  Cache files with another
+# version are ignored (and eventually overwritten).  So are those written
+# by another major version of python, as python 2 would read the strings
+# of python 3 as unicode.
+formatVersion = 1
+
+class TableCache(object):
+    """
+    a lookup of parsed table files, keyed by table file path and flavor, that
+    is backed by a cache file.  The file is read the first time a table is
+    looked up, and new entries are written back to it when save() is called
+    (which happens automatically at exit once an entry has been added).
+    """
+
+    def __init__(self, file):
+        """
+        @param file    the path to the cache file.  It need not exist yet.
+        """
+        self.file = file
+
+        # the cached entries:  (signature, compiled table) tuples keyed by
+        # (table file, flavor).  None until the file is first read.
+        self._entries = None
+
+        # True if entries have been added since the file was read
+        self._updated = False
+        self._saveAtExit = False
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+
+        try:
+            fd = open(self.file, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                data = pickle.load(fd)
+            except Exception:
+                # a corrupted or incompatible cache is simply rebuilt
+                return
+        finally:
+            fd.close()
+
+        if isinstance(data, dict) and data.get("version") == formatVersion \
+           and data.get("python") == sys.version_info[0]:
+            self._entries = data["tables"]
+
+    def _signature(self, tableFile, product, addDefaultProduct):
+        # the things that the parsed contents of a table file depend on
+        st = os.stat(tableFile)
+        defaultProduct = None
+        if addDefaultProduct is not False:
+            dp = hooks.config.Eups.defaultProduct
+            defaultProduct = (dp["name"], dp["version"], dp["tag"])
+
+        return (st.st_mtime, st.st_size, product.name, defaultProduct)
+
+    def getTable(self, tableFile, product, addDefaultProduct=None):
+        """
+        return the Table for a table file as it was cached, or None if it
+        is not in the cache or the table file has changed since it was
+        cached.  The returned Table has not had its variables expanded.
+        @param tableFile          the path to the table file
+        @param product            the Product that owns the table file
+        @param addDefaultProduct  as passed to the Table constructor
+        """
+        entry = self._getEntry(tableFile, product, addDefaultProduct)
+        if not entry:
+            return None
+
+        return Table.fromCompiled(tableFile, entry[1], product)
+
+    def hasTable(self, tableFile, product, addDefaultProduct=None):
+        """
+        return True if getTable() would return a Table (without building it)
+        """
+        return self._getEntry(tableFile, product, addDefaultProduct) is not None
+
+    def _getEntry(self, tableFile, product, addDefaultProduct):
+        # return the cache entry for a table file, or None if it's missing or out of date
+        self._load()
+        entry = self._entries.get((tableFile, product.flavor))
+        if not entry:
+            return None
+
+        try:
+            if entry[0] != self._signature(tableFile, product, addDefaultProduct):
+                return None
+        except OSError:
+            return None
+
+        return entry
+
+    def addTable(self, table, product, addDefaultProduct=None):
+        """
+        add a freshly parsed Table to the cache.  This must be called before
+        the table's variables are expanded.
+        @param table              the Table parsed from product's table file
+        @param product            the Product that owns the table file
+        @param addDefaultProduct  as passed to the Table constructor
+        """
+        self._load()
+        try:
+            signature = self._signature(table.file, product, addDefaultProduct)
+        except OSError:
+            return
+
+        self._entries[(table.file, product.flavor)] = (signature, table.getCompiled())
+        self._updated = True
+
+        if not self._saveAtExit:
+            atexit.register(self.save)
+            self._saveAtExit = True
+
+    def __len__(self):
+        self._load()
+        return len(self._entries)
+
+    def save(self):
+        """
+        write the cache to its file if entries have been added.  Failure to
+        write the file (e.g. because the directory is not writable) is
+        silently ignored.
+        """
+        if not self._updated:
+            return
+
+        try:
+            fd = utils.AtomicFile(self.file, "wb")
+            pickle.dump({"version": formatVersion, "python": sys.version_info[0],
+                         "tables": self._entries}, fd, protocol=2)
+            fd.close()
+        except (IOError, OSError):
+            return
+        self._updated = False
+
+    def clear(self):
+        """
+        forget all cached tables and remove the cache file
+        """
+        self._entries = {}
+        self._updated = False
+        if os.path.exists(self.file):
+            os.remove(self.file)
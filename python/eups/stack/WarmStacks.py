@@ -0,0 +1,83 @@
+"""
+a pool of ProductStacks kept in memory by a long-running process (such as
+the resolver daemon; see eups.daemon) so that they needn't be read from
+their cache files for every command.
+"""
+from __future__ import absolute_import
+import os
+import time
+from eups.db import Database
+
+class WarmStacks(object):
+    """
+    ProductStacks kept in memory, keyed by the database and flavors they
+    were loaded for and the directories their caches were read from.  A
+    stack is handed out again only while nothing that it was loaded from
+    appears to have changed, as judged by stat'ing the database's generation
+    files (or, for a database without a generation, its product directories)
+    and the stack's cache and journal files.
+    """
+
+    def __init__(self):
+        # (stack, signature, time loaded) tuples, keyed by (dbpath, flavors,
+        # cacheDir, userCacheDir)
+        self._stacks = {}
+
+    def _signature(self, stack, dbpath, flavors, cacheDir, userCacheDir):
+        # the state of the files that the stack was loaded from
+        db = Database(dbpath)
+        out = [db.getGeneration()]
+        if userCacheDir:
+            out.append(db.getGeneration(userCacheDir))
+
+        for flavor in flavors:
+            for dir in (dbpath, cacheDir):
+                if not dir:
+                    continue
+                cache = stack._persistPath(flavor, dir)
+                for file in (cache, stack._journalPath(cache)):
+                    try:
+                        st = os.stat(file)
+                        out.append((file, st.st_mtime, st.st_size))
+                    except OSError:
+                        out.append((file, None, None))
+
+        return out
+
+    def get(self, dbpath, flavors, cacheDir, userCacheDir):
+        """
+        return the stack loaded for a database, or None if there isn't one
+        or it is out of date.  Any parsed tables it holds are forgotten, as
+        their table files may have changed.
+        """
+        key = (dbpath, tuple(flavors), cacheDir, userCacheDir)
+        if key not in self._stacks:
+            return None
+
+        stack, signature, loaded = self._stacks[key]
+        if signature[0] is None and Database(dbpath).isNewerThan(loaded):
+            del self._stacks[key]
+            return None
+        if self._signature(stack, dbpath, flavors, cacheDir, userCacheDir) != signature:
+            del self._stacks[key]
+            return None
+
+        stack.unloadTables()
+        return stack
+
+    def add(self, stack, dbpath, flavors, cacheDir, userCacheDir):
+        """
+        keep a stack that has just been loaded for a database
+        """
+        key = (dbpath, tuple(flavors), cacheDir, userCacheDir)
+        self._stacks[key] = (stack, self._signature(stack, dbpath, flavors, cacheDir, userCacheDir),
+                             time.time())
+
+    def __len__(self):
+        return len(self._stacks)
+
+    def clear(self):
+        """
+        forget all the stacks
+        """
+        self._stacks = {}
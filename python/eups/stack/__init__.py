@@ -8,6 +8,12 @@ The major classes are:
                        to speed up recreation of a stack instance later.
    ProductFamily   a collection of different versions of product (installed 
                        for the same flavor).  
+   LazyStacks      a dictionary of the ProductStacks for several databases
+                       that reads each one only when it is first needed.
+   WarmStacks      a pool of ProductStacks kept in memory between commands
+                       by a long-running process.
 """
 from .ProductFamily import ProductFamily
 from .ProductStack import ProductStack, persistVersionName, CacheOutOfSync
+from .LazyStacks import LazyStacks
+from .WarmStacks import WarmStacks
@@ -15,10 +15,100 @@ from .VersionParser import VersionParser
 from . import utils
 from . import hooks
 
+#
+# Table files are parsed a line at a time.  _lexTable() turns the lines into tokens which Table._read()
+# builds into Actions and logical blocks.  Tables that use the old (ups) syntax need rewriting
+# first, and are tokenized by Table._rewrite() and Table._tokenize() instead;  the tokens are the
+# same either way.
+#
+class _OldStyleTable(Exception):
+    """A table file needs rewriting before it can be tokenized"""
+    pass
+
+# Lines starting with a keyword that Table._rewrite() handles (a superset of them)
+_oldStyle_re = re.compile(r"^(?:file|action|qualifiers|group|flavor)", re.IGNORECASE)
+# if (...) {, } else if (...) {, } else {, and }
+_logical_re = re.compile(r"^(?:if\s*\((.*)\)\s*{\s*|}\s*(?:(else(?:\s*if\s*\((.*)\))?)\s*{)?)$", re.IGNORECASE)
+# action(args)
+_action_re = re.compile(r'^(\w+)\s*\(([^)]*)\)', re.IGNORECASE)
+_spaceArg_re = re.compile(r',\s*"(\s)"')
+_quoted_re = re.compile(r'"[^"]+"')
+
+# Older synonyms for eups variables in table files
+_variableSynonyms = [
+    ("${PROD_DIR}", "${PRODUCT_DIR}"),
+    ("${UPS_PROD_DIR}", "${PRODUCT_DIR}"),
+    ("${UPS_PROD_FLAVOR}", "${PRODUCT_FLAVOR}"),
+    ("${UPS_PROD_NAME}", "${PRODUCT_NAME}"),
+    ("${UPS_PROD_VERSION}", "${PRODUCT_VERSION}"),
+    ("${UPS_DB}", "${PRODUCTS}"),
+    ("${UPS_UPS_DIR}", "${UPS_DIR}"),
+    ]
+
+def _lexTable(contents):
+    """Split the lines of a table file into a list of (lineNo, line, kind, value) tokens, where kind is
+    "logical" (value: the if, else, and else-if groups of the condition), "action" (value: the
+    lower-cased command and its arguments), or "other".  Raise _OldStyleTable if the table must
+    be rewritten by Table._rewrite() first"""
+
+    tokens = []
+    lineNo = 0
+    for line in contents:
+        lineNo += 1
+
+        line = line.replace("\n", "").lstrip()
+        i = line.find("#")
+        if i >= 0:
+            line = line[:i]
+
+        if not line:
+            continue
+        if _oldStyle_re.match(line):
+            raise _OldStyleTable()
+
+        if "${" in line:
+            for old, new in _variableSynonyms:
+                line = line.replace(old, new)
+
+        mat = _logical_re.match(line)
+        if mat:
+            tokens.append((lineNo, line, "logical", mat.groups()))
+            continue
+
+        mat = _action_re.match(line)
+        if mat:
+            tokens.append((lineNo, line, "action", (mat.group(1).lower(), _splitArgs(mat.group(2)))))
+        else:
+            tokens.append((lineNo, line, "other", None))
+
+    return tokens
+
+def _unquote(s):
+    # remove a pair of quotes surrounding s
+    if len(s) >= 2 and s[0] == '"' and s[-1] == '"':
+        return s[1:-1]
+    return s
+
+def _splitArgs(args):
+    """Split the arguments of an action, as Table._tokenize() does"""
+
+    args = _unquote(args)
+    if '"' not in args and "\1" not in args and "\2" not in args and "\3" not in args:
+        return [s for s in args.replace(",", " ").split(" ") if s]
+    #
+    # Protect \" as \002, cmd(..., " ") as \001, and " " and , within quoted strings as \001 and \003
+    #
+    args = args.replace(r'\"', r'%c' % 2)
+    args = _spaceArg_re.sub(r'\1"%c"' % 1, args)
+    args = _quoted_re.sub(lambda s: s.group(0).replace(" ", "\1").replace(",", "\3"), args)
+
+    return [_unquote(s).replace("\1", " ").replace("\2", '"').replace("\3", ",")
+            for s in args.replace(",", " ").split(" ") if s]
+
 class Table(object):
     """A class that represents a eups table file"""
 
-    def __init__(self, tableFile, topProduct=None, addDefaultProduct=None, verbose=0):
+    def __init__(self, tableFile, topProduct=None, addDefaultProduct=None, verbose=0, contents=None):
         """
         Parse a tablefile
         @param  tableFile          the tablefile we're reading
@@ -26,6 +116,8 @@ class Table(object):
         @param  addDefaultProduct  if True or None, automatically add a 
                                      "setupOptional" action for the product
                                      specified in hooks.config.Eups.defaultProduct
+        @param  contents           the lines of the tablefile, if they have already
+                                     been read
         @throws TableError       if an IOError occurs while reading the table file
         @throws BadTableContent  if the table file parser encounters unparseable 
                                    content.  Note that BadTableContent is a subclass
@@ -38,7 +130,59 @@ class Table(object):
         self._actions = []
 
         if utils.isRealFilename(tableFile):
-            self._read(tableFile, addDefaultProduct, verbose, topProduct)
+            self._read(tableFile, addDefaultProduct, verbose, topProduct, contents)
+
+    def getCompiled(self):
+        """
+        return the parsed contents of this table in a compact form made up
+        only of strings, lists, tuples, and dictionaries, suitable for
+        pickling.  The table can be recreated from it with fromCompiled().
+        This should be called before expandEupsVariables() so that the
+        result does not depend on where the product is installed.
+        """
+        actions = []
+        for LBB in self._actions:
+            compiled = []
+            for logicalOrBlock in LBB:
+                if isinstance(logicalOrBlock, list):
+                    logicalOrBlock = [(a.tableFile, a.cmd, list(a.args), dict(a.extra),
+                                       a.topProduct is not None) for a in logicalOrBlock]
+                compiled.append(logicalOrBlock)
+            actions.append((isinstance(LBB, tuple), compiled))
+
+        return (self.old, actions)
+
+    # @staticmethod   # requires python 2.4
+    def fromCompiled(tableFile, compiled, topProduct=None):
+        """
+        recreate a Table from the output of getCompiled() without reading
+        the table file.
+        @param  tableFile    the tablefile the compiled contents came from
+        @param  compiled     the output of Table.getCompiled()
+        @param  topProduct   the Product that owns this tablefile
+        """
+        table = Table(None, topProduct)
+        table.file = tableFile
+
+        table.old, actions = compiled
+        for isTuple, compiledLBB in actions:
+            LBB = []
+            for logicalOrBlock in compiledLBB:
+                if isinstance(logicalOrBlock, list):
+                    block = []
+                    for file, cmd, args, extra, hasTop in logicalOrBlock:
+                        a = Action(file, cmd, [], dict(extra),
+                                   topProduct=(hasTop and topProduct or None))
+                        a.args = list(args)
+                        block.append(a)
+                    logicalOrBlock = block
+                LBB.append(logicalOrBlock)
+            if isTuple:
+                LBB = tuple(LBB)
+            table._actions.append(LBB)
+
+        return table
+    fromCompiled = staticmethod(fromCompiled)  # works since python 2.2
 
     def _rewrite(self, contents):
         """Rewrite the contents of a tablefile to the canonical form; each
@@ -161,6 +305,57 @@ but no other interpretation is applied
             
         return ncontents
 
+    def _tokenize(self, contents):
+        """Split the output of _rewrite() into the tokens used by _read();
+this is the slow path of _lexTable(), used for tables that need rewriting
+"""
+
+        tokens = []
+        for lineNo, line in contents:
+            #
+            # Is this the start of a logical condition?
+            #
+            mat = re.search(r"^(?:if\s*\((.*)\)\s*{\s*|}\s*(?:(else(?:\s*if\s*\((.*)\))?)\s*{)?)$", \
+                                line, re.IGNORECASE)
+            if mat:
+                tokens.append((lineNo, line, "logical", mat.groups()))
+                continue
+            #
+            # Is line of the form action(...)?
+            #
+            mat = re.search(r'^(\w+)\s*\(([^)]*)\)', line, re.IGNORECASE)
+            if mat:
+                cmd = mat.group(1).lower()
+                args = re.sub(r'^"(.*)"$', r'\1', mat.group(2))
+                #
+                # Protect \" by replacing it with "\002"
+                #
+                args = args.replace(r'\"', r'%c' % 2)
+                #
+                # Special case cmd(..., " ") by protecting " " as "\001"
+                #
+                args = re.sub(r',\s*"(\s)"', r'\1"%c"' % 1, args)
+                #
+                # Replace " " within quoted strings with \1 too
+                #
+                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(" ", "\1", s.group(0)), args)
+                #
+                # Replace , within quoted strings with "\003"
+                #
+                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(",", "%c" % 3, s.group(0)), args)
+
+                args = [s for s in re.split("[, ]", args) if s]
+                args = [re.sub(r'^"(.*)"$', r'\1', s) for s in args] # remove quotes
+                args = [re.sub(r'%c' % 1, r' ', s) for s in args] # reinstate \001 as a space
+                args = [re.sub(r'%c' % 2, r'"', s) for s in args] # reinstate \002 as "
+                args = [re.sub(r'%c' % 3, r',', s) for s in args] # reinstate \003 as ,
+
+                tokens.append((lineNo, line, "action", (cmd, args)))
+            else:
+                tokens.append((lineNo, line, "other", None))
+
+        return tokens
+
     def expandEupsVariables(self, product, quiet=False):
         """Expand eups-related variables such as $PRODUCT_DIR"""
 
@@ -251,19 +446,23 @@ but no other interpretation is applied
 
         return self
     
-    def _read(self, tableFile, addDefaultProduct, verbose=0, topProduct=None):
+    def _read(self, tableFile, addDefaultProduct, verbose=0, topProduct=None, contents=None):
         """Read and parse a table file, setting _actions"""
 
         if not tableFile:               # nothing to do
             return
 
-        try:
-            fd = open(tableFile)
-        except IOError as e:
-            raise TableError(tableFile, msg=str(e))
+        if contents is None:
+            try:
+                fd = open(tableFile)
+            except IOError as e:
+                raise TableError(tableFile, msg=str(e))
 
-        contents = fd.readlines()
-        contents = self._rewrite(contents)
+            contents = fd.readlines()
+        try:
+            tokens = _lexTable(contents)
+        except _OldStyleTable:
+            tokens = self._tokenize(self._rewrite(contents))
 
         logical = "True"                # logical condition required to execute block
         block = []
@@ -277,20 +476,19 @@ but no other interpretation is applied
                                         # } else {
                                         #    actionN
                                         # }
-        for lineNo, line in contents:
+        for lineNo, line, kind, value in tokens:
             #
             # Is this the start of a logical condition?
             #
-            mat = re.search(r"^(?:if\s*\((.*)\)\s*{\s*|}\s*(?:(else(?:\s*if\s*\((.*)\))?)\s*{)?)$", \
-                                line, re.IGNORECASE)
-            if mat:
+            if kind == "logical":
+                ifCondition, elseClause, elseIfCondition = value
                 if block:
-                    if mat.group(2) == "else": # i.e. we saw an } else {
+                    if elseClause == "else": # i.e. we saw an } else {
                         ifBlock = block
-                    elif mat.group(3) != None: # i.e. we saw an } else if (...) {
+                    elif elseIfCondition != None: # i.e. we saw an } else if (...) {
                         logicalBlocks += [logical, block,]
                         block = False
-                        logical = mat.group(3)
+                        logical = elseIfCondition
                     else:               # we saw an }
                         if ifBlock:
                             elseBlock = block
@@ -300,17 +498,17 @@ but no other interpretation is applied
                             
                         logicalBlocks += [logical, ifBlock, elseBlock,]
 
-                        if logicalBlocks and mat.group(1) != None:
+                        if logicalBlocks and ifCondition != None:
                             self._actions.append(logicalBlocks)
                             ifBlock = []
                             logicalBlocks = []
                         
                     block = []
 
-                if mat.group(1) != None:
-                    logical = mat.group(1)
+                if ifCondition != None:
+                    logical = ifCondition
                 else:
-                    if mat.group(2) == None:   # we got to }
+                    if elseClause == None:   # we got to }
                         logical = "True"
                         if logicalBlocks:
                             self._actions.append(logicalBlocks)
@@ -321,56 +519,10 @@ but no other interpretation is applied
             #
             # Is line of the form action(...)?
             #
-            mat = re.search(r'^(\w+)\s*\(([^)]*)\)', line, re.IGNORECASE)
-            if mat:
-                cmd = mat.group(1).lower()
-                args = re.sub(r'^"(.*)"$', r'\1', mat.group(2))
-                #
-                # Protect \" by replacing it with "\002"
-                #
-                args = args.replace(r'\"', r'%c' % 2)
-                #
-                # Special case cmd(..., " ") by protecting " " as "\001"
-                #
-                args = re.sub(r',\s*"(\s)"', r'\1"%c"' % 1, args)
-                #
-                # Replace " " within quoted strings with \1 too
-                #
-                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(" ", "\1", s.group(0)), args)
-                #
-                # Replace , within quoted strings with "\003"
-                #
-                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(",", "%c" % 3, s.group(0)), args)
-
-                args = [s for s in re.split("[, ]", args) if s]
-                args = [re.sub(r'^"(.*)"$', r'\1', s) for s in args] # remove quotes
-                args = [re.sub(r'%c' % 1, r' ', s) for s in args] # reinstate \001 as a space
-                args = [re.sub(r'%c' % 2, r'"', s) for s in args] # reinstate \002 as "
-                args = [re.sub(r'%c' % 3, r',', s) for s in args] # reinstate \003 as ,
-
+            if kind == "action":
+                cmd, args = value
                 try:
-                    cmd = {
-                        "addalias" : Action.addAlias,
-                        "declareoptions" : Action.declareOptions, 
-                        "envappend" : Action.envAppend,
-                        "envprepend" : Action.envPrepend,
-                        "envset" : Action.envSet,
-                        "envunset" : Action.envUnset,
-                        "pathappend" : Action.envAppend,
-                        "pathprepend" : Action.envPrepend,
-                        "pathremove" : Action.envUnset,
-                        "pathset" : Action.envSet,
-                        "print" : Action.doPrint,
-                        "proddir" : Action.prodDir,
-                        "setupenv" : Action.setupEnv,
-                        "setenv" : Action.envSet,
-                        "unsetenv" : Action.envUnset,
-                        "setuprequired" : Action.setupRequired,
-                        "setupoptional" : Action.setupOptional,
-                        "sourcerequired" : Action.sourceRequired,
-                        "unsetuprequired" : Action.unsetupRequired,
-                        "unsetupoptional" : Action.unsetupOptional,
-                        }[cmd]
+                    cmd = _actionCommands[cmd]
                 except KeyError:
                     print("Unexpected line in %s:%d: %s" % (tableFile, lineNo, line), file=utils.stderr)
                     continue
@@ -499,6 +651,23 @@ but no other interpretation is applied
             print(msg, file=utils.stdinfo)
         return actions
 
+    def dependsOnEnvironment(self):
+        """
+        Return True if any of the table's logical conditions refers to an
+        environment variable (e.g. "if (${XXX:-0} == 1)"), so that the actions
+        returned by actions() may change with the environment.
+        """
+        for LBB in self._actions:
+            while LBB:
+                logical, elseBlock = LBB[0], LBB[2:]
+                if "${" in str(logical):
+                    return True
+                if len(elseBlock) == 1:
+                    break
+                LBB = elseBlock
+
+        return False
+
     def __str__(self):
         s = ""
         for logical, ifBlock, elseBlock in self._actions:
@@ -563,7 +732,10 @@ but no other interpretation is applied
             addDefaultProduct = False
 
         deps = []
-        for a in self.actions(Eups.flavor, setupType=setupType):
+        actions = self.actions(Eups.flavor, setupType=setupType)
+        if recursive:
+            Eups.prefetchTables(actions)
+        for a in actions:
             if a.cmd == Action.unsetupRequired:
                 if True:
                     optional = a.extra["optional"]
@@ -617,7 +789,8 @@ but no other interpretation is applied
 
                     if recursive and not noRecursion and prodkey(product) not in recursiveDict:
                         recursiveDict[prodkey(product)] = 1
-                        deptable = product.getTable(addDefaultProduct=addDefaultProduct)
+                        deptable = product.getTable(addDefaultProduct=addDefaultProduct,
+                                                    contents=Eups.takePrefetchedTable(product))
                         if deptable:
                             deps += deptable.dependencies(Eups, eupsPathDirs, recursiveDict,
                                                           recursionDepth + 1, followExact, productDictionary,
@@ -742,6 +915,28 @@ class Action(object):
     def __str__(self):
         return "%s %s %s" % (self.cmd, self.args, self.extra)
 
+    def getDependencySpec(self):
+        """
+        return the (productName, version) named by a setupRequired command, without any of the
+        checks (or messages) of processArgs().  The version is None if none was given; the
+        productName is None if the product is given by directory (-r)
+        """
+        args = []
+        i = 0
+        while i < len(self.args):
+            arg = self.args[i]
+            if arg == "-r":
+                return None, None
+            elif arg in ("-f", "--flavor", "-T", "-t", "--tag", "--vro"):
+                i += 1                  # skip the option's argument
+            elif not arg.startswith("-"):
+                args.append(arg)
+            i += 1
+
+        if not args:
+            return None, None
+        return args[0], " ".join(args[1:]) or None
+
     def execute(self, Eups, recursionDepth, fwd=True, noRecursion=False, tableProduct=None,
                 implicitProduct=False):
         """Execute an action"""
@@ -817,7 +1012,7 @@ class Action(object):
             productName = None
 
         if productDir:
-            productDir = os.path.expanduser(self.expandEnvironmentalVariable(productDir, Eups.verbose))
+            productDir = os.path.expanduser(self.expandEnvironmentalVariable(productDir, Eups.verbose, Eups))
             if not os.path.isabs(productDir):
                 if self.topProduct:
                     toplevelDir = self.topProduct.dir
@@ -834,9 +1029,7 @@ class Action(object):
 
         vers = None
         if not fwd:                     # unsetup
-            product = Eups.findSetupProduct(productName)
-            if product:
-                vers = product.version
+            vers = Eups.findSetupVersion(productName)[0]
         elif Eups.ignore_versions:
             vers = None                 # Setting and then ignoring vers generates confusing error messages
         elif args:
@@ -921,7 +1114,7 @@ class Action(object):
 
         return requestedVRO, productName, productDir, vers, versExpr, noRecursion
 
-    def expandEnvironmentalVariable(self, value, verbose=0):
+    def expandEnvironmentalVariable(self, value, verbose=0, Eups=None):
         # look for values that are optional environment variables: ${XXX} or $?{XXX}
         # If desired, specify a default value as e.g. ${XXX-value}
         # if they don't exist, ignore the entire line if marked optional; raise an error otherwise
@@ -930,6 +1123,9 @@ class Action(object):
         if not mat:
             return value
         
+        if Eups is not None:
+            Eups.flushPathVariables()   # so os.environ is up to date
+
         optional, key, default = mat.groups()
 
         if key in os.environ:
@@ -957,7 +1153,7 @@ class Action(object):
         requestedVRO, productName, productDir, vers, versExpr, noRecursion = \
             self.processArgs(Eups, fwd)
         if productDir:
-            productDir = self.expandEnvironmentalVariable(productDir, Eups.verbose)
+            productDir = self.expandEnvironmentalVariable(productDir, Eups.verbose, Eups)
             if productDir is None:
                 return
 
@@ -1063,8 +1259,6 @@ class Action(object):
         else:
             delim = ":"
 
-        opath = os.environ.get(envVar, "") # old value of envVar, generally a path of some sort hence the name
-
         # should we prepend an extra :?
         pat = "^" + delim
         prepend_delim = re.search(pat, value)
@@ -1074,10 +1268,8 @@ class Action(object):
         append_delim = re.search(pat, value)
         value = re.sub(pat, "", value)
 
-        opath = [el for el in opath.split(delim) if el] # strip extra : at start or end
-
         if fwd:
-            value = self.expandEnvironmentalVariable(value, Eups.verbose)
+            value = self.expandEnvironmentalVariable(value, Eups.verbose, Eups)
             if value is None:
                 return
 
@@ -1085,29 +1277,24 @@ class Action(object):
             if Eups.verbose > 1:
                 print("In %s value \"%s\" contains a delimiter '%s'" % (self.tableFile, value, delim), file=utils.stdwarn)
 
-        npath = opath
+        npath = Eups.getEnvPath(envVar, delim) # old value of envVar, without duplicates
+        npath.remove("")                # strip extra : left by an earlier action
         for value in value.split(delim):
             if fwd:
                 if append:
-                    npath = npath + [value]
+                    npath.append(value)
                 else:
-                    npath = [value] + npath
+                    npath.prepend(value)
             else:
-                npath = [d for d in npath if d != value]
-
-        npath = self.pathUnique(npath) # remove duplicates
+                npath.remove(value)
 
-        npath = delim.join(npath)     # convert back to a string
-        
-        if prepend_delim and not re.search(r"^%s" % delim, npath):
-            npath = delim + npath
-        if append_delim and not re.search(r"%s$" % delim, npath):
-            npath += delim
+        npath.leadingDelim = bool(prepend_delim)
+        npath.trailingDelim = bool(append_delim)
 
         if Eups.force and envVar in Eups.oldEnviron:
             del Eups.oldEnviron[envVar]
 
-        Eups.setEnv(envVar, npath, interpolateEnv=True)
+        Eups.setEnvPath(envVar, npath)
 
     def execute_addAlias(self, Eups, fwd=True):
         """Execute addAlias"""
@@ -1138,7 +1325,7 @@ class Action(object):
             del Eups.oldEnviron[key]
 
         if fwd:
-            value = self.expandEnvironmentalVariable(value, Eups.verbose)
+            value = self.expandEnvironmentalVariable(value, Eups.verbose, Eups)
             if not value:
                 return
 
@@ -1187,17 +1374,37 @@ class Action(object):
         if not fwd:
             return                      # we don't know how to reset a value. Sorry
 
-        key = self.args[0]
-
-        try:
-            del os.environ[key]
-        except KeyError:
-            pass
+        Eups.unsetEnv(self.args[0])
+
+# The Action commands, keyed by the lower-cased names used in table files
+_actionCommands = {
+    "addalias" : Action.addAlias,
+    "declareoptions" : Action.declareOptions, 
+    "envappend" : Action.envAppend,
+    "envprepend" : Action.envPrepend,
+    "envset" : Action.envSet,
+    "envunset" : Action.envUnset,
+    "pathappend" : Action.envAppend,
+    "pathprepend" : Action.envPrepend,
+    "pathremove" : Action.envUnset,
+    "pathset" : Action.envSet,
+    "print" : Action.doPrint,
+    "proddir" : Action.prodDir,
+    "setupenv" : Action.setupEnv,
+    "setenv" : Action.envSet,
+    "unsetenv" : Action.envUnset,
+    "setuprequired" : Action.setupRequired,
+    "setupoptional" : Action.setupOptional,
+    "sourcerequired" : Action.sourceRequired,
+    "unsetuprequired" : Action.unsetupRequired,
+    "unsetupoptional" : Action.unsetupOptional,
+    }
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 #
 # Expand a table file
 #
+
 def expandTableFile(Eups, ofd, ifd, productList, versionRegexp=None, force=False,
                     expandVersions=True, addExactBlock=True, toplevelName=None,
                     recurse=True):
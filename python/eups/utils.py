@@ -35,6 +35,17 @@ if sys.version_info[0] == 2:
 
     def decode(string, encoding):
         return string
+
+    def nativeStrings(obj):
+        # convert the unicode strings within obj (as returned by e.g. json)
+        # to str
+        if isinstance(obj, unicode):
+            return obj.encode("utf-8")
+        elif isinstance(obj, list):
+            return [nativeStrings(o) for o in obj]
+        elif isinstance(obj, dict):
+            return dict((nativeStrings(k), nativeStrings(v)) for k, v in obj.items())
+        return obj
 else:
     # Python 3.x versions
     import io as StringIO
@@ -60,6 +71,9 @@ else:
     def decode(string, encoding):
         return string.decode(encoding)
 
+    def nativeStrings(obj):
+        return obj
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def getUserName(full=False):
@@ -208,6 +222,13 @@ def setupEnvPrefix():
     """
     return "SETUP_"
 
+def unsetupEnvNameFor(productName):
+    """
+    return the name of the environment variable that records how to unsetup
+    a product (see UnsetupRecord).  This is of the form "EUPS_UNSETUP_prod"
+    """
+    return "EUPS_UNSETUP_" + productName.upper()
+
 def setupEnvNameFor(productName):
     """
     return the name of the environment variable that provides the 
@@ -0,0 +1,139 @@
+"""
+the client side of the EUPS resolver daemon (see eups.daemon).
+
+The eups and setup programmes call run() before importing eups, which is
+the point:  if a daemon is listening on the user's socket, the command is
+handed to it and its output is relayed, so that no time is spent starting
+eups.  If there is no daemon, or it declines the command, run() returns None
+and the command should be executed in-process as usual.
+
+This module must only import modules from the standard library.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import socket
+import struct
+
+# the version of the protocol spoken with the daemon
+protocolVersion = 1
+
+def socketPath(environ=None):
+    """
+    return the path of the Unix socket that the daemon listens on.  This is
+    $EUPS_DAEMON_SOCKET if set, otherwise daemon.sock in the _caches_
+    directory of the user's data directory.
+    """
+    if environ is None:
+        environ = os.environ
+
+    if "EUPS_DAEMON_SOCKET" in environ:
+        return environ["EUPS_DAEMON_SOCKET"]
+
+    if "EUPS_USERDATA" in environ:
+        userDataDir = environ["EUPS_USERDATA"]
+    else:
+        userDataDir = os.path.join(os.path.expanduser("~"), ".eups")
+    return os.path.join(userDataDir, "_caches_", "daemon.sock")
+
+def sendMessage(sock, message):
+    """
+    send a message (a JSON-serializable object) over a socket
+    """
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+def receiveMessage(sock):
+    """
+    return the next message read from a socket, or None if it is closed
+    """
+    header = _receive(sock, 4)
+    if header is None:
+        return None
+    data = _receive(sock, struct.unpack(">I", header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode("utf-8"))
+
+def _receive(sock, nbyte):
+    # read exactly nbyte bytes from sock;  None if it is closed first
+    chunks = []
+    while nbyte > 0:
+        chunk = sock.recv(min(nbyte, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        nbyte -= len(chunk)
+    return b"".join(chunks)
+
+def request(tool, argv, stderr=None, path=None, timeout=None):
+    """
+    ask the daemon to run a command, returning its exit status and its
+    standard output, or None if the command should be run in-process
+    instead (because there is no daemon, or it declined the command, or
+    the connection failed).
+    @param tool     the programme to run:  "eups" or "setup"
+    @param argv     the programme's arguments
+    @param stderr   the file to copy the command's standard error to, as it
+                      is produced.  Default: sys.stderr
+    @param path     the daemon's socket.  Default: socketPath()
+    @param timeout  the time to wait for the daemon to respond, in seconds
+                      (None means no limit)
+    """
+    if stderr is None:
+        stderr = sys.stderr
+    if path is None:
+        path = socketPath()
+    if not os.path.exists(path):
+        return None
+
+    try:
+        isatty = os.isatty(stderr.fileno())
+    except Exception:
+        isatty = False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+            sendMessage(sock, dict(version=protocolVersion, tool=tool, argv=list(argv),
+                                   environ=dict(os.environ), cwd=os.getcwd(), isatty=isatty))
+
+            stdout = []
+            while True:
+                message = receiveMessage(sock)
+                if message is None or "fallback" in message:
+                    return None
+                if "stderr" in message:
+                    stderr.write(message["stderr"])
+                    stderr.flush()
+                if "stdout" in message:
+                    stdout.append(message["stdout"])
+                if "status" in message:
+                    return message["status"], "".join(stdout)
+        except (socket.error, socket.timeout, ValueError):
+            return None
+    finally:
+        sock.close()
+
+def run(tool, argv=None):
+    """
+    run a command via the daemon, writing its standard output once it has
+    finished.  Return the command's exit status, or None if it should be
+    run in-process instead.  $EUPS_NO_DAEMON disables the daemon.
+    """
+    if os.environ.get("EUPS_NO_DAEMON"):
+        return None
+    if argv is None:
+        argv = sys.argv[1:]
+
+    result = request(tool, argv)
+    if result is None:
+        return None
+
+    status, stdout = result
+    sys.stdout.write(stdout)
+    sys.stdout.flush()
+    return status
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+A benchmark of the time taken to import the modules needed by the eups
+commands, as measured by python -X importtime, and a check that they stay
+within a budget.  The number of modules that they import is budgeted too;
+unlike the times, that doesn't depend on the machine, so the tests in
+testMisc check it (and which modules are imported).  Run it directly:
+
+   python tests/benchImport.py [-v]
+
+With -v, the slowest modules imported by each command are listed too.  The
+exit status is 1 if any command went over its budget.
+"""
+from __future__ import print_function
+import os
+import re
+import subprocess
+import sys
+
+import testCommon
+import eups
+
+# the modules imported by each command (c.f. bin/eups_setup_impl.py and
+# bin/eups_impl.py;  eups distrib commands also import the distrib subsystem)
+commands = [
+    ("setup", "import eups.setupcmd"),
+    ("eups list", "import eups.cmd"),
+    ("eups distrib install", "import eups.cmd; import eups.distrib"),
+    ]
+
+# the most time, in seconds, that importing the modules needed by each command should take
+budgets = {
+    "setup" : 0.5,
+    "eups list" : 0.5,
+    "eups distrib install" : 1.0,
+    }
+
+# the most modules (including those from the standard library) that "import eups" should
+# import, and that each command should import in addition
+baseStatement = "import eups"
+baseModuleBudget = 160
+moduleBudgets = {
+    "setup" : 5,
+    "eups list" : 5,
+    "eups distrib install" : 80,
+    }
+
+_importtime_re = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)")
+
+def importTimes(statement):
+    """
+    run statement in a new python, returning the total time taken by the
+    imports of eups modules (in seconds) and a dict giving the cumulative
+    time taken by each module imported, including those from the standard
+    library
+    """
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(eups.__file__)))] +
+        [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", statement], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("Failed to run \"%s\": %s" % (statement, err.decode()))
+
+    total, modules = 0, {}
+    for line in err.decode().splitlines():
+        mat = _importtime_re.search(line)
+        if not mat:
+            continue
+        cumulative, indent, name = int(mat.group(2)), mat.group(3), mat.group(4)
+        modules[name] = cumulative*1e-6
+        if len(indent) == 1 and (name == "eups" or name.startswith("eups.")):
+            total += cumulative         # a module imported by statement itself
+
+    return total*1e-6, modules
+
+def importedModules(statement):
+    """
+    run statement in a new python, returning the set of the names of the
+    modules that it imported.  Unlike importTimes(), this works with any
+    version of python
+    """
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(eups.__file__)))] +
+        [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+
+    script = "import sys; before = set(sys.modules); %s; " \
+             "print(' '.join([m for m in sys.modules if m not in before and sys.modules[m]]))" \
+             % statement
+    proc = subprocess.Popen([sys.executable, "-c", script], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("Failed to run \"%s\": %s" % (statement, err.decode()))
+
+    return set(out.decode().split())
+
+def run(verbose=False):
+    """
+    print the import time and the number of modules imported by each command,
+    returning False if any is over budget
+    """
+    ok = True
+    base = importedModules(baseStatement)
+    line = "%-22s %8s     %4d modules" % (baseStatement, "", len(base))
+    if len(base) > baseModuleBudget:
+        line += "  (over its budget of %d)" % baseModuleBudget
+        ok = False
+    print(line)
+
+    for what, statement in commands:
+        total, modules = importTimes(statement)
+        extra = importedModules(statement) - base
+        line = "%-22s %8.1f ms  %4d modules (%d more)" % (what, 1e3*total, len(modules), len(extra))
+        if total > budgets[what]:
+            line += "  (over its budget of %.1f ms)" % (1e3*budgets[what])
+            ok = False
+        if len(extra) > moduleBudgets[what]:
+            line += "  (over its budget of %d more modules)" % moduleBudgets[what]
+            ok = False
+        print(line)
+        if verbose:
+            for name in sorted(modules, key=modules.get, reverse=True)[:10]:
+                print("    %-36s %8.1f ms" % (name, 1e3*modules[name]))
+
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(not run("-v" in sys.argv[1:]))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+A benchmark of the memory used by a ProductStack holding a large synthetic
+stack, and of the time taken to pickle and unpickle it.  This is not part
+of the test suite; run it directly:
+
+   python tests/benchStack.py [nproduct [nversion]]
+
+By default, 500 products with 100 versions each (50000 versions) are used.
+"""
+from __future__ import print_function
+import gc
+import sys
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import testCommon
+from testCommon import testEupsStack
+from eups.stack import ProductStack
+from eups.Product import Product
+
+def makeStack(nproduct, nversion, flavor="Linux64"):
+    ps = ProductStack(testEupsStack + "/ups_db", autosave=False)
+    for i in range(nproduct):
+        name = "product%04d" % i
+        for j in range(nversion):
+            version = "%d.%d.%d" % (j // 10, j % 10, i % 3)
+            dir = "/opt/software/stack/%s/%s/%s" % (flavor, name, version)
+            ps.addProduct(Product(name, version, flavor, dir,
+                                  "%s/ups/%s.table" % (dir, name)))
+        ps.lookup[flavor][name].assignTag("current", version)
+    return ps
+
+def measure(func):
+    # return the result of calling func, the memory allocated by it that is
+    # still in use, and the time taken
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    t = time.time()
+    result = func()
+    t = time.time() - t
+    mem = None
+    if tracemalloc:
+        gc.collect()
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return result, mem, t
+
+def report(what, mem, t):
+    if mem is None:
+        print("%-34s %8.2fs" % (what, t))
+    else:
+        print("%-34s %8.1f MB %8.2fs" % (what, mem / 1.0e6, t))
+
+def run(nproduct=500, nversion=100):
+    print("%d products x %d versions = %d versions" %
+          (nproduct, nversion, nproduct * nversion))
+
+    ps, mem, t = measure(lambda: makeStack(nproduct, nversion))
+    report("build stack", mem, t)
+
+    data = pickle.dumps(ps.lookup["Linux64"], protocol=2)
+    print("%-34s %8.1f MB" % ("pickled size", len(data) / 1.0e6))
+
+    lookup, mem, t = measure(lambda: pickle.loads(data))
+    report("unpickle stack", mem, t)
+
+    def getAll():
+        return [ps.getProduct(name, version, "Linux64")
+                for name in ps.getProductNames("Linux64")
+                for version in ps.getVersions(name, "Linux64")]
+    prods, mem, t = measure(getAll)
+    report("get all %d Products" % len(prods), mem, t)
+
+if __name__ == "__main__":
+    run(*[int(a) for a in sys.argv[1:]])
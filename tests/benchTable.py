@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+A benchmark of the time taken to parse table files, using the lexer in
+eups.table and (for comparison) the regular-expression based path that is
+used for old-style tables.  The tables in tests/ and a synthetic corpus are
+used.  This is not part of the test suite; run it directly:
+
+   python tests/benchTable.py [ntable [nrepeat]]
+
+By default, a corpus of 2000 synthetic tables is parsed 3 times.
+"""
+from __future__ import print_function
+import glob
+import os
+import sys
+import time
+
+import testCommon
+from testCommon import testEupsStack
+from eups import table
+from eups.table import Table
+
+def testTables():
+    """return the (file, lines) of the table files in tests/"""
+    tables = []
+    for dirpath, dirnames, filenames in os.walk(testEupsStack):
+        for f in sorted(filenames):
+            if f.endswith(".table"):
+                fd = open(os.path.join(dirpath, f))
+                tables.append((os.path.join(dirpath, f), fd.readlines()))
+                fd.close()
+    return tables
+
+def makeTable(i):
+    """return the lines of a synthetic table file, exercising most of the syntax"""
+    lines = [
+        "# synthetic table %d\n" % i,
+        "\n",
+        "setupRequired(python)        # any version\n",
+        "setupRequired(numpy 1.%d.0 [>= 1.6])\n" % (i % 10),
+        "  setupOptional( \"doxygen\" , \"1.8\" )\n",
+        "setupRequired(-j afw -t current)\n",
+        "envPrepend(PATH, ${PRODUCT_DIR}/bin)\n",
+        "envPrepend(LD_LIBRARY_PATH, ${PRODUCT_DIR}/lib)\n",
+        "pathAppend(PYTHONPATH, ${PROD_DIR}/python, \":\")\n",
+        "envSet(PROD%d_CONF, \"${UPS_PROD_DIR}/etc/a b,c.conf\")\n" % i,
+        "envSet(GREETING, \"he said \\\"hi\\\", then left\")\n",
+        "envAppend(SEP, \" \")\n",
+        "addAlias(ll%d, ls -l)\n" % i,
+        "unsetenv(PRODUCT_DIR)\n",
+        "if (type == build) {\n",
+        "    setupRequired(scons)\n",
+        "    envSet(CC, gcc)\n",
+        "} else if (flavor == DarwinX86 || FLAVOR == Linux64) {\n",
+        "    setupOptional(mkl)\n",
+        "} else {\n",
+        "    print(stdwarn, \"no build\")\n",
+        "}\n",
+        "IF (Type == Exact) {\n",
+        "   setupRequired(boost -j 1.%d)\n" % i,
+        "}\n",
+        "if (a) {\n",
+        "}\n",
+        ]
+    if i % 20 == 0:                     # an old-style table
+        lines[0:0] = ["File = Table\n", "Product = synth%d\n" % i, "Group:\n",
+                      "  Flavor = ANY\n", "  Qualifiers = \"\"\n", "Common:\n",
+                      "  Action = setup\n", "End:\n", "Flavor = Linux\n", "Flavor = Linux64\n"]
+    return lines
+
+def parse(tableFile, lines, lexer=True):
+    """parse the lines of a table file, using the lexer or the regular expression path"""
+    if lexer:
+        return Table(tableFile, addDefaultProduct=False, contents=lines)
+
+    lexTable = table._lexTable
+    def rewrite(contents):
+        raise table._OldStyleTable()
+    table._lexTable = rewrite
+    try:
+        return Table(tableFile, addDefaultProduct=False, contents=lines)
+    finally:
+        table._lexTable = lexTable
+
+def run(ntable=2000, nrepeat=3):
+    corpora = [("tests/*.table", testTables()),
+               ("%d synthetic tables" % ntable,
+                [("synth%d.table" % i, makeTable(i)) for i in range(ntable)])]
+
+    for what, tables in corpora:
+        for lexer in (False, True):
+            t = time.time()
+            for i in range(nrepeat):
+                for tableFile, lines in tables:
+                    parse(tableFile, lines, lexer)
+            t = (time.time() - t)/nrepeat
+            print("%-24s %-8s %8.1f ms" % (what, lexer and "lexer" or "regexp", 1e3*t))
+
+if __name__ == "__main__":
+    run(*[int(a) for a in sys.argv[1:]])
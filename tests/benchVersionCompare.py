@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+A benchmark of the time taken to sort versions: by key (as eups now does),
+by comparing versions that are parsed once, and by comparing versions that
+are split in every comparison (as eups used to).  This is not part of the
+test suite, which only checks that the orders agree (see
+testVersionCompare); run it directly:
+
+   python tests/benchVersionCompare.py [nversion [niter]]
+
+By default, 200 random versions are sorted 20 times.
+"""
+from __future__ import print_function
+import functools
+import random
+import sys
+import time
+
+import testCommon
+from eups.VersionCompare import VersionCompare, versionSortKey
+from testVersionCompare import UnparsedVersionCompare, randomVersions
+
+def timeSort(versions, niter, vcmp, useKey):
+    """return the time taken to sort versions niter times"""
+    t = time.time()
+    for i in range(niter):
+        if useKey:
+            sorted(versions, key=versionSortKey(vcmp, versions))
+        else:
+            sorted(versions, key=functools.cmp_to_key(vcmp))
+    return time.time() - t
+
+def run(nversion=200, niter=20):
+    versions = randomVersions(random.Random(42), nversion)
+    for what, vcmp, useKey in [("unparsed", UnparsedVersionCompare(), False),
+                               ("compare", VersionCompare(), False),
+                               ("keys", VersionCompare(), True)]:
+        t = timeSort(versions, niter, vcmp, useKey)
+        print("%-10s %8.2f ms per sort of %d versions" % (what, 1e3*t/niter, nversion))
+
+if __name__ == "__main__":
+    run(*[int(a) for a in sys.argv[1:]])
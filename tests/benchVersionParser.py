@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+A benchmark of the time taken to evaluate the logical expressions found in
+table files: compiled and cached (as eups now does), interpreted, and parsed
+afresh every time (as eups used to).  This is not part of the test suite,
+which only checks that the compiled and interpreted expressions agree (see
+testVersionParser); run it directly:
+
+   python tests/benchVersionParser.py [niter]
+
+By default, each expression is evaluated 1000 times.
+"""
+from __future__ import print_function
+import sys
+import time
+
+import testCommon
+from eups.VersionParser import VersionParser
+vp = sys.modules["eups.VersionParser"] # not the class of the same name
+
+expressions = ["type == build", "FLAVOR == Linux64", "flavor == DarwinX86 || flavor == Linux64",
+               "TYPE == exact", "depth <= 2", "True"]
+
+def timeEval(niter, interpret=False, cached=True):
+    """return the time taken to evaluate the expressions niter times"""
+    t = time.time()
+    for i in range(niter):
+        for exprStr in expressions:
+            if not cached:
+                vp._cache.clear()
+            parser = VersionParser(exprStr)
+            parser.define("flavor", "Linux64")
+            parser.define("type", ["build"])
+            parser.define("depth", 1)
+            if interpret:
+                parser._interpret()
+            else:
+                parser.eval()
+    return time.time() - t
+
+def run(niter=1000):
+    n = niter*len(expressions)
+    for what, interpret, cached in [("uncached", True, False),
+                                    ("interpreted", True, True),
+                                    ("compiled", False, True)]:
+        t = timeEval(niter, interpret, cached)
+        print("%-12s %8.2f us per expression" % (what, 1e6*t/n))
+
+if __name__ == "__main__":
+    run(*[int(a) for a in sys.argv[1:]])
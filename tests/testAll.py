@@ -12,12 +12,15 @@ for t in [
     "testCmd",
     "testDeprecated",
     "testDb",
+    "testDaemon",
     "testEups",
     "testMisc",
     "testProduct",
     "testStack",
     "testTable",
     "testTags",
+    "testVersionCompare",
+    "testVersionParser",
     "testDyldLibraryPath",
     "testEupspkg",
     ]:
@@ -14,6 +14,7 @@ from testCommon import testEupsStack
 import eups.cmd
 import eups.hooks as hooks
 from eups import Tag, TagNotRecognized
+from eups.db import Database
 
 prog = "eups"
 
@@ -401,7 +402,135 @@ class SetupCmdTestCase(unittest.TestCase):
         hooks.config.Eups.defaultTags = dict(pre=[], post=[]) # disable any defined in the startup.py file
         cmd = eups.setupcmd.EupsSetup(args=cmd.split(), toolname=prog)
         self.assertEqual(cmd.run(), 0)
-        
+
+    def testSetupAlso(self):
+        hooks.config.Eups.defaultTags = dict(pre=[], post=[]) # disable any defined in the startup.py file
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["PATH"] = "/bin:/usr/bin"
+        environ = os.environ.copy()
+        pdir = os.path.join(testEupsStack, "Linux", "python", "2.5.2")
+        tdir = os.path.join(testEupsStack, "Linux", "tcltk", "8.5a4")
+
+        cmd = eups.setupcmd.EupsSetup(args=["tcltk", "--also", "-j python 2.5.2"], toolname=prog)
+        self.assertEqual(cmd.run(), 0)
+        cmds = self.out.getvalue().split(";\n")
+        self.assertIn("export TCLTK_DIR=%s" % tdir, cmds)
+        self.assertIn("export PYTHON_DIR=%s" % pdir, cmds)
+        self.assertIn("export PATH=%s/bin:%s/bin:/bin:/usr/bin" % (pdir, tdir), cmds)
+        self.assertNotIn("false", cmds)
+
+        # a product that can't be setup leaves the others alone
+        os.environ = environ.copy()
+        self._resetOut()
+        cmd = eups.setupcmd.EupsSetup(args="-q python --also nosuchproduct".split(), toolname=prog)
+        self.assertEqual(cmd.run(), 0)
+        cmds = self.out.getvalue().strip().split(";\n")
+        self.assertIn("export TCLTK_DIR=%s" % tdir, cmds)
+        self.assertEquals(cmds[-1], "false")
+
+        # -j only applies to the product that it's given for
+        os.environ = environ.copy()
+        self._resetOut()
+        cmd = eups.setupcmd.EupsSetup(args=["-j", "doxygen", "--also", "python 2.5.2"], toolname=prog)
+        self.assertEqual(cmd.run(), 0)
+        cmds = self.out.getvalue().strip().split(";\n")
+        self.assertIn("export TCLTK_DIR=%s" % tdir, cmds)
+        self.assert_([c for c in cmds if c.startswith("export DOXYGEN_DIR=")])
+        self.assertNotIn("false", cmds)
+
+        os.environ = environ.copy()
+        cmd = eups.setupcmd.EupsSetup(args=["python", "--also", "-j"], toolname=prog)
+        self.assertEqual(cmd.run(), 3)
+        cmd = eups.setupcmd.EupsSetup(args="-r . python --also tcltk".split(), toolname=prog)
+        self.assertEqual(cmd.run(), 3)
+
+    def testSetupConflicts(self):
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        Eups = eups.Eups(readCache=False)
+
+        self.assertEquals(eups.findSetupConflicts(Eups, ["python", ("tcltk", "8.5a4")]), [])
+        msgs = eups.findSetupConflicts(Eups, ["tcltk", ("python", "2.6"), ("python", "2.5.2", True)])
+        self.assertEquals(len(msgs), 1)
+        self.assertIn("python are required: 2.6 by python; 2.5.2 by python", msgs[0])
+
+    def testSnapshot(self):
+        hooks.config.Eups.defaultTags = dict(pre=[], post=[]) # disable any defined in the startup.py file
+        snapfile = os.path.join(testEupsStack, "python.snapshot")
+        generation = os.path.join(self.dbpath, ".generation")
+        hadGeneration = os.path.exists(generation)
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        environ = os.environ.copy()
+
+        def setup(args):
+            # run setup in the initial environment, returning the sorted commands it issued
+            os.environ = environ.copy()
+            self._resetOut()
+            cmd = eups.setupcmd.EupsSetup(args=args.split(), toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            return sorted(self.out.getvalue().split(";\n"))
+
+        try:
+            # a database without a generation can't be relied upon
+            if os.path.exists(generation):
+                os.remove(generation)
+            cmd = eups.cmd.EupsCmd(args=("snapshot -q -o %s python 2.5.2" % snapfile).split(),
+                                   toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assertRaises(eups.StaleSnapshot, eups.Snapshot.read(snapfile).check)
+
+            Database(self.dbpath)._bumpGeneration()
+            os.environ = environ.copy()
+            cmd = eups.cmd.EupsCmd(args=("snapshot -q -o %s python 2.5.2" % snapfile).split(),
+                                   toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assert_(os.path.exists(snapfile))
+
+            cmds = setup("python 2.5.2")
+            self.assert_("export TCLTK_DIR=%s" % os.environ["TCLTK_DIR"] in cmds)
+            self.assertEquals(setup("--from-snapshot %s" % snapfile), cmds)
+            self.assertEquals(setup("--from-snapshot %s python" % snapfile), cmds)
+
+            # the snapshot doesn't depend on what else is in the environment
+            environ["PATH"] = "/somewhere/else:" + environ["PATH"]
+            cmds = setup("python 2.5.2")
+            self.assertEquals(setup("--from-snapshot %s" % snapfile), cmds)
+
+            snap = eups.Snapshot.read(snapfile)
+            self.assertEquals(type(snap.productName), str) # not unicode, as json returns in python 2
+            for name, (old, new) in snap.environ.items():
+                self.assertEquals(type(name), str)
+                self.assert_(new is None or type(new) is str)
+            os.environ = environ.copy()
+            eups.setupFromSnapshot(snap, eups.Eups(readCache=False))
+            self.assertEquals(os.environ["PYTHON_DIR"],
+                              os.path.join(testEupsStack, "Linux", "python", "2.5.2"))
+
+            # once the database changes, the snapshot is out of date and the setup is done in
+            # the usual way
+            Database(self.dbpath)._bumpGeneration()
+            os.environ = environ.copy()
+            self.assertRaises(eups.StaleSnapshot, snap.check)
+            self.assertRaises(eups.StaleSnapshot, eups.setupFromSnapshot, snap,
+                              eups.Eups(readCache=False))
+            self.assertEquals(setup("-q --from-snapshot %s" % snapfile), cmds)
+
+            # as it was asked for when the snapshot was made
+            os.environ = environ.copy()
+            cmd = eups.cmd.EupsCmd(args=("snapshot -q -t current -o %s python" % snapfile).split(),
+                                   toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            snap = eups.Snapshot.read(snapfile)
+            self.assertEquals((snap.versionName, snap.tags, snap.version), (None, ["current"], "2.5.2"))
+            self.assertEquals(snap.postTags, [])
+
+            Database(self.dbpath)._bumpGeneration()
+            self.assertEquals(setup("-q --from-snapshot %s" % snapfile), setup("-t current python"))
+        finally:
+            if os.path.exists(snapfile):
+                os.remove(snapfile)
+            if not hadGeneration and os.path.exists(generation):
+                os.remove(generation)
+
 
 class Stdout(object):
 
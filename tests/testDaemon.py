@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Tests for eups.daemon and the eupsclient module
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import testCommon
+from testCommon import testEupsStack
+
+import eups
+import eupsclient
+from eups import hooks
+from eups.daemon import Daemon, isRunning, stopDaemon
+
+class DaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["EUPS_SHELL"] = "sh"
+        os.environ.pop("EUPS_NO_DAEMON", None)
+
+        # Unix socket names are short, so keep this out of the test directory
+        self.tmpdir = tempfile.mkdtemp(prefix="eupsd")
+        self.socket = os.path.join(self.tmpdir, "sock")
+        hooks.loadCustomization(execute=False, reset=True, path=eups.Eups.setEupsPath())
+        self.config0 = hooks.saveConfig()
+
+        self.daemon = Daemon(self.socket, idleTimeout=60)
+        self.daemon.listen()
+
+    def tearDown(self):
+        if isRunning(self.socket):
+            stopDaemon(self.socket)
+        shutil.rmtree(self.tmpdir)
+        os.environ.clear()
+        os.environ.update(self.environ0)
+        hooks.restoreConfig(self.config0)
+
+    def serve(self, client):
+        """
+        run client() in a thread while the daemon serves in this one (eups
+        sets signal handlers, which only the main thread may do), stopping
+        the daemon once client() has returned.  Return client()'s result.
+        """
+        result = []
+        def run():
+            try:
+                result.append(client())
+            finally:
+                stopDaemon(self.socket)
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.daemon.serve()
+        thread.join()
+
+        self.assertEquals(len(result), 1)
+        return result[0]
+
+    def testSetup(self):
+        def client():
+            running = isRunning(self.socket)
+            ok = eupsclient.request("setup", ["python", "2.5.2"], path=self.socket)
+            warm = len(eups.Eups.warmStacks)
+            bad = eupsclient.request("setup", ["nosuchproduct"], stderr=open(os.devnull, "w"),
+                                     path=self.socket)
+            return running, ok, warm, bad
+        running, ok, warm, bad = self.serve(client)
+
+        self.assert_(running)
+        self.assert_(ok is not None)
+        status, stdout = ok
+        self.assertEquals(status, 0)
+        pdir = os.path.join(testEupsStack, "Linux", "python", "2.5.2")
+        self.assert_("export PYTHON_DIR=%s" % pdir in stdout)
+
+        # the daemon's own state is untouched, but its stacks were kept
+        self.assert_("PYTHON_DIR" not in os.environ or os.environ["PYTHON_DIR"] != pdir)
+        self.assert_(warm > 0)
+
+        # errors are reported to the shell, as they are in-process
+        self.assert_(bad is not None)
+        self.assert_("false" in bad[1].split())
+
+    def testEups(self):
+        def client():
+            return [eupsclient.request("eups", argv, path=self.socket) for argv in
+                    (["list", "python"],
+                     ["declare", "foo", "1.0", "-r", "none"],
+                     ["admin", "daemon", "--stop"],
+                     ["--debug=raise", "list"])]
+        results = self.serve(client)
+
+        status, stdout = results[0]
+        self.assertEquals(status, 0)
+        self.assert_("2.5.2" in stdout)
+
+        # commands that can change a database are run by the client
+        for result in results[1:]:
+            self.assert_(result is None)
+
+    def testConfig(self):
+        # the changes that commands make to the configuration are undone
+        hooks.config.Eups.userTags = []
+        status, stdout = self.serve(lambda: eupsclient.request("eups", ["list", "python"],
+                                                               path=self.socket))
+        self.assertEquals(status, 0)
+        self.assertEquals(hooks.config.Eups.userTags, [])
+
+    def testStop(self):
+        self.assert_(self.serve(lambda: True))
+        self.assert_(not os.path.exists(self.socket))
+        self.assert_(not isRunning(self.socket))
+
+        # with no daemon, the client runs commands itself
+        self.assert_(eupsclient.request("eups", ["list"], path=self.socket) is None)
+        self.assert_(not stopDaemon(self.socket))
+
+class ClientTestCase(unittest.TestCase):
+
+    def testSocketPath(self):
+        self.assertEquals(eupsclient.socketPath({"EUPS_DAEMON_SOCKET" : "/tmp/sock",
+                                                 "EUPS_USERDATA" : "/tmp/eups"}), "/tmp/sock")
+        self.assertEquals(eupsclient.socketPath({"EUPS_USERDATA" : "/tmp/eups"}),
+                          "/tmp/eups/_caches_/daemon.sock")
+
+    def testDisabled(self):
+        environ0 = os.environ.copy()
+        try:
+            os.environ["EUPS_NO_DAEMON"] = "1"
+            self.assert_(eupsclient.run("eups", ["list"]) is None)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ0)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        ClientTestCase,
+        DaemonTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
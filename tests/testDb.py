@@ -484,10 +484,17 @@ class DatabaseTestCase(unittest.TestCase):
         if os.path.isfile(self.pycur+".bak"):
             os.rename(self.pycur+".bak", self.pycur)
 
+        self.generation = os.path.join(self.dbpath, ".generation")
+        if os.path.exists(self.generation):
+            os.remove(self.generation)
+
     def tearDown(self):
         if os.path.isfile(self.pycur+".bak"):
             os.rename(self.pycur+".bak", self.pycur)
 
+        if os.path.exists(self.generation):
+            os.remove(self.generation)
+
         if os.path.exists(self.userdb) and self.userdb.endswith("user_ups_db"):
             
             os.system("rm -rf " + self.userdb)
@@ -652,6 +659,29 @@ class DatabaseTestCase(unittest.TestCase):
         self.assert_(not os.path.exists(os.path.join(self.userdb,
                                                      "python","my.chain")))
 
+    def testGeneration(self):
+        self.assert_(self.db.getGeneration() is None)
+
+        tfile = self.db._tagFile("python", "beta")
+        try:
+            self.db.assignTag("beta", "python", "2.6")
+            self.assertEquals(self.db.getGeneration(), 1)
+            self.assert_(self.db.unassignTag("beta", "python"))
+            self.assertEquals(self.db.getGeneration(), 2)
+            self.assert_(not self.db.unassignTag("beta", "python"))
+            self.assertEquals(self.db.getGeneration(), 2)
+        finally:
+            if os.path.exists(tfile):  os.remove(tfile)
+
+        gens = self.db.getGenerations()
+        self.assertEquals(gens[self.dbpath], 2)
+        self.assert_(gens[self.userdb] is None)
+
+        # user tags are counted in the user's area
+        self.db.assignTag("user:my", "python", "2.5.2")
+        self.assertEquals(self.db.getGeneration(self.userdb), 1)
+        self.assertEquals(self.db.getGeneration(), 2)
+
     def testAssignTag(self):
         if not os.path.exists(self.pycur+".bak"):
             shutil.copyfile(self.pycur, self.pycur+".bak")
@@ -787,6 +817,209 @@ class DatabaseTestCase(unittest.TestCase):
                           os.remove(f)
                   os.removedirs(pdir)
             raise
+
+    def testDeclareList(self):
+        pdir = self.db._productDir("base")
+        self.assert_(not os.path.exists(pdir))
+        baseidir = os.path.join(testEupsStack,"Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir, 
+                       os.path.join(baseidir, "ups/base.table"))
+        base2 = base.clone()
+        base2.version = "2.0"
+        base3 = base.clone()
+        base3.version = "3.0"
+
+        self.db.declare(base)
+        try:
+            # a failed declaration of several products undoes the rest of
+            # it, but leaves alone those that were already declared
+            bad = Product("bad", None, "Linux", baseidir, 
+                          os.path.join(baseidir, "ups/base.table"))
+            self.assertRaises(UnderSpecifiedProduct, self.db.declare, 
+                              [base2, base, base3, bad])
+            self.assertEquals([p.version for p in self.db.findProducts("base")],
+                              ["1.0"])
+
+            self.db.declare([base2, base3])
+            self.assertEquals(len(self.db.findProducts("base")), 3)
+        finally:
+            for p in [base, base2, base3]:
+                self.db.undeclare(p)
+        self.assert_(not os.path.exists(pdir))
+                           
+from eups.db import SqliteDatabase
+from eups import UnderSpecifiedProduct
+
+class SqliteDatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stack = os.path.join(testEupsStack, "sqlite_stack")
+        if os.path.exists(self.stack):
+            shutil.rmtree(self.stack)
+        self.dbpath = os.path.join(self.stack, "ups_db")
+        shutil.copytree(os.path.join(testEupsStack, "ups_db"), self.dbpath,
+                        ignore=shutil.ignore_patterns("*DB1_3_0", ".generation"))
+        self.userdb = os.path.join(self.stack, "user_ups_db")
+        os.makedirs(self.userdb)
+
+        self.nprod = SqliteDatabase.toSqlite(self.dbpath)
+        self.db = Database(self.dbpath, self.userdb)
+
+    def tearDown(self):
+        SqliteDatabase._forgetDatabases(self.dbpath)
+        if os.path.exists(self.stack):
+            shutil.rmtree(self.stack)
+
+    def testConversion(self):
+        self.assertEquals(self.nprod, 6)
+        self.assert_(isinstance(self.db, SqliteDatabase._SqliteDatabase))
+        self.assert_(os.path.isfile(os.path.join(self.dbpath, "eups.sqlite3")))
+        self.assert_(not os.path.exists(os.path.join(self.dbpath, "python")))
+        self.assertEquals(self.db.getGeneration(), 1)
+
+        SqliteDatabase.fromSqlite(self.dbpath)
+        self.assert_(not os.path.exists(os.path.join(self.dbpath, "eups.sqlite3")))
+        db = Database(self.dbpath, self.userdb)
+        self.assert_(not isinstance(db, SqliteDatabase._SqliteDatabase))
+        self.assertEquals(db.getGeneration(), 2)
+
+        # the round trip preserves the declarations and tags
+        orig = Database(os.path.join(testEupsStack, "ups_db"))
+        for prod in orig.findProductNames():
+            for vers in orig.findVersions(prod):
+                vf = VersionFile(db._versionFile(prod, vers))
+                self.assertEquals(vf.info, 
+                                  VersionFile(orig._versionFile(prod, vers)).info)
+            self.assertEquals(sorted(db.getTagAssignments(prod)), 
+                              sorted(orig.getTagAssignments(prod)))
+
+    def testFind(self):
+        prods = self.db.findProductNames()
+        self.assertEquals(len(prods), 6)
+        self.assertIn("doxygen", prods)
+        self.assertEquals(sorted(self.db.findVersions("doxygen")), 
+                          ["1.5.7.1", "1.5.9"])
+        self.assertEquals(len(self.db.findVersions("goober")), 0)
+        self.assertEquals(sorted(self.db.findFlavors("doxygen")), 
+                          ["Linux", "Linux64"])
+        self.assertEquals(self.db.findFlavors("doxygen", "1.5.9"), ["Linux64"])
+
+        self.assert_(self.db.isDeclared("doxygen"))
+        self.assert_(self.db.isDeclared("doxygen", "1.5.9", "Linux64"))
+        self.assert_(self.db.isDeclared("doxygen", flavor="Linux"))
+        self.assert_(not self.db.isDeclared("doxygen", "1.5.9", "Linux"))
+        self.assert_(not self.db.isDeclared("goober"))
+
+        self.assertRaises(ProductNotFound, self.db.findTags, 
+                          "goober", "1.5.9", "Linux64")
+        self.assertEquals(self.db.findTags("doxygen", "1.5.7.1", "Linux"), 
+                          ["current"])
+
+        self.assert_(self.db.findProduct("doxygen", "1.5.9", "Linux") is None)
+        prod = self.db.findProduct("python", "2.5.2", "Linux")
+        self.assertEquals(prod.db, self.dbpath)
+        expect_pdir = os.path.join(self.stack, "Linux/python/2.5.2")
+        self.assertEquals(prod.dir, expect_pdir)
+        self.assertEquals(prod.tablefile, 
+                          os.path.join(expect_pdir, "ups", "python.table"))
+        self.assertEquals(prod.tags, ["current"])
+
+        prods = self.db.findProducts("doxygen")
+        self.assertEquals(len(prods), 2)
+        prod = next(d for d in prods if d.version == "1.5.7.1")
+        self.assertEquals(prod.tags, ["current"])
+        self.assertEquals(prod.tablefile, "none")
+
+    def testNativeStrings(self):
+        # text comes back as str (not unicode under python 2), so products
+        # read from SQLite are the same as those read from the files
+        for prod in self.db.findProductNames():
+            self.assert_(type(prod) is str, repr(prod))
+            for vers in self.db.findVersions(prod):
+                self.assert_(type(vers) is str, repr(vers))
+
+        filedb = Database(os.path.join(testEupsStack, "ups_db"))
+        for name, vers, flavor in [("python", "2.5.2", "Linux"),
+                                   ("doxygen", "1.5.9", "Linux64"),
+                                   ("doxygen", "1.5.7.1", "Linux")]:
+            prod = self.db.findProduct(name, vers, flavor)
+            expected = filedb.findProduct(name, vers, flavor)
+            self.assertEquals(type(prod.name), str)
+            self.assertEquals(type(prod.version), str)
+            self.assertEquals((prod.name, prod.version, prod.flavor),
+                              (expected.name, expected.version, expected.flavor))
+            self.assertEquals(prod.tags, expected.tags)
+            if expected.tablefile == "none":
+                self.assertEquals(prod.tablefile, "none")
+            else:
+                self.assertEquals(os.path.relpath(prod.tablefile, prod.dir),
+                                  os.path.relpath(expected.tablefile, expected.dir))
+
+    def testTags(self):
+        self.assertEquals(self.db.getTaggedVersion("current", "python", "Linux"),
+                          "2.5.2")
+        self.assertRaises(ProductNotFound, 
+                          self.db.assignTag, "current", "python", "2.7")
+
+        self.db.assignTag("beta", "doxygen", "1.5.9")
+        self.db.assignTag("beta", "doxygen", "1.5.7.1")
+        self.assertEquals(self.db.getTaggedVersion("beta", "doxygen", "Linux64"),
+                          "1.5.9")
+        self.assertEquals(self.db.getTaggedVersion("beta", "doxygen", "Linux"),
+                          "1.5.7.1")
+        self.assertEquals(self.db.getGeneration(), 3)
+
+        stamps = self.db.getProductStamps()
+        self.assertEquals(list(self.db.getProductStamps(["goober", "python"]).keys()), 
+                          ["python"])
+        self.assert_(self.db.unassignTag("beta", "doxygen", "Linux64"))
+        self.assert_(not self.db.unassignTag("beta", "doxygen", "Linux64"))
+        self.assert_(self.db.getTaggedVersion("beta", "doxygen", "Linux64") is None)
+        newstamps = self.db.getProductStamps()
+        self.assertNotEqual(newstamps["doxygen"], stamps["doxygen"])
+        self.assertEquals(newstamps["python"], stamps["python"])
+
+        # user tags are still kept in files
+        self.db.assignTag("user:my", "python", "2.5.2")
+        self.assert_(os.path.exists(os.path.join(self.userdb, "python", "my.chain")))
+        self.assertEquals(self.db.findTags("python", "2.5.2", "Linux"), 
+                          ["current", "user:my"])
+        self.assertEquals(self.db.getGeneration(self.userdb), 1)
+        self.assertEquals(self.db.getGeneration(), 4)
+        self.assert_(self.db.unassignTag("user:my", "python"))
+        self.assert_(self.db.getTaggedVersion("user:my", "python", "Linux") is None)
+
+    def testDeclare(self):
+        baseidir = os.path.join(testEupsStack, "Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir, 
+                       os.path.join(baseidir, "ups/base.table"),
+                       tags=["current"])
+        base2 = base.clone()
+        base2.version = "2.0"
+        base2.tags = []
+
+        # a failed declaration of several products records none of them
+        bad = Product("bad", None, "Linux", baseidir, 
+                      os.path.join(baseidir, "ups/base.table"))
+        self.assertRaises(UnderSpecifiedProduct, self.db.declare, [base, base2, bad])
+        self.assert_(not self.db.isDeclared("base"))
+        self.assertEquals(self.db.getGeneration(), 1)
+
+        self.db.declare([base, base2])
+        self.assert_(not os.path.exists(self.db._productDir("base")))
+        prods = self.db.findProducts("base")
+        self.assertEquals(len(prods), 2)
+        prod = self.db.findProduct("base", "1.0", "Linux")
+        self.assertEquals(prod.dir, baseidir)
+        self.assertEquals(prod.tablefile, os.path.join(baseidir, "ups/base.table"))
+        self.assertEquals(prod.tags, ["current"])
+        self.assertEquals(self.db.getTaggedVersion("current", "base", "Linux"), "1.0")
+
+        self.assert_(self.db.undeclare(base))
+        self.assert_(not self.db.undeclare(base))
+        self.assert_(self.db.findProduct("base", "1.0", "Linux") is None)
+        self.assert_(self.db.getTaggedVersion("current", "base", "Linux") is None)
+        self.assertEquals(len(self.db.findProducts("base")), 1)
                            
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -797,6 +1030,7 @@ def suite(makeSuite=True):
         ChainFileTestCase,
         DatabaseTestCase,
         MacroSubstitutionTestCase,
+        SqliteDatabaseTestCase,
         VersionFileTestCase,
         ], makeSuite)
 
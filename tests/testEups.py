@@ -5,10 +5,12 @@ Tests for eups.Eups
 
 from __future__ import print_function
 import os
+import pickle
+import re
 import sys
 import shutil
+import tempfile
 import unittest
-import time
 from eups.utils import StringIO
 import testCommon
 from testCommon import testEupsStack
@@ -16,7 +18,11 @@ from testCommon import testEupsStack
 from eups import TagNotRecognized, ProductNotFound, EupsException
 from eups.Eups import Eups
 from eups.stack import ProductStack
+from eups.db import Database
 from eups.utils import Quiet
+from eups.table import Action
+from eups.UnsetupRecord import UnsetupRecord
+from eups import utils
 import eups.hooks
 
 class EupsTestCase(unittest.TestCase):
@@ -480,6 +486,179 @@ class EupsTestCase(unittest.TestCase):
         self.assertNotIn("TCLTK_DIR", os.environ)
         self.assertNotIn("SETUP_TCLTK", os.environ)
 
+    def testSetupPaths(self):
+        # path variables are written to the environment once the setup is done
+        os.environ["PATH"] = "/bin:/usr/bin:/bin"
+        os.environ.pop("LD_LIBRARY_PATH", None)
+        written = []
+        setEnv = self.eups.setEnv
+        def recordingSetEnv(key, *args, **kwargs):
+            written.append(key)
+            return setEnv(key, *args, **kwargs)
+        self.eups.setEnv = recordingSetEnv
+
+        self.eups.setup("python")
+        pdir = os.path.join(testEupsStack, "Linux", "python", "2.5.2")
+        tdir = os.path.join(testEupsStack, "Linux", "tcltk", "8.5a4")
+        self.assertEquals(os.environ["PATH"], "%s/bin:%s/bin:/bin:/usr/bin" % (pdir, tdir))
+        self.assertEquals(os.environ["LD_LIBRARY_PATH"], "%s/lib:%s/lib" % (pdir, tdir))
+        self.assertEquals(written.count("PATH"), 1)
+
+        self.eups.unsetup("python")
+        self.assertEquals(os.environ["PATH"], "/bin:/usr/bin")
+        self.assertEquals(os.environ["LD_LIBRARY_PATH"], "")
+
+    def testSetupState(self):
+        # getSetupProducts() only looks up products whose variables have changed
+        self.eups.setup("python")
+        names = sorted([p.name for p in self.eups.getSetupProducts()])
+        self.assertEquals(names, ["python", "tcltk"])
+
+        lookups = []
+        findSetupProduct = self.eups.findSetupProduct
+        def countingFind(*args, **kwargs):
+            lookups.append(args[0])
+            return findSetupProduct(*args, **kwargs)
+        self.eups.findSetupProduct = countingFind
+        findSetupVersion = self.eups.findSetupVersion
+        def countingFindVersion(*args, **kwargs):
+            lookups.append(args[0])
+            return findSetupVersion(*args, **kwargs)
+        self.eups.findSetupVersion = countingFindVersion
+
+        self.assertEquals(sorted([p.name for p in self.eups.getSetupProducts()]), names)
+        self.assertEquals(len(self.eups.getSetupProducts("tcltk")), 1)
+        self.assertEquals(lookups, [])
+
+        self.eups.setEnv("TCLTK_DIR", "/somewhere/else")
+        prods = dict([(p.name, p) for p in self.eups.getSetupProducts()])
+        self.assertEquals(sorted(prods.keys()), names)
+        self.assertEquals(prods["python"].dir, os.path.join(testEupsStack, "Linux", "python", "2.5.2"))
+        self.assertEquals(lookups, ["tcltk"])
+
+        del lookups[:]
+        self.eups.unsetup("tcltk")
+        self.assertEquals([p.name for p in self.eups.getSetupProducts()], ["python"])
+        self.assertEquals(self.eups.getSetupProducts("tcltk"), [])
+        self.assertNotIn("python", lookups)
+
+    def testUnsetupRecord(self):
+        # unsetup undoes what setup recorded, without looking in the stacks
+        os.environ["PATH"] = "/bin:/usr/bin"
+        self.eups.setup("python")
+        self.assert_(utils.unsetupEnvNameFor("python") in os.environ)
+        self.assert_(utils.unsetupEnvNameFor("tcltk") in os.environ)
+
+        lookups = []
+        findProduct = self.eups.findProduct
+        def countingFind(*args, **kwargs):
+            lookups.append(args[0])
+            return findProduct(*args, **kwargs)
+        self.eups.findProduct = countingFind
+
+        self.eups.unsetup("python")
+        self.assertEquals(lookups, [])
+        self.assertEquals(os.environ["PATH"], "/bin:/usr/bin")
+        for name in ("python", "tcltk"):
+            self.assert_(utils.setupEnvNameFor(name) not in os.environ)
+            self.assert_(utils.unsetupEnvNameFor(name) not in os.environ)
+
+        record = UnsetupRecord()
+        record.addAction(Action("t.table", Action.envPrepend, ["PATH", "/a b/bin:/c,d", ":"],
+                                {"append" : True}))
+        record.addAction(Action("t.table", Action.envSet, ["FOO", "${BAR}"], {}))
+        record.addAction(Action("t.table", Action.doPrint, ["hello"], {}))
+        record.addAction(Action("t.table", Action.setupRequired, ["tcltk", "-j", "8.5a4"],
+                                {"optional" : True}))
+        value = str(record)
+        self.assert_(re.search(r"^[A-Za-z0-9_./+@%,:-]+$", value))
+
+        actions = UnsetupRecord.fromString(value).getActions()
+        self.assertEquals([(a.cmd, a.args) for a in actions],
+                          [(Action.envPrepend, ["PATH", "/a b/bin:/c,d", ":"]),
+                           (Action.envSet, ["FOO"]),
+                           (Action.setupRequired, ["tcltk", "-j", "8.5a4"])])
+        self.assert_(actions[2].extra["optional"])
+        self.assertRaises(ValueError, UnsetupRecord.fromString, "x,FOO")
+
+    def testPrefetchTables(self):
+        # the table files of dependencies are read ahead of time, without changing the setup
+        os.environ["PATH"] = "/bin:/usr/bin"
+        taken = []
+        def recordTakes(e):
+            takePrefetchedTable = e.takePrefetchedTable
+            def recordingTake(product):
+                contents = takePrefetchedTable(product)
+                if contents is not None:
+                    taken.append(product.name)
+                return contents
+            e.takePrefetchedTable = recordingTake
+        recordTakes(self.eups)
+
+        self.eups.setup("python")
+        self.assertEquals(taken, ["tcltk"])
+        self.assert_(self.eups._tablePrefetcher is None) # the threads are stopped after the setup
+        pdir = os.path.join(testEupsStack, "Linux", "python", "2.5.2")
+        tdir = os.path.join(testEupsStack, "Linux", "tcltk", "8.5a4")
+        self.assertEquals(os.environ["PATH"], "%s/bin:%s/bin:/bin:/usr/bin" % (pdir, tdir))
+
+        # tables that are in the stack's TableCache aren't read ahead
+        tableCache = self.eups.versions[testEupsStack].getTableCache()
+        if tableCache is not None:
+            self.assert_(len(tableCache) > 0)
+            tableCache.save()
+            del taken[:]
+            e = Eups()
+            recordTakes(e)
+            os.environ["PATH"] = "/bin:/usr/bin"
+            e.setup("python")
+            self.assertEquals(taken, [])
+            self.assertEquals(os.environ["PATH"], "%s/bin:%s/bin:/bin:/usr/bin" % (pdir, tdir))
+
+        self.assertEquals(Action("t.table", Action.setupRequired, ["-f", "Linux", "tcltk", "8.5a4"],
+                                 {"optional" : False}).getDependencySpec(), ("tcltk", "8.5a4"))
+        self.assertEquals(Action("t.table", Action.setupRequired, ["-r", "/a/b"],
+                                 {"optional" : False}).getDependencySpec(), (None, None))
+
+    def testVersionMatch(self):
+        self.assertEquals(self.eups.version_match("12.1", ">= 12.0 && < 13"), "12.1")
+        self.assertEquals(self.eups.version_match("13.0", ">= 12.0 && < 13"), None)
+        self.assertEquals(self.eups.version_match("1.0", "< 2 || == 3"), "1.0")
+        self.assertEquals(self.eups.version_match("1.0", "> 2 && < 3"), False) # short circuit
+        self.assertEquals(self.eups.version_match("1.a", ">= 1.0"), None) # no sort order
+        self.assertRaises(IndexError, self.eups.version_match, "1.0", "< 1.0 || >=")
+        #
+        # The expression is split once, and the terms of a list of versions that can be sorted
+        # by key are evaluated by bisection
+        #
+        expr = ">= 12.0 && < 13 || == 1.2.3"
+        matcher = self.eups._versionMatcher(expr)
+        self.assert_(self.eups._versionMatcher(expr) is matcher)
+
+        versions = ["%d.%d" % (major, minor) for major in range(20) for minor in range(25)]
+        versions += ["1.2.3", "1.2.3+1", "12.0-rc1"]
+        self.assert_(matcher._isRange())
+        self.assert_(self.eups.version_cmp.rangeKey(versions) is not None)
+        self.assert_(self.eups.version_cmp.rangeKey(versions + ["12.a"]) is None)
+
+        expected = [v for v in versions if matcher.match(v)]
+        self.assertEquals(len(expected), 25) # the && short circuits, so 1.2.3 doesn't match
+        self.assertEquals(self.eups.versions_match(versions, expr), expected)
+
+        # bisection evaluates the expression for far fewer versions than matching them one at a time
+        nmatch = []
+        match = matcher.match
+        def countingMatch(vname, *args, **kwargs):
+            nmatch.append(vname)
+            return match(vname, *args, **kwargs)
+        matcher.match = countingMatch
+        try:
+            self.eups.versions_match(versions, expr)
+        finally:
+            del matcher.match
+        self.assert_(0 < len(nmatch) < len(versions)//10, "%d evaluations for %d versions" %
+                     (len(nmatch), len(versions)))
+
     def testRemove(self):
         os.environ = self.environ0
 
@@ -537,7 +716,14 @@ class EupsCacheTestCase(unittest.TestCase):
     def testDetectOutOfSync(self):
         e1 = Eups()
         e2 = Eups()
-        time.sleep(1)
+
+        # make the caches look old, so that the changes below are seen to be
+        # newer even where file times only have a resolution of a second
+        for dir, subdirs, files in os.walk(os.path.join(testEupsStack, "_userdata_")):
+            for file in files:
+                file = os.path.join(dir, file)
+                mtime = os.stat(file).st_mtime - 10
+                os.utime(file, (mtime, mtime))
 
         prod = e1.findProduct("newprod")
         self.assert_(prod is None, "Found not-yet declared product")
@@ -559,6 +745,189 @@ class EupsCacheTestCase(unittest.TestCase):
         prod = e2.findProduct("newprod")
         self.assert_(prod is not None, "Failed to declare product")
 
+    def testLazyLoading(self):
+        stack2 = os.path.join(testEupsStack, "_lazystack_")
+        os.makedirs(os.path.join(stack2, "ups_db"))
+        shutil.copyfile(os.path.join(self.dbpath, "global.tags"),
+                        os.path.join(stack2, "ups_db", "global.tags"))
+        os.environ["EUPS_PATH"] = ":".join([stack2, testEupsStack])
+
+        eups.hooks.config.Eups.lazyStackLoading = True
+        try:
+            Eups()                      # caches the lists of user tags
+            e = Eups()
+            self.assert_(stack2 in e.versions)
+            self.assertEquals(e.versions.loaded, [])
+
+            # python is not declared in the first stack, so only the second is read
+            prod = e.findProduct("python", "2.5.2")
+            self.assertEquals(prod.dir, os.path.join(testEupsStack, "Linux/python/2.5.2"))
+            self.assertEquals(e.versions.loaded, [testEupsStack])
+
+            # a product declared in both stacks is still found in the first
+            os.mkdir(os.path.join(stack2, "ups_db", "python"))
+            shutil.copyfile(os.path.join(self.dbpath, "python", "2.5.2.version"),
+                            os.path.join(stack2, "ups_db", "python", "2.5.2.version"))
+            e = Eups()
+            prod = e.findProduct("python", "2.5.2")
+            self.assertEquals(prod.dir, os.path.join(stack2, "Linux/python/2.5.2"))
+            self.assertEquals(e.versions.loaded, [stack2])
+
+            e.versions.loadAll()
+            self.assertEquals(sorted(e.versions.loaded), sorted(e.path))
+        finally:
+            eups.hooks.config.Eups.lazyStackLoading = False
+            shutil.rmtree(stack2)
+
+    def testLoadThreads(self):
+        # several stacks read at once by different threads are the same as when read one at a time
+        tmpdirs = [tempfile.mkdtemp() for i in range(3)]
+        cacheLoadThreads = eups.hooks.config.Eups.cacheLoadThreads
+        try:
+            for d in tmpdirs:
+                shutil.copytree(self.dbpath, os.path.join(d, "ups_db"),
+                                ignore=shutil.ignore_patterns(".generation", "Linux"))
+            os.environ["EUPS_PATH"] = ":".join(tmpdirs + [testEupsStack])
+
+            contents = []
+            for nthread in (1, 4, 4):   # the caches are written the first time, and read after that
+                eups.hooks.config.Eups.cacheLoadThreads = nthread
+                e = Eups()
+                self.assertEquals(e.versions.loaded[:len(e.path)], e.path)
+                contents.append([(p, sorted(e.versions[p].getProductNames("Linux")),
+                                  e.versions[p].getTaggedProduct("python", "Linux", "current").version,
+                                  e.versions[p].getTaggedProduct("tcltk", "Linux", "current").version)
+                                 for p in e.path if p in tmpdirs + [testEupsStack]])
+
+            self.assertEquals(len(contents[0]), 4)
+            self.assertEquals(contents[0][0][1:], (["cfitsio", "doxygen", "eigen", "mpich2",
+                                                    "python", "tcltk"], "2.5.2", "8.5a4"))
+            self.assertEquals(contents[1], contents[0])
+            self.assertEquals(contents[2], contents[0])
+        finally:
+            eups.hooks.config.Eups.cacheLoadThreads = cacheLoadThreads
+            for d in tmpdirs:
+                shutil.rmtree(d)
+
+    def testSetupPlan(self):
+        generation = os.path.join(self.dbpath, ".generation")
+        hadGeneration = os.path.exists(generation)
+        Database(self.dbpath)._bumpGeneration()
+        cacheSetupPlans = eups.hooks.config.Eups.cacheSetupPlans
+        eups.hooks.config.Eups.cacheSetupPlans = True
+        environ = os.environ.copy()
+
+        def setupPython():
+            # setup python in the initial environment, returning the 
+            # environment and the number of times a product was looked up
+            os.environ = environ.copy()
+            e = Eups()
+            lookups = []
+            findProductFromVRO = e.findProductFromVRO
+            def countingFind(*args, **kwargs):
+                lookups.append(args[0])
+                return findProductFromVRO(*args, **kwargs)
+            e.findProductFromVRO = countingFind
+
+            e.setup("python")
+            return os.environ.copy(), len(lookups)
+
+        try:
+            env, lookups = setupPython()
+            self.assert_(lookups > 0)
+            self.assertIn("SETUP_TCLTK", env)
+            self.assertIn("EUPS_UNSETUP_PYTHON", env)
+            self.assertEquals(len(Eups()._getSetupPlanCache()), 1)
+
+            # the second time, the setup is replayed without looking anything up
+            env2, lookups = setupPython()
+            self.assertEquals(lookups, 0)
+            self.assertEquals(env2, env)
+
+            # but not if the plan was cached by another major version of python
+            plans = Eups()._getSetupPlanCache().file
+            fd = open(plans, "rb")
+            data = pickle.load(fd)
+            fd.close()
+            self.assertEquals(data["python"], sys.version_info[0])
+            data["python"] = 5 - sys.version_info[0]
+            fd = open(plans, "wb")
+            pickle.dump(data, fd, protocol=2)
+            fd.close()
+            env2, lookups = setupPython()
+            self.assert_(lookups > 0)
+            self.assertEquals(env2, env)
+
+            # changing a table file or the database means resolving the setup again
+            table = os.path.join(testEupsStack, "Linux/tcltk/8.5a4/ups/tcltk.table")
+            st = os.stat(table)
+            os.utime(table, (st.st_atime, st.st_mtime + 10))
+            try:
+                env2, lookups = setupPython()
+                self.assert_(lookups > 0)
+                self.assertEquals(env2, env)
+            finally:
+                os.utime(table, (st.st_atime, st.st_mtime))
+
+            Database(self.dbpath)._bumpGeneration()
+            env2, lookups = setupPython()
+            self.assert_(lookups > 0)
+            env2, lookups = setupPython()
+            self.assertEquals(lookups, 0)
+
+            # so does having other products setup
+            os.environ = environ.copy()
+            Eups().setup("tcltk")
+            environ = os.environ.copy()
+            env2, lookups = setupPython()
+            self.assert_(lookups > 0)
+        finally:
+            eups.hooks.config.Eups.cacheSetupPlans = cacheSetupPlans
+            if not hadGeneration:
+                os.remove(generation)
+
+    def testSetupPlanEnvironment(self):
+        # a plan isn't saved if the actions taken depend on environment variables
+        generation = os.path.join(self.dbpath, ".generation")
+        hadGeneration = os.path.exists(generation)
+        Database(self.dbpath)._bumpGeneration()
+        cacheSetupPlans = eups.hooks.config.Eups.cacheSetupPlans
+        eups.hooks.config.Eups.cacheSetupPlans = True
+
+        table = os.path.join(testEupsStack, "Linux/python/2.5.2/ups/python.table")
+        fd = open(table)
+        contents = fd.read()
+        fd.close()
+        st = os.stat(table)
+        environ = os.environ.copy()
+        try:
+            fd = open(table, "a")
+            fd.write("""
+if (${PLAN_SWITCH:-0} == 1) {
+    envSet(PLANVAR, on)
+} else {
+    envSet(PLANVAR, off)
+}
+""")
+            fd.close()
+
+            for switch, value in [("0", "off"), ("1", "on"), ("0", "off")]:
+                os.environ = environ.copy()
+                os.environ["PLAN_SWITCH"] = switch
+                Eups().setup("python")
+                self.assertEquals(os.environ["PLANVAR"], value)
+
+            self.assertEquals(len(Eups()._getSetupPlanCache()), 0)
+        finally:
+            os.environ = environ
+            fd = open(table, "w")
+            fd.write(contents)
+            fd.close()
+            os.utime(table, (st.st_atime, st.st_mtime))
+            eups.hooks.config.Eups.cacheSetupPlans = cacheSetupPlans
+            if not hadGeneration:
+                os.remove(generation)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
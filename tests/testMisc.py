@@ -4,6 +4,7 @@ Miscellaneous Tests.  These might eventually be migrated into other test
 files.  
 """
 import os
+import pickle
 import sys
 import shutil
 import re
@@ -13,6 +14,7 @@ import testCommon
 from testCommon import testEupsStack
 
 import eups
+from eups import hooks
 
 class MiscTestCase(unittest.TestCase):
 
@@ -25,6 +27,141 @@ class MiscTestCase(unittest.TestCase):
     def testNothing(self):
         pass
 
+class StartupCacheTestCase(unittest.TestCase):
+    """test caching the configuration set by startup files"""
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        self.userTags0 = hooks.config.Eups.userTags
+        self.cacheStartupFiles0 = hooks.config.Eups.cacheStartupFiles
+        self.execute_file0 = hooks.execute_file
+
+        self.tmpdir = os.path.join(testEupsStack, "_startup_")
+        os.makedirs(os.path.join(self.tmpdir, "site"))
+        os.environ["EUPS_SITEDATA"] = os.path.join(self.tmpdir, "site")
+        os.environ["EUPS_USERDATA"] = self.tmpdir
+        os.environ.pop("EUPS_STARTUP", None)
+
+        self.executed = []
+        def countingExecute(startupFile):
+            self.executed.append(startupFile)
+            return self.execute_file0(startupFile)
+        hooks.execute_file = countingExecute
+
+    def tearDown(self):
+        hooks.execute_file = self.execute_file0
+        hooks.config.Eups.userTags = self.userTags0
+        hooks.config.Eups.cacheStartupFiles = self.cacheStartupFiles0
+        os.environ = self.environ0
+        hooks.loadCustomization(execute=False, reset=True)
+        shutil.rmtree(self.tmpdir)
+
+    def writeStartup(self, contents):
+        startup = os.path.join(self.tmpdir, "startup.py")
+        fd = open(startup, "w")
+        fd.write(contents)
+        fd.close()
+        return startup
+
+    def testCache(self):
+        startup = self.writeStartup("hooks.config.Eups.cacheStartupFiles = True\n"
+                                    "hooks.config.Eups.userTags += ['mine']\n")
+        hooks.config.Eups.userTags = []
+
+        self.assertEquals(hooks.loadCustomization(reset=True), [startup])
+        self.assertEquals(self.executed, [startup])
+        self.assertEquals(hooks.config.Eups.userTags, ["mine"])
+
+        # the second time, the file isn't executed
+        hooks.config.Eups.userTags = []
+        self.assertEquals(hooks.loadCustomization(reset=True), [startup])
+        self.assertEquals(self.executed, [startup])
+        self.assertEquals(hooks.config.Eups.userTags, ["mine"])
+
+        # nor by another major version of python (which has its own entries in the cache)
+        cacheFile = hooks._startupCacheFile()
+        fd = open(cacheFile, "rb")
+        data = pickle.load(fd)
+        fd.close()
+        self.assertEquals(list(data["entries"].keys()), [(sys.version_info[0], startup)])
+        data["entries"] = dict(((5 - sys.version_info[0], startup), entry)
+                               for entry in data["entries"].values())
+        fd = open(cacheFile, "wb")
+        pickle.dump(data, fd, protocol=2)
+        fd.close()
+        hooks.config.Eups.userTags = []
+        hooks.loadCustomization(reset=True)
+        self.assertEquals(self.executed, [startup, startup])
+        self.assertEquals(hooks.config.Eups.userTags, ["mine"])
+
+        # unless it changes
+        self.writeStartup("hooks.config.Eups.cacheStartupFiles = True\n"
+                          "hooks.config.Eups.userTags += ['yours']\n")
+        hooks.config.Eups.userTags = []
+        hooks.loadCustomization(reset=True)
+        self.assertEquals(len(self.executed), 3)
+        self.assertEquals(hooks.config.Eups.userTags, ["yours"])
+
+        # or stops asking for the cache to be used
+        self.writeStartup("hooks.config.Eups.userTags += ['theirs']\n")
+        hooks.config.Eups.cacheStartupFiles = False
+        for i in range(2):
+            hooks.config.Eups.userTags = []
+            hooks.loadCustomization(reset=True)
+            self.assertEquals(hooks.config.Eups.userTags, ["theirs"])
+        self.assertEquals(len(self.executed), 5)
+
+    def testNotCached(self):
+        # startup files are executed every time unless they turn on the cache
+        startup = self.writeStartup("hooks.config.Eups.userTags += ['mine']\n")
+        hooks.loadCustomization(reset=True)
+        hooks.loadCustomization(reset=True)
+        self.assertEquals(self.executed, [startup, startup])
+        self.assert_(not os.path.exists(hooks._startupCacheFile()))
+
+    def testCallbacks(self):
+        # startup files that define callbacks are always executed
+        startup = self.writeStartup("""
+hooks.config.Eups.cacheStartupFiles = True
+def callback(Eups, cmd, opts, args):
+    pass
+eups.commandCallbacks.add(callback)
+""")
+        try:
+            hooks.loadCustomization(reset=True)
+            hooks.loadCustomization(reset=True)
+        finally:
+            eups.commandCallbacks.clear()
+        self.assertEquals(self.executed, [startup, startup])
+
+class ImportTestCase(unittest.TestCase):
+    """test the modules imported by the eups commands (see benchImport for the time they take)"""
+
+    # modules that only the distrib commands should import
+    distribModules = ["eups.distrib", "urllib.request", "urllib2", "multiprocessing.pool"]
+
+    def testModuleBudgets(self):
+        import benchImport
+        base = benchImport.importedModules(benchImport.baseStatement)
+        self.assert_("eups" in base)
+        self.assert_(len(base) <= benchImport.baseModuleBudget,
+                     "%s imports %d modules" % (benchImport.baseStatement, len(base)))
+
+        for what, statement in benchImport.commands:
+            extra = benchImport.importedModules(statement) - base
+            self.assert_(len(extra) <= benchImport.moduleBudgets[what],
+                         "%s imports %d more modules: %s" % (what, len(extra), " ".join(sorted(extra))))
+
+    def testDistribImports(self):
+        import benchImport
+        for what, statement in benchImport.commands:
+            modules = benchImport.importedModules(statement)
+            if what.startswith("eups distrib"):
+                self.assert_("eups.distrib" in modules)
+            else:
+                for name in self.distribModules:
+                    self.assert_(name not in modules, "%s imports %s" % (what, name))
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -32,6 +169,8 @@ def suite(makeSuite=True):
 
     return testCommon.makeSuite([
         MiscTestCase,
+        StartupCacheTestCase,
+        ImportTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
@@ -5,6 +5,7 @@ Tests for eups.product
 
 import os
 import unittest
+import pickle
 
 import testCommon
 from testCommon import testEupsStack
@@ -50,6 +51,21 @@ class ProductTestCase(unittest.TestCase):
         self.assert_(self.prod._table is None)
         self.assert_(self.prod.tablefile is None)
 
+    def testPickle(self):
+        self.prod.tags = ["stable"]
+        p = pickle.loads(pickle.dumps(self.prod, protocol=2))
+        self.assertEqual(p.name, "eups")
+        self.assertEqual(p.dir, testEupsStack)
+        self.assertEqual(p.tags, ["stable"])
+        self.assert_(p.ups_dir is None)
+
+        # a Product pickled before it had __slots__
+        p = Product.__new__(Product)
+        p.__setstate__({"name": "eups", "version": "1.0", "dir": testEupsStack})
+        self.assertEqual(p.version, "1.0")
+        self.assertEqual(p.tags, [])
+        self.assert_(p._prodStack is None)
+
     def testStackRoot(self):
         self.assert_(self.prod.stackRoot() is None)
         self.prod.db = os.path.join(self.prod.dir, "ups_db")
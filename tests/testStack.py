@@ -4,6 +4,8 @@ Tests for eups.stack
 """
 
 import os
+import sys
+import pickle
 import unittest
 import time
 import testCommon
@@ -11,6 +13,7 @@ from testCommon import testEupsStack
 from eups.Product import ProductNotFound, Product
 
 from eups.stack import ProductFamily
+from eups import hooks
 
 class ProductFamilyTestCase(unittest.TestCase):
 
@@ -40,6 +43,25 @@ class ProductFamilyTestCase(unittest.TestCase):
         self.assertEqual(p.version, "3.1")
         self.assertEqual(p.dir, "/opt/LInux/magnum/3.1")
 
+    def testTablefile(self):
+        self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1", 
+                            "/opt/LInux/magnum/3.1/ups/magnum.table")
+        self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2/", 
+                            "/opt/LInux/magnum/3.2/ups/magnum.table")
+        self.fam.addVersion("3.3", "/opt/LInux/magnum/3.3", 
+                            "/opt/tables/magnum.table")
+        self.fam.addVersion("3.4", "/opt/LInux/magnum/3.4", "none")
+        self.assertEqual(self.fam.getProduct("3.1").tablefile, 
+                         "/opt/LInux/magnum/3.1/ups/magnum.table")
+        self.assertEqual(self.fam.getProduct("3.2").tablefile, 
+                         "/opt/LInux/magnum/3.2/ups/magnum.table")
+        self.assertEqual(self.fam.getProduct("3.3").tablefile, 
+                         "/opt/tables/magnum.table")
+        self.assertEqual(self.fam.getProduct("3.4").tablefile, "none")
+
+        # the relative path is shared by all versions
+        self.assert_(self.fam.versions["3.1"][1] is self.fam.versions["3.2"][1])
+
     def testAssignTag(self):
         self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
         self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2")
@@ -73,6 +95,74 @@ class ProductFamilyTestCase(unittest.TestCase):
         self.assert_(not self.fam.isTagAssigned("beta"))
         self.assert_(self.fam.isTagAssigned("current"))
 
+    def testTagsFor(self):
+        self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
+        self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2")
+        self.assertEquals(self.fam.getTagsFor("3.1"), [])
+        self.fam.assignTag("stable", "3.1")
+        self.fam.assignTag("current", "3.1")
+        self.fam.assignTag("beta", "3.2")
+        self.assertEquals(sorted(self.fam.getTagsFor("3.1")), ["current", "stable"])
+
+        # moving a tag removes it from the version it was assigned to
+        self.fam.assignTag("current", "3.2")
+        self.assertEquals(self.fam.getTagsFor("3.1"), ["stable"])
+        self.assertEquals(sorted(self.fam.getTagsFor("3.2")), ["beta", "current"])
+        self.assertEquals(sorted(self.fam.getProduct("3.2").tags), ["beta", "current"])
+
+        # removing a version removes its tags
+        self.assert_(self.fam.removeVersion("3.2"))
+        self.assert_(not self.fam.isTagAssigned("beta"))
+        self.assert_(not self.fam.isTagAssigned("current"))
+        self.assertEquals(self.fam.getTagsFor("3.2"), [])
+
+        # the reverse lookup is rebuilt for families pickled without it
+        state = self.fam.__dict__.copy()
+        del state["versionTags"]
+        fam = ProductFamily.__new__(ProductFamily)
+        fam.__setstate__(state)
+        self.assertEquals(fam.getTagsFor("3.1"), ["stable"])
+
+    def testVersionIndex(self):
+        for v in ["3.10", "3.2", "3.9"]:
+            self.fam.addVersion(v, "/opt/LInux/magnum/" + v)
+        self.assertEquals(self.fam.getLatestVersion(hooks.version_cmp), "3.10")
+        index = self.fam.getVersionIndex(hooks.version_cmp)
+        self.assertEquals(index.versions, ["3.2", "3.9", "3.10"])
+        self.assertEquals(index.bisect(hooks.version_cmp, "3.9"), (1, 2))
+
+        # the index is kept until the versions change
+        self.assert_(self.fam.getVersionIndex(hooks.version_cmp) is index)
+        self.fam.addVersion("3.9", "/opt/LInux/magnum/3.9")
+        self.assert_(self.fam.getVersionIndex(hooks.version_cmp) is index)
+        self.fam.addVersion("3.11", "/opt/LInux/magnum/3.11")
+        self.assertEquals(self.fam.getLatestVersion(hooks.version_cmp), "3.11")
+        self.assert_(self.fam.removeVersion("3.11"))
+        self.assertEquals(self.fam.getLatestVersion(hooks.version_cmp), "3.10")
+
+        # or the comparator does
+        def reversedCmp(v1, v2, mustReturnInt=True):
+            return hooks.version_cmp(v2, v1, mustReturnInt)
+        self.assertEquals(self.fam.getLatestVersion(reversedCmp), "3.2")
+        self.assertEquals(self.fam.getVersionIndex(reversedCmp).bisect(reversedCmp, "3.9"), None)
+        self.assertEquals(self.fam.getLatestVersion(hooks.version_cmp), "3.10")
+
+        # the index is pickled, but only if it was sorted by a VersionCompare
+        fam = pickle.loads(pickle.dumps(self.fam, protocol=2))
+        self.assertEquals(fam._versionIndex.versions, ["3.2", "3.9", "3.10"])
+        self.assert_(fam._versionIndex.isSortedBy(hooks.version_cmp))
+        self.fam.getVersionIndex(reversedCmp)
+        fam = pickle.loads(pickle.dumps(self.fam, protocol=2))
+        self.assert_(fam._versionIndex is None)
+        self.assertEquals(fam.getLatestVersion(hooks.version_cmp), "3.10")
+
+        # families pickled without an index get one when it's needed
+        state = self.fam.__dict__.copy()
+        del state["_versionIndex"]
+        fam = ProductFamily.__new__(ProductFamily)
+        fam.__setstate__(state)
+        self.assertEquals(fam.getLatestVersion(hooks.version_cmp), "3.10")
+
     def testExport(self):
         self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
         self.fam.addVersion("3.2", "/opt/LInux/magnum/3.2")
@@ -132,6 +222,13 @@ class ProductStackTestCase(unittest.TestCase):
         self.stack.addProduct(Product("fw", "1.2", "Darwin", 
                                       "/opt/sw/Darwin/fw/1.2", "none"))
 
+    def tearDown(self):
+        # forget the tables cached by the tests, which would otherwise be
+        # saved into the test stack at exit
+        cache = self.stack.getTableCache()
+        if cache is not None:
+            cache.clear()
+
     def testMisc(self):
         self.assertEquals(ProductStack.persistFilename("Linux"),
                           "Linux.pickleDB1_3_0")
@@ -424,6 +521,17 @@ class ProductStackTestCase(unittest.TestCase):
 
 
 from eups.stack import CacheOutOfSync
+from eups.db import Database
+from eups import hooks
+
+def backdate(*paths):
+    """
+    set the modification times of files back, so that a later change to 
+    them is noticed even where file times only have a resolution of a second
+    """
+    for path in paths:
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime - 10))
 
 class CacheTestCase(unittest.TestCase):
 
@@ -456,7 +564,12 @@ class CacheTestCase(unittest.TestCase):
                                      updateCache=True, verbose=1)
         ps2 = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
                                      updateCache=True, verbose=1)
-        time.sleep(1)
+
+        # make the cache look old, so that rewriting it is noticed even 
+        # where file times only have a resolution of a second
+        for file in list(ps2.modtimes.keys()):
+            backdate(file)
+            ps1.modtimes[file] = ps2.modtimes[file] = os.stat(file).st_mtime
         ps1.addProduct(Product("fw", "1.2", "Linux", 
                                "/opt/sw/Darwin/fw/1.2", "none"))
         self.assert_(ps1.cacheIsInSync())
@@ -467,7 +580,510 @@ class CacheTestCase(unittest.TestCase):
         ps2.addProduct(Product("fw", "1.2", "Linux", 
                                "/opt/sw/Darwin/fw/1.2", "none"))
         self.assertRaises(CacheOutOfSync, ps2.save)
+
+    def testRefreshChanged(self):
+        db = Database(self.dbpath)
+        pdir = os.path.join(self.dbpath, "base")
+        baseidir = os.path.join(testEupsStack, "Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir, 
+                       os.path.join(baseidir, "ups/base.table"))
+        cache = os.path.join(self.dbpath, 
+                             ProductStack.persistFilename("Linux", "indexed"))
+        try:
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, cacheFormat="indexed")
+            self.assert_(not ps.hasProduct("base"))
+            self.assertIn("python", ps.stamps["Linux"])
+            self.assertNotIn("base", ps.stamps["Linux"])
+
+            db.declare(base)
+            # make sure that the tag assignment below changes base's stamp
+            backdate(pdir, *[os.path.join(pdir, f) for f in os.listdir(pdir)])
+
+            # only the new product should get read in
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, cacheFormat="indexed")
+            self.assert_(ps.hasProduct("base", "Linux", "1.0"))
+            self.assert_(not ps.lookup["Linux"].isLoaded("python"))
+            self.assert_(ps.hasProduct("python", "Linux", "2.5.2"))
+            self.assertIn("base", ps.stamps["Linux"])
+
+            ps = ProductStack(self.dbpath, autosave=False, cacheFormat="indexed")
+            ps.reload("Linux")
+            self.assert_(ps.hasProduct("base", "Linux", "1.0"))
+
+            db.assignTag("beta", "base", "1.0")
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, cacheFormat="indexed")
+            self.assertEquals(ps.getTaggedProduct("base", "Linux", "beta").version,
+                              "1.0")
+
+            db.undeclare(base)
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, cacheFormat="indexed")
+            self.assert_(not ps.hasProduct("base"))
+            self.assertNotIn("base", ps.stamps["Linux"])
+
+        finally:
+            if os.path.exists(cache):
+                os.remove(cache)
+            if os.path.isdir(pdir):
+                for p in os.listdir(pdir):
+                    os.remove(os.path.join(pdir, p))
+                os.removedirs(pdir)
+
+    def testJournal(self):
+        import shutil, tempfile
+        persistDir = tempfile.mkdtemp()
+        journalSize = hooks.config.Eups.cacheJournalSize
+        try:
+            cache = os.path.join(persistDir, ProductStack.persistFilename("Linux"))
+            journal = os.path.join(persistDir, ProductStack.journalFilename("Linux"))
+            ps = ProductStack.fromCache(self.dbpath, "Linux", persistDir, 
+                                        autosave=True)
+            self.assert_(os.path.exists(cache))
+            self.assert_(not os.path.exists(journal))
+            mtime = os.stat(cache).st_mtime
+
+            # updates are journaled rather than rewriting the cache
+            ps.addProduct(Product("afw", "1.2", "Linux", 
+                                  "/opt/sw/Linux/afw/1.2", "none"))
+            ps.addProduct(Product("afw", "1.3", "Linux", 
+                                  "/opt/sw/Linux/afw/1.3", "none"))
+            ps.assignTag("beta", "afw", "1.3")
+            ps.removeProduct("afw", "Linux", "1.2")
+            ps.unassignTag("current", "python")
+            self.assert_(os.path.exists(journal))
+            self.assertEquals(os.stat(cache).st_mtime, mtime)
+            self.assert_(ps.cacheIsInSync())
+
+            ps2 = ProductStack(self.dbpath, persistDir, autosave=False)
+            ps2.reload("Linux")
+            self.assert_(ps2.hasProduct("afw", "Linux", "1.3"))
+            self.assert_(not ps2.hasProduct("afw", "Linux", "1.2"))
+            self.assertEquals(ps2.getTaggedProduct("afw", "Linux", "beta").version, 
+                              "1.3")
+            self.assert_(ps2.getTaggedProduct("python", "Linux", "current") is None)
+
+            # another stack sees that the journal has grown
+            ps2.addProduct(Product("afw", "1.4", "Linux", 
+                                   "/opt/sw/Linux/afw/1.4", "none"))
+            ps2.save()
+            self.assert_(not ps.cacheIsInSync())
+            ps.reload("Linux")
+            self.assert_(ps.hasProduct("afw", "Linux", "1.4"))
+
+            # a partly written update is ignored
+            fd = open(journal, "ab")
+            fd.write(b"\0\0\1")
+            fd.close()
+            ps2.reload("Linux")
+            self.assert_(ps2.hasProduct("afw", "Linux", "1.4"))
+
+            # ...and then the cache gets rewritten rather than journaled to
+            ps2.addProduct(Product("afw", "1.5", "Linux", 
+                                   "/opt/sw/Linux/afw/1.5", "none"))
+            ps2.save()
+            self.assert_(not os.path.exists(journal))
+            ps.reload("Linux")
+            self.assert_(ps.hasProduct("afw", "Linux", "1.5"))
+            self.assert_(ps.hasProduct("afw", "Linux", "1.4"))
+
+            # the cache is rewritten once the journal gets too big
+            hooks.config.Eups.cacheJournalSize = 300
+            for v in "2.0 2.1 2.2 2.3 2.4".split():
+                ps.addProduct(Product("afw", v, "Linux", 
+                                      "/opt/sw/Linux/afw/" + v, "none"))
+                if os.path.exists(journal):
+                    self.assert_(os.path.getsize(journal) <= 300)
+            ps2.reload("Linux")
+            self.assertEquals(len(ps2.getVersions("afw", "Linux")), 8)
+
+            ps.clearCache("Linux")
+            self.assert_(not os.path.exists(journal))
+        finally:
+            hooks.config.Eups.cacheJournalSize = journalSize
+            shutil.rmtree(persistDir)
+
+    def testGeneration(self):
+        db = Database(self.dbpath)
+        generation = os.path.join(self.dbpath, ".generation")
+        tfile = os.path.join(self.dbpath, "python", "beta.chain")
+        cache = os.path.join(self.dbpath, 
+                             ProductStack.persistFilename("Linux", "indexed"))
+        try:
+            db.assignTag("beta", "python", "2.6")
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                        updateCache=True, cacheFormat="indexed")
+            self.assertEquals(ps.generations["Linux"][self.dbpath], 
+                              db.getGeneration())
+            self.assertEquals(ps.getTaggedProduct("python", "Linux", "beta").version,
+                              "2.6")
+
+            # changes made behind EUPS's back are only noticed when being 
+            # paranoid
+            backdate(cache)
+            os.remove(tfile)
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                        updateCache=False, cacheFormat="indexed")
+            self.assert_(not [p for p in ps.getProductNames("Linux")
+                              if ps.lookup["Linux"].isLoaded(p)])
+            self.assert_(ps.getTaggedProduct("python", "Linux", "beta"))
+
+            hooks.config.Eups.paranoidCacheCheck = True
+            try:
+                ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                            updateCache=False, cacheFormat="indexed")
+                self.assert_(not ps.getTaggedProduct("python", "Linux", "beta"))
+            finally:
+                hooks.config.Eups.paranoidCacheCheck = False
+
+            # changes made via the database update the generation
+            db.assignTag("beta", "python", "2.5.2")
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                        updateCache=True, cacheFormat="indexed")
+            self.assertEquals(ps.getTaggedProduct("python", "Linux", "beta").version,
+                              "2.5.2")
+            self.assertEquals(ps.generations["Linux"][self.dbpath], 
+                              db.getGeneration())
+        finally:
+            for f in (tfile, generation, cache):
+                if os.path.exists(f):
+                    os.remove(f)
+
+    def testUserTagGeneration(self):
+        # a cache kept with the database notices changes to the user tags that it includes
+        db = Database(self.dbpath)
+        generation = os.path.join(self.dbpath, ".generation")
+        cache = os.path.join(self.dbpath, ProductStack.persistFilename("Linux"))
+        userTagDir = tempfile.mkdtemp()
+        try:
+            db._bumpGeneration()
+            ps = ProductStack.fromCache(self.dbpath, "Linux", userTagDir=userTagDir,
+                                        autosave=False, updateCache=True)
+            self.assertEquals(ps.generations["Linux"],
+                              {self.dbpath : db.getGeneration(), userTagDir : None})
+
+            db._bumpGeneration(userTagDir)
+            ps = ProductStack.fromCache(self.dbpath, "Linux", userTagDir=userTagDir,
+                                        autosave=False, updateCache=True)
+            self.assertEquals(ps.generations["Linux"][userTagDir], 1)
+        finally:
+            shutil.rmtree(userTagDir)
+            for f in (generation, cache):
+                if os.path.exists(f):
+                    os.remove(f)
+
+    def testRefreshOldCache(self):
+        # caches written without product stamps can't be refreshed
+        ps = ProductStack.fromDatabase(self.dbpath, autosave=False)
+        ps.stamps = {}
+        ps.save("Linux")
+        ps = ProductStack(self.dbpath, autosave=False)
+        ps.reload("Linux")
+        self.assert_("Linux" not in ps.stamps)
+        self.assert_(not ps.refreshChangedProducts("Linux"))
+        self.assert_(ps.hasProduct("python", "Linux", "2.5.2"))
+
+        # nor can those written by another major version of python
+        ps = ProductStack.fromDatabase(self.dbpath, autosave=False)
+        ps.save("Linux")
+        cache = ps._persistPath("Linux")
+        fd = open(cache, "rb")
+        data, meta = pickle.load(fd), pickle.load(fd)
+        fd.close()
+        self.assertEquals(meta["python"], sys.version_info[0])
+        meta["python"] = 5 - sys.version_info[0]
+        fd = open(cache, "wb")
+        pickle.dump(data, fd, protocol=2)
+        pickle.dump(meta, fd, protocol=2)
+        fd.close()
+        ps = ProductStack(self.dbpath, autosave=False)
+        ps.reload("Linux")
+        self.assert_("Linux" not in ps.stamps)
+        self.assert_("Linux" not in ps.generations)
+        self.assert_(not ps.refreshChangedProducts("Linux"))
+        self.assertEquals(ps.foreignFlavors, set(["Linux"]))
+
+        # so they are rebuilt from the database, even if they look up to date
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=True)
+        self.assertEquals(ps.foreignFlavors, set())
+        self.assert_(ps.hasProduct("python", "Linux", "2.5.2"))
+        fd = open(cache, "rb")
+        pickle.load(fd)
+        self.assertEquals(pickle.load(fd)["python"], sys.version_info[0])
+        fd.close()
         
+from eups.stack.IndexedCache import IndexedCache
+
+class IndexedCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dbpath = os.path.join(testEupsStack, "ups_db")
+        self.cache = os.path.join(self.dbpath, 
+                                  ProductStack.persistFilename("Linux", "indexed"))
+        if os.path.exists(self.cache):
+            os.remove(self.cache)
+
+    def tearDown(self):
+        if os.path.exists(self.cache):
+            os.remove(self.cache)
+
+    def testFilename(self):
+        self.assertEquals(self.cache, 
+                          os.path.join(self.dbpath, "Linux.indexDB1_3_0"))
+        self.assertRaises(RuntimeError, ProductStack, self.dbpath, 
+                          autosave=False, cacheFormat="goober")
+
+    def testSaveReload(self):
+        ps = ProductStack.fromDatabase(self.dbpath, autosave=False, 
+                                       cacheFormat="indexed")
+        ps.save("Linux")
+        self.assert_(os.path.exists(self.cache))
+        self.assertIn("Linux", ProductStack.findCachedFlavors(self.dbpath))
+        self.assertIn("Linux", ProductStack.findCachedFlavors(self.dbpath, 
+                                                              "indexed"))
+        self.assertNotIn("Linux", 
+                         ProductStack.findCachedFlavors(self.dbpath, "pickle"))
+
+        expected = ps.getProductNames("Linux")
+        expected.sort()
+        tags = ps.getTags("Linux")
+
+        ps2 = ProductStack(self.dbpath, autosave=False, cacheFormat="indexed")
+        ps2.reload("Linux")
+        lookup = ps2.lookup["Linux"]
+        self.assert_(isinstance(lookup, IndexedCache))
+
+        # product names are available without decoding any product
+        names = ps2.getProductNames("Linux")
+        names.sort()
+        self.assertEquals(names, expected)
+        self.assert_(not [n for n in names if lookup.isLoaded(n)])
+
+        p = ps2.getProduct("python", "2.5.2", "Linux")
+        self.assertEquals(p.name, "python")
+        self.assertEquals(p.version, "2.5.2")
+        self.assertEquals(p.flavor, "Linux")
+        self.assertEquals(p.db, self.dbpath)
+        self.assertIn("current", p.tags)
+        self.assert_(lookup.isLoaded("python"))
+        self.assertEquals(len([n for n in names if lookup.isLoaded(n)]), 1)
+
+        self.assertEquals(ps2.getVersions("python", "Linux"), 
+                          ps.getVersions("python", "Linux"))
+
+        # the versions were sorted when the cache was written
+        self.assert_(lookup["python"]._versionIndex is not None)
+        self.assertEquals(ps2.getVersionIndex("python", "Linux", hooks.version_cmp).latest(), "2.6")
+        self.assertEquals(ps2.getVersionIndex("python", "Darwin", hooks.version_cmp), None)
+        self.assertEquals(ps2.getTags("Linux"), tags)
+
+    def testUpdate(self):
+        ps = ProductStack.fromDatabase(self.dbpath, autosave=False, 
+                                       cacheFormat="indexed")
+        ps.save("Linux")
+
+        ps = ProductStack(self.dbpath, autosave=False, cacheFormat="indexed")
+        ps.reload("Linux")
+        ps.addProduct(Product("afw", "1.2", "Linux", "/opt/sw/Linux/afw/1.2", 
+                              "none"))
+        self.assert_(ps.removeProduct("tcltk", "Linux", "8.5a4"))
+        ps.save("Linux")
+
+        ps = ProductStack(self.dbpath, autosave=False, cacheFormat="indexed")
+        ps.reload("Linux")
+        self.assert_(ps.hasProduct("afw", "Linux", "1.2"))
+        self.assert_(not ps.hasProduct("tcltk", "Linux", "8.5a4"))
+        self.assert_(ps.hasProduct("python", "Linux", "2.5.2"))
+        self.assertIn("afw", ps.getProductNames("Linux"))
+
+        del ps.lookup["Linux"]["afw"]
+        self.assertNotIn("afw", ps.getProductNames("Linux"))
+        self.assertRaises(KeyError, ps.lookup["Linux"].__delitem__, "afw")
+
+    def testFromCache(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    updateCache=True, cacheFormat="indexed")
+        self.assert_(os.path.exists(self.cache))
+        self.assert_(ps.hasProduct("python"))
+
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    updateCache=True, cacheFormat="indexed")
+        self.assert_(isinstance(ps.lookup["Linux"], IndexedCache))
+        self.assert_(ps.hasProduct("python", "Linux", "2.5.2"))
+
+from eups.stack import LazyStacks
+import threading
+
+class LazyStacksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirs = ["/a", "/b", "/c", "/d"]
+        self.threads = {}
+        self.stacks = LazyStacks()
+        for d in self.dirs:
+            self.stacks.addLoader(d, self._loader(d))
+
+    def _loader(self, dir):
+        def load():
+            time.sleep(0.1)
+            self.threads[dir] = threading.current_thread().name
+            return "stack for " + dir
+        return load
+
+    def testLazy(self):
+        self.assertEquals(len(self.stacks), 4)
+        self.assert_("/b" in self.stacks)
+        self.assert_("/e" not in self.stacks)
+        self.assertEquals(list(self.stacks.keys()), self.dirs)
+        self.assertEquals(self.stacks.loaded, [])
+
+        self.assertEquals(self.stacks["/c"], "stack for /c")
+        self.assertEquals(self.stacks["/c"], "stack for /c")
+        self.assertEquals(self.stacks.loaded, ["/c"])
+        self.assert_(self.stacks.isLoaded("/c"))
+        self.assert_(not self.stacks.isLoaded("/a"))
+
+        self.stacks["/a"] = "replacement"
+        self.assertEquals(self.stacks["/a"], "replacement")
+        self.assertEquals(self.stacks.loaded, ["/c"])
+        self.assertRaises(KeyError, self.stacks.__getitem__, "/e")
+
+        self.stacks.loadAll()
+        self.assertEquals(self.stacks.loaded, ["/c", "/b", "/d"])
+
+    def testConcurrentLoad(self):
+        self.stacks.load("/b")
+        self.stacks.loadAll(["/d", "/c", "/b", "/a"], nthread=3)
+        self.assertEquals(self.stacks.loaded, ["/b", "/d", "/c", "/a"])
+        self.assertEquals(len(set([self.threads[d] for d in ["/a", "/c", "/d"]])), 3)
+        for d in self.dirs:
+            self.assertEquals(self.stacks[d], "stack for " + d)
+
+from eups.stack.TableCache import TableCache
+import shutil
+import tempfile
+
+class TableCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tablefile = os.path.join(self.tmpdir, "mwi.table")
+        shutil.copy(os.path.join(testEupsStack, "mwi.table"), self.tablefile)
+        self.dbpath = os.path.join(testEupsStack, "ups_db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _getProduct(self, stack):
+        stack.addProduct(Product("mwi", "3.1", "Linux", 
+                                 "/opt/Linux/magnum/3.1", self.tablefile))
+        return stack.getProduct("mwi", "3.1", "Linux")
+
+    def _actions(self, table):
+        return [str(a) for a in table.actions("Linux")]
+
+    def testCache(self):
+        ps = ProductStack(self.dbpath, self.tmpdir, autosave=False)
+        prod = self._getProduct(ps)
+        table = prod.getTable()
+        cache = ps.getTableCache()
+        self.assertEquals(len(cache), 1)
+        cache.save()
+        cacheFile = os.path.join(self.tmpdir, ProductStack.tableCacheFile)
+        self.assert_(os.path.exists(cacheFile))
+        self.assert_(not ProductStack.cacheFileRe.match(os.path.basename(cacheFile)))
+
+        # a new stack reads the table from the cache
+        ps = ProductStack(self.dbpath, self.tmpdir, autosave=False)
+        prod = self._getProduct(ps)
+        cached = ps.getTableCache().getTable(self.tablefile, prod)
+        self.assert_(cached is not None)
+        self.assertEquals(self._actions(cached.expandEupsVariables(prod)), 
+                          self._actions(table))
+        self.assertEquals(self._actions(prod.getTable()), self._actions(table))
+
+        # the entry is invalidated when the table file changes
+        fd = open(self.tablefile, "a")
+        fd.write("envSet(MWI_EXTRA, 1)\n")
+        fd.close()
+        self.assert_(TableCache(cacheFile).getTable(self.tablefile, prod) is None)
+
+        ps.clearCache("Linux", verbose=-1)
+        self.assert_(not os.path.exists(cacheFile))
+        self.assertEquals(len(ps.getTableCache()), 0)
+
+    def testOtherPython(self):
+        # caches written by another major version of python are ignored
+        ps = ProductStack(self.dbpath, self.tmpdir, autosave=False)
+        prod = self._getProduct(ps)
+        prod.getTable()
+        cache = ps.getTableCache()
+        cache.save()
+
+        fd = open(cache.file, "rb")
+        data = pickle.load(fd)
+        fd.close()
+        self.assertEquals(data["python"], sys.version_info[0])
+        self.assertEquals(len(TableCache(cache.file)), 1)
+
+        data["python"] = 5 - sys.version_info[0]
+        fd = open(cache.file, "wb")
+        pickle.dump(data, fd, protocol=2)
+        fd.close()
+        self.assertEquals(len(TableCache(cache.file)), 0)
+
+    def testDisabled(self):
+        cacheTables = hooks.config.Eups.cacheTables
+        hooks.config.Eups.cacheTables = False
+        try:
+            ps = ProductStack(self.dbpath, self.tmpdir, autosave=False)
+            self.assert_(ps.getTableCache() is None)
+            self.assert_(self._getProduct(ps).getTable() is not None)
+        finally:
+            hooks.config.Eups.cacheTables = cacheTables
+
+from eups.stack import WarmStacks
+
+class WarmStacksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(testEupsStack, "ups_db")
+        self.generation = os.path.join(self.dbpath, ".generation")
+        self.db = Database(self.dbpath)
+        self.db._bumpGeneration()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        if os.path.exists(self.generation):
+            os.remove(self.generation)
+
+    def testReuse(self):
+        warm = WarmStacks()
+        ps = ProductStack.fromDatabase(self.dbpath, autosave=False)
+        self.assert_(warm.get(self.dbpath, ["Linux"], self.tmpdir, None) is None)
+        warm.add(ps, self.dbpath, ["Linux"], self.tmpdir, None)
+        self.assertEquals(len(warm), 1)
+
+        self.assert_(warm.get(self.dbpath, ["Linux"], self.tmpdir, None) is ps)
+        self.assert_(warm.get(self.dbpath, ["Darwin"], self.tmpdir, None) is None)
+
+        # a change to the database retires the stack
+        self.db._bumpGeneration()
+        self.assert_(warm.get(self.dbpath, ["Linux"], self.tmpdir, None) is None)
+        self.assertEquals(len(warm), 0)
+
+    def testCacheChanged(self):
+        warm = WarmStacks()
+        ps = ProductStack.fromDatabase(self.dbpath, self.tmpdir, autosave=False)
+        warm.add(ps, self.dbpath, ["Linux"], self.tmpdir, None)
+
+        ps.save("Linux")
+        self.assert_(warm.get(self.dbpath, ["Linux"], self.tmpdir, None) is None)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -475,8 +1091,12 @@ def suite(makeSuite=True):
 
     return testCommon.makeSuite([
         CacheTestCase,
+        IndexedCacheTestCase,
+        LazyStacksTestCase,
         ProductFamilyTestCase,
-        ProductStackTestCase
+        ProductStackTestCase,
+        TableCacheTestCase,
+        WarmStacksTestCase
         ], makeSuite)
 
 def run(shouldExit=False):
@@ -10,6 +10,7 @@ from testCommon import testEupsStack
 
 from eups.table import Table
 from eups.Eups import Eups
+from eups.PathVariables import OrderedPath
 
 class TableTestCase1(unittest.TestCase):
     """test the Table class"""
@@ -129,6 +130,32 @@ class TableTestCase2(unittest.TestCase):
             action.execute(self.eups, 1, True)
 
 
+class OrderedPathTestCase(unittest.TestCase):
+    """test the OrderedPath class used by envPrepend/envAppend"""
+
+    def testOps(self):
+        path = OrderedPath(":/usr/goob:/opt/goob::/usr/goob:")
+        self.assertEquals(path.elements(), ["/usr/goob", "/opt/goob"])
+        self.assertEquals(str(path), "/usr/goob:/opt/goob")
+
+        path.prepend("/home/goob")
+        path.prepend("/opt/goob")       # moves to the front
+        path.append("/usr/goob")        # already there
+        path.append("/usr/local/goob")
+        path.remove("/home/goob")
+        path.remove("/no/goob")
+        self.assertEquals(str(path), "/opt/goob:/usr/goob:/usr/local/goob")
+        self.assertIn("/usr/goob", path)
+        self.assertEquals(len(path), 3)
+
+        copy = path.copy()
+        copy.prepend("/usr/local/goob")
+        copy.leadingDelim = copy.trailingDelim = True
+        self.assertEquals(str(copy), ":/usr/local/goob:/opt/goob:/usr/goob:")
+        self.assertEquals(str(path), "/opt/goob:/usr/goob:/usr/local/goob")
+
+        self.assertEquals(str(OrderedPath("a;b;a", ";")), "a;b")
+
 class EmptyTableTestCase(unittest.TestCase):
     """
     test out an (effectively) empty table file
@@ -165,6 +192,61 @@ class IfElseTestCase(unittest.TestCase):
 
             self.assertEqual(os.environ["FOO"].lower(), t)
                 
+class TableLexerTestCase(unittest.TestCase):
+    """
+    Check that tables are parsed the same by the lexer and the regular expression path
+    """
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+
+    def tearDown(self):
+        os.environ = self.environ0
+
+    def assertParsedSame(self, tableFile, lines):
+        import benchTable
+        expected = benchTable.parse(tableFile, lines, lexer=False)
+        table = benchTable.parse(tableFile, lines)
+        self.assertEquals(table.getCompiled(), expected.getCompiled())
+
+    def testTestTables(self):
+        import benchTable
+        tables = benchTable.testTables()
+        self.assert_(len(tables) > 5)
+        for tableFile, lines in tables:
+            self.assertParsedSame(tableFile, lines)
+
+    def testSyntheticTables(self):
+        import benchTable
+        for i in range(40):
+            self.assertParsedSame("synth%d.table" % i, benchTable.makeTable(i))
+
+    def testQuoting(self):
+        lines = [
+            'envSet(A, "x, y" "z")\n',
+            'envSet(B, a"b"c)\n',
+            'envSet(C, \\"quoted\\")\n',
+            'envSet(D, x)#comment\n',
+            'envSet(E, "${UPS_DB}/${UPS_UPS_DIR}")\n',
+            'envSet(F, "a","b")\n',
+            'envAppend(G, x, " ")\n',
+            'envPrepend(H, "a b" , ",")\n',
+            'setupRequired("foo 1.2")\n',
+            '\t   # just a comment\r\n',
+            'if(x){\n',
+            '  envSet(I, "")\n',
+            '}else{\n',
+            '  envSet(I, "" "")\n',
+            '}\n',
+            ]
+        self.assertParsedSame("quoting.table", lines)
+
+        table = Table("quoting.table", addDefaultProduct=False, contents=lines)
+        args = [a.args for a in table.actions(None)]
+        self.assertEquals(args[0], ["A", "x, y z"])
+        self.assertEquals(args[2], ["C", '"quoted"'])
+        self.assertEquals(args[4], ["E", "${PRODUCTS}/${UPS_DIR}"])
+
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -173,9 +255,11 @@ def suite(makeSuite=True):
 
     return testCommon.makeSuite([
         EmptyTableTestCase,
+        OrderedPathTestCase,
         TableTestCase1,
         TableTestCase2,
         IfElseTestCase,
+        TableLexerTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Tests for eups.VersionCompare
+"""
+
+import functools
+import random
+import unittest
+
+import testCommon
+from eups.VersionCompare import VersionCompare, versionSortKey, latestVersion
+
+class UnparsedVersionCompare(VersionCompare):
+    """A VersionCompare that splits the versions every time they're compared, as eups used to"""
+
+    def _splitVersion(self, version):
+        return VersionCompare._splitVersion(self, version)
+
+def randomVersions(rand, n, realistic=True):
+    """return a list of n random version strings"""
+    if realistic:
+        parts = ["0", "1", "2", "3", "10", "12"]
+    else:
+        parts = ["0", "1", "2", "9", "10", "01", "v1", "v10", "v2", "a", "b", "rc1", "", "beta"]
+
+    versions = []
+    for i in range(n):
+        v = ".".join([rand.choice(parts) for j in range(rand.randint(1, 4))]) or "1"
+        r = rand.random()
+        if r < 0.2:
+            v += "-" + rand.choice(["1", "2", "10"] + (["rc1"], [])[realistic])
+        elif r < 0.35:
+            v += "+" + rand.choice(["1", "2", "10", "1.2"] + (["m3", "p5", "abc"], [])[realistic])
+        elif r < 0.45:
+            v += rand.choice(["m1", "m2", "p1", "p10"])
+        elif r < 0.5:
+            v += "-1+" + rand.choice(["1", "3"])
+        versions.append(v)
+    return versions
+
+class VersionCompareTestCase(unittest.TestCase):
+    """test sorting versions"""
+
+    def setUp(self):
+        self.vcmp = VersionCompare()
+        self.unparsed = UnparsedVersionCompare()
+
+    def sortedByCmp(self, versions, vcmp=None):
+        return sorted(versions, key=functools.cmp_to_key(vcmp or self.unparsed))
+
+    def testCompare(self):
+        rand = random.Random(42)
+        for realistic in (True, False):
+            versions = randomVersions(rand, 200, realistic)
+            for v1 in versions[:50]:
+                for v2 in versions:
+                    for mustReturnInt in (True, False):
+                        results = []
+                        for vcmp in (self.unparsed, self.vcmp):
+                            try:
+                                results.append(vcmp(v1, v2, mustReturnInt))
+                            except ValueError:
+                                results.append(ValueError)
+                        self.assertEqual(results[0], results[1], "%s %s" % (v1, v2))
+
+    def testSortKey(self):
+        versions = ["1.2.3", "1.2.3-rc1", "1.2.3+2", "1.2.3+10", "1.10", "1.2", "1.2.3-rc2+3", "2",
+                    "1.2p1", "1.2.3.0"]
+        key, isTuple = self.vcmp.sortKey(versions)
+        self.assert_(isTuple)
+        self.assertEqual(sorted(versions, key=key), self.sortedByCmp(versions))
+        self.assertEqual(sorted(versions, key=key),
+                         ["1.2", "1.2p1", "1.2.3-rc1", "1.2.3-rc2+3", "1.2.3", "1.2.3+2",
+                          "1.2.3+10", "1.2.3.0", "1.10", "2"])
+        #
+        # Versions that can't be given consistent keys are sorted using compare();  1.2a sorts
+        # before 1.9 but after 1.10 (as they're compared as strings)
+        #
+        for versions in (["1.9", "1.10", "1.2a"], ["1.1", "1.01-2"], ["v1", "1"]):
+            key, isTuple = self.vcmp.sortKey(versions)
+            self.assert_(not isTuple)
+            self.assertEqual(sorted(versions, key=key), self.sortedByCmp(versions))
+
+    def testSortKeyMatchesCompare(self):
+        rand = random.Random(42)
+        for realistic in (True, False):
+            for i in range(500):
+                versions = randomVersions(rand, rand.randint(1, 20), realistic)
+                expected = self.sortedByCmp(versions)
+                self.assertEqual(sorted(versions, key=versionSortKey(self.vcmp, versions)), expected)
+                self.assertEqual(latestVersion(self.vcmp, versions), expected[-1])
+
+    def testLatest(self):
+        self.assertEqual(latestVersion(self.vcmp, []), None)
+        self.assertEqual(latestVersion(self.vcmp, ["1.2", "1.10", "1.9"]), "1.10")
+        self.assertEqual(latestVersion(self.vcmp, ["1.1", "1.01"]), "1.01") # equal; the last wins
+
+    def testCustomCompare(self):
+        def reversedCmp(v1, v2, mustReturnInt=True):
+            return self.vcmp(v2, v1, mustReturnInt)
+
+        versions = ["1.2", "1.10", "1.9", "2.0"]
+        self.assertEqual(sorted(versions, key=versionSortKey(reversedCmp, versions)),
+                         ["2.0", "1.10", "1.9", "1.2"])
+        self.assertEqual(latestVersion(reversedCmp, versions), "1.2")
+
+        class ReversedVersionCompare(VersionCompare):
+            def compare(self, v1, v2, mustReturnInt=True):
+                return self.stdCompare(v2, v1, mustReturnInt=mustReturnInt)
+
+        self.assertEqual(latestVersion(ReversedVersionCompare(), versions), "1.2")
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        VersionCompareTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Tests for eups.VersionParser
+"""
+
+import os
+import random
+import sys
+import unittest
+
+import testCommon
+from eups.VersionParser import VersionParser
+vp = sys.modules["eups.VersionParser"] # not the class of the same name
+
+class VersionParserTestCase(unittest.TestCase):
+    """test evaluating logical expressions"""
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["VP_LINUX"] = "Linux"
+        if "VP_UNSET" in os.environ:
+            del os.environ["VP_UNSET"]
+
+    def tearDown(self):
+        os.environ = self.environ0
+
+    def eval(self, exprStr, interpret=False, **symbols):
+        parser = VersionParser(exprStr)
+        for k, v in symbols.items():
+            parser.define(k, v)
+        if interpret:
+            val = parser._interpret()
+        else:
+            val = parser.eval()
+        if hasattr(val, "span"):        # a match object
+            val = ("match", val.span())
+        return val
+
+    def testEval(self):
+        self.assertEqual(self.eval("flavor == Linux64", flavor="Linux64"), True)
+        self.assertEqual(self.eval("FLAVOR == Linux64", flavor="Linux"), False)
+        self.assertEqual(self.eval("flavor == Linux || flavor == Linux64", flavor="Linux64"), True)
+        self.assertEqual(self.eval("type == build", type=["build"]), True)
+        self.assertEqual(self.eval("type != build", type=["exact"]), True)
+        self.assertEqual(self.eval("depth <= 2", depth=3), False)
+        self.assertEqual(self.eval("!(depth <= 2)", depth=3), True)
+        self.assertEqual(self.eval("${VP_LINUX} == Linux"), True)
+        self.assertEqual(self.eval("${VP_UNSET:-Linux} == Linux"), True)
+        self.assertEqual(self.eval("True"), True)
+        self.assertEqual(self.eval(""), False)
+        self.assertRaises(RuntimeError, self.eval, "${VP_UNSET} == Linux")
+
+    def testCompiled(self):
+        self.assert_(VersionParser("flavor == Linux || type == build")._compiled.evaluate)
+        self.assert_(VersionParser("(a == a && !(b == c))")._compiled.evaluate)
+        self.assert_(not VersionParser("FLAVOR =~ .*")._compiled.evaluate) # trailing *
+        #
+        # The interpreter gives up on a short circuit within parentheses;  so must we
+        #
+        self.assertRaises(RuntimeError, self.eval, "(a == a || b == b)")
+        self.assertEqual(self.eval("(a == b || b == b)"), True)
+        #
+        # Symbols that look like operators are handled by the interpreter
+        #
+        self.assertEqual(self.eval("a == b", interpret=True, **{"==" : "!="}),
+                         self.eval("a == b", **{"==" : "!="}))
+
+    def testCompiledMatchesInterpreter(self):
+        rand = random.Random(42)
+        ops = ["==", "!=", "=~", "!~", "<", "<=", ">", ">="]
+        atoms = ["a", "flavor", "type", "1", "2", "True", "${VP_LINUX}", "${VP_UNSET:-x}", "${VP_UNSET}",
+                 "Linux", "L.*", "build", "(", "||", "EOF"]
+        values = ["Linux", "1", 2, True, False, ["build"], "", "build", "||", "("]
+
+        def prim(depth):
+            r = rand.random()
+            if depth < 3 and r < 0.2:
+                return "( %s )" % expr(depth + 1)
+            elif depth < 3 and r < 0.3:
+                return "! %s" % expr(depth + 1)
+            return rand.choice(atoms)
+
+        def term(depth):
+            if rand.random() < 0.7:
+                return "%s %s %s" % (prim(depth), rand.choice(ops), prim(depth))
+            return prim(depth)
+
+        def expr(depth):
+            s = term(depth)
+            for i in range(rand.randint(0, 2)):
+                s += " %s %s" % (rand.choice(["||", "&&", "or", "and"]), term(depth))
+            return s
+
+        for i in range(2000):
+            exprStr = expr(0)
+            symbols = {}
+            for k in rand.sample(["a", "flavor", "type"], rand.randint(0, 3)):
+                symbols[k] = rand.choice(values)
+
+            results = []
+            for interpret in (True, False):
+                try:
+                    results.append(self.eval(exprStr, interpret, **symbols))
+                except Exception as e:
+                    results.append((type(e), str(e)))
+            self.assertEqual(results[0], results[1], "%s %s" % (exprStr, symbols))
+
+    def testCache(self):
+        exprStr = "flavor == CacheTest"
+        self.assert_(VersionParser(exprStr)._compiled is VersionParser(exprStr)._compiled)
+
+        cacheSize0 = vp._cacheSize
+        vp._cacheSize = 2
+        try:
+            for e in ["a == 1", "a == 2", "a == 3"]:
+                VersionParser(e)
+            self.assert_(len(vp._cache) <= 2)
+            self.assert_("a == 3" in vp._cache)
+        finally:
+            vp._cacheSize = cacheSize0
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        VersionParserTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)